@@ -0,0 +1,70 @@
+import sys
+import time
+
+import numpy as np
+from photon_stream.representations import (
+    list_of_lists_to_raw_phs,
+    raw_phs_to_point_cloud,
+)
+from photon_stream.geometry import GEOMETRY
+from photon_stream.io.magic_constants import NUMBER_OF_PIXELS
+
+from factnn.utils.phs import photons_to_point_clouds
+
+"""
+Compares converting events from the list of lists to point clouds with photon_stream, one photon at a time,
+against the batched conversion of factnn.utils.phs
+
+Usage: python benchmark_point_cloud.py [number of events] [mean photons per pixel]
+"""
+
+num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+photons_per_pixel = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+rng = np.random.RandomState(1337)
+events = [
+    [
+        sorted(rng.randint(0, 100, rng.poisson(photons_per_pixel)).tolist())
+        for _ in range(NUMBER_OF_PIXELS)
+    ]
+    for _ in range(num_events)
+]
+print(
+    "{} events with {:.0f} photons on average".format(
+        num_events, np.mean([sum(len(pixel) for pixel in event) for event in events])
+    )
+)
+
+
+def photon_stream_point_clouds(events):
+    return [
+        np.asarray(
+            raw_phs_to_point_cloud(
+                list_of_lists_to_raw_phs(event),
+                cx=GEOMETRY.x_angle,
+                cy=GEOMETRY.y_angle,
+            ),
+            dtype=np.float32,
+        )
+        for event in events
+    ]
+
+
+if __name__ == "__main__":
+    results = {}
+    for name, converter in [
+        ("photon_stream", photon_stream_point_clouds),
+        ("factnn", photons_to_point_clouds),
+    ]:
+        start = time.time()
+        results[name] = converter(events)
+        seconds = time.time() - start
+        print(
+            "{:>14}: {:.3f} s, {:.1f} events/s".format(
+                name, seconds, num_events / seconds
+            )
+        )
+
+    for expected, point_cloud in zip(results["photon_stream"], results["factnn"]):
+        np.testing.assert_allclose(point_cloud, expected, rtol=1e-6)
+    print("Point clouds are the same")
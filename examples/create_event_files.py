@@ -5,11 +5,9 @@ from os import path
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # see issue #152
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 from factnn import ProtonPreprocessor, GammaPreprocessor, GammaDiffusePreprocessor
+from factnn.utils.io import convert_events
 import os
 
-from multiprocessing import Pool
-from functools import partial
-
 
 base_dir = "/run/media/jacob/SSD_Backup/phs/"
 obs_dir = [base_dir + "public/"]
@@ -34,104 +32,43 @@ for directory in gamma_dir:
 print(len(gamma_paths))
 
 
-def gf(clump_size, path):
-    print("Gamma_Diffuse")
-    print("Size: ", clump_size)
+if __name__ == "__main__":
+
+    clump_sizes = [20, 10, 15]
+    for clump_size in clump_sizes:
+        output_paths = [
+            os.path.join(output_path, "protonFeature", "no_clean"),
+            os.path.join(output_path, "protonFeature", "clump" + str(clump_size)),
+            os.path.join(output_path, "protonFeature", "core" + str(clump_size)),
+            os.path.join(output_path, "gammaFeature", "no_clean"),
+            os.path.join(output_path, "gammaFeature", "clump" + str(clump_size)),
+            os.path.join(output_path, "gammaFeature", "core" + str(clump_size)),
+            os.path.join(output_path, "gamma_diffuse", "no_clean"),
+            os.path.join(output_path, "gamma_diffuse", "clump" + str(clump_size)),
+            os.path.join(output_path, "gamma_diffuse", "core" + str(clump_size)),
+        ]
+        for path in output_paths:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
     gamma_configuration = {
-        "rebin_size": clump_size,
+        "rebin_size": rebin_size,
         "output_file": "../gamma.hdf5",
         "shape": shape,
-        "paths": [path],
         "dl2_file": gamma_dl2,
+        "clustering": "grid",
     }
-
-    gamma_train_preprocessor = GammaDiffusePreprocessor(config=gamma_configuration)
-    gamma_train_preprocessor.event_processor(
-        directory=os.path.join(output_path, "gamma_diffuse"),
-        clean_images=True,
-        only_core=True,
-        clump_size=clump_size,
+    # Files are split into tasks of 500 events, rerunning skips the tasks in the manifest of the output directory
+    # All clump sizes are cleaned in one pass over the events
+    convert_events(
+        GammaDiffusePreprocessor,
+        gamma_paths,
+        os.path.join(output_path, "gamma_diffuse"),
+        config=gamma_configuration,
+        processor_kwargs={
+            "clean_images": True,
+            "clump_size": clump_sizes,
+        },
+        events_per_task=500,
+        threads=8,
     )
-
-
-# Now do the Kfold Cross validation Part for both sets of paths
-
-
-if __name__ == "__main__":
-
-    clump_size = 20
-    output_paths = [
-        os.path.join(output_path, "protonFeature", "no_clean"),
-        os.path.join(output_path, "protonFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "protonFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "no_clean"),
-        os.path.join(output_path, "gammaFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "no_clean"),
-        os.path.join(output_path, "gamma_diffuse", "clump" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "core" + str(clump_size)),
-    ]
-    for path in output_paths:
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    # proton_pool = Pool(8)
-    gamma_pool = Pool(1)
-    # dunc = partial(d, clump_size)
-    # gunc = partial(gf, clump_size)
-    # g = proton_pool.map_async(dunc, crab_paths)
-    func = partial(gf, clump_size)
-    r = gamma_pool.map(func, gamma_paths)
-
-    # g.wait()
-    # print("\n\n\n\n\n\n\n----------------------------------Done Proton------------------------------------------------\n\n\n\n\n\n\n\n")
-    r.wait()
-
-    clump_size_2 = 10
-    output_paths = [
-        os.path.join(output_path, "protonFeature", "no_clean"),
-        os.path.join(output_path, "protonFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "protonFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "no_clean"),
-        os.path.join(output_path, "gammaFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "no_clean"),
-        os.path.join(output_path, "gamma_diffuse", "clump" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "core" + str(clump_size)),
-    ]
-    for path in output_paths:
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-    # dunc = partial(d, clump_size_2)
-    # g = proton_pool.map_async(dunc, crab_paths)
-    r.wait()
-
-    func = partial(gf, clump_size_2)
-    r = gamma_pool.map_async(func, gamma_paths)
-
-    r.wait()
-    # g.wait()
-
-    clump_size_3 = 15
-    output_paths = [
-        os.path.join(output_path, "protonFeature", "no_clean"),
-        os.path.join(output_path, "protonFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "protonFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "no_clean"),
-        os.path.join(output_path, "gammaFeature", "clump" + str(clump_size)),
-        os.path.join(output_path, "gammaFeature", "core" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "no_clean"),
-        os.path.join(output_path, "gamma_diffuse", "clump" + str(clump_size)),
-        os.path.join(output_path, "gamma_diffuse", "core" + str(clump_size)),
-    ]
-    for path in output_paths:
-        if not os.path.exists(path):
-            os.makedirs(path)
-    func = partial(gf, clump_size_3)
-    # dunc = partial(d, clump_size_3)
-    r = gamma_pool.map_async(func, gamma_paths)
-    # g = proton_pool.map_async(dunc, crab_paths)
-
-    r.wait()
-    # g.wait()
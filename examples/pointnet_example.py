@@ -423,8 +423,8 @@ model.compile(loss=loss, optimizer=optimizer, metrics=metric)
 
 model.summary()
 
-model.fit_generator(
-    generator=train,
+model.fit(
+    train,
     epochs=500,
     verbose=2,
     validation_data=val,
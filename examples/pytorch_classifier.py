@@ -6,6 +6,7 @@ import numpy as np
 import argparse
 
 from factnn.generator.pytorch.datasets import (
+    BalancedSampler,
     ClusterDataset,
     DiffuseDataset,
     EventDataset,
@@ -36,7 +37,7 @@ def test(args, model, device, test_loader):
             data = data.to(device)
             output = model(data)
             # sum up batch loss
-            test_loss += F.nll_loss(output, data.y, reduction="sum").item()
+            test_loss += F.nll_loss(output, data.y.view(-1), reduction="sum").item()
             # get the index of the max log-probability
             pred = output.argmax(dim=1, keepdim=True)
             correct += pred.eq(data.y.view_as(pred)).sum().item()
@@ -82,7 +83,7 @@ def train(args, model, device, train_loader, optimizer, epoch):
         data = data.to(device)
         optimizer.zero_grad()
         output = model(data)
-        loss = F.nll_loss(F.log_softmax(output, dim=-1), data.y)
+        loss = F.nll_loss(F.log_softmax(output, dim=-1), data.y.view(-1))
         loss.backward()
 
         # save_loss.append(loss.item())
@@ -134,7 +135,14 @@ def default_argument_parser():
         "--max-points",
         type=int,
         default=0,
-        help="max number of sampled points, if > 0, default 0",
+        help="max number of sampled points, if > 0 the point clouds are stored with this many points "
+        "and batched densely, default 0",
+    )
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help="whether to draw new balanced training events every epoch, instead of fixing them when processing, "
+        "default False",
     )
     parser.add_argument(
         "--dataset", type=str, default="", help="path to dataset folder"
@@ -166,8 +174,9 @@ if __name__ == "__main__":
     np.random.seed(args.seed)
     num_classes = 2
     transforms = []
-    if args.max_points > 0:
-        transforms.append(T.FixedPoints(args.max_points))
+    # Fixed size point clouds are made when processing, and stacked into dense batches
+    num_points = args.max_points if args.max_points > 0 else None
+    loader_class = DenseDataLoader if num_points is not None else DataLoader
     if args.augment:
         transforms.append(T.RandomRotate((-180, 180), axis=2))  # Rotate around z axis
         transforms.append(T.RandomFlip(0))  # Flp about x axis
@@ -184,8 +193,9 @@ if __name__ == "__main__":
         cleanliness=args.clean,
         pre_transform=None,
         transform=transform,
-        balanced_classes=True,
-        fraction=0.001
+        balanced_classes=not args.resample,
+        fraction=0.001,
+        num_points=num_points,
     )
     test_dataset = EventDataset(
         args.dataset,
@@ -195,18 +205,24 @@ if __name__ == "__main__":
         cleanliness=args.clean,
         pre_transform=None,
         transform=transform,
-        fraction=0.001
+        fraction=0.001,
+        num_points=num_points,
     )
     print(len(test_dataset))
     print(len(train_dataset))
-    train_loader = DataLoader(
+    # The sampler shuffles, and draws the same number of gamma and proton events each epoch
+    train_sampler = (
+        BalancedSampler(train_dataset.event_types) if args.resample else None
+    )
+    train_loader = loader_class(
         train_dataset,
         batch_size=args.batch,
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         num_workers=12,
     )
     print(next(iter(train_loader)))
-    test_loader = DataLoader(
+    test_loader = loader_class(
         test_dataset,
         batch_size=args.batch,
         shuffle=False,
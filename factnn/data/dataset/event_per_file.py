@@ -39,7 +39,6 @@ def process_diffuse_gamma_files(
         gamma_train_preprocessor.event_processor(
             directory=output_dir,
             clean_images=True,
-            only_core=True,
             clump_size=clump_size,
         )
 
@@ -73,7 +72,7 @@ def process_gamma_files(
 
         gamma_train_preprocessor = GammaPreprocessor(config=gamma_configuration)
         gamma_train_preprocessor.event_processor(
-            output_dir, clean_images=True, only_core=True, clump_size=clump_size
+            output_dir, clean_images=True, clump_size=clump_size
         )
 
     pool = Pool(num_workers)
@@ -104,7 +103,7 @@ def process_proton_files(
 
         proton_train_preprocessor = ProtonPreprocessor(config=proton_configuration)
         proton_train_preprocessor.event_processor(
-            output_dir, clean_images=True, only_core=True, clump_size=clump_size
+            output_dir, clean_images=True, clump_size=clump_size
         )
 
     pool = Pool(num_workers)
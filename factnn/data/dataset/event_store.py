@@ -0,0 +1,421 @@
+"""
+Packed event store, replacing the one pickle per event files written by the event processors
+
+A store is a directory holding one or more shards. Each shard is a directory with
+
+- times.bin: uint8 arrival time slices of all photons of all events, in event and then CHID order
+- pixel_counts.bin: uint16 (num_events, 1440) number of photons per CHID of each event
+- photon_offsets.npy: int64 (num_events + 1) offset of the first photon of each event in times.bin
+- names.npy: name of each event, <run>_<counter> like the event files
+- columns/<name>.npy: one array per data_format entry, e.g. Energy, Zd_Deg, Phi, Theta, COG_X
+- features/<name>.npy: one array per extracted Hillas feature, NaN where an event has none
+- metadata.json: number of events and photons, data_format and the column names
+
+The arrival times of the photons of CHID c in an event are the pixel_counts[event, c] values following the
+sum of pixel_counts[event, :c]
+"""
+
+import json
+import os
+
+import numpy as np
+
+from factnn.utils.phs import arrays_to_point_cloud
+
+METADATA_FILE = "metadata.json"
+TIMES_FILE = "times.bin"
+PIXEL_COUNTS_FILE = "pixel_counts.bin"
+NUMBER_OF_PIXELS = 1440
+
+
+def to_column(values):
+    """
+    Converts the values of one column to an array that can be saved as .npy and memory mapped
+    :param values: List of values, None where an event has no value
+    :return: Numeric array with NaN for missing values, or datetime64 or string array if the values are not numeric
+    """
+    values = np.asarray(values)
+    if values.dtype != object:
+        return values
+    for dtype in (np.float64, "datetime64[us]", str):
+        try:
+            return values.astype(dtype)
+        except (TypeError, ValueError):
+            continue
+
+
+def save_array(path, array):
+    """
+    Saves an array as .npy, written under a temporary name first so readers never see a partial file
+    :param path: Path of the .npy file
+    :param array: Array to save
+    """
+    temp_path = path + ".tmp.npy"
+    np.save(temp_path, array)
+    os.replace(temp_path, path)
+
+
+class EventStoreWriter(object):
+    """
+    Appends events to one shard of a packed event store
+
+    Reopening an existing shard appends to it, photons written after the last flush are discarded
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Directory of the shard, created if it does not exist
+        """
+        self.path = path
+        os.makedirs(os.path.join(path, "columns"), exist_ok=True)
+        os.makedirs(os.path.join(path, "features"), exist_ok=True)
+
+        self.names = []
+        self.name_set = set()
+        self.photon_offsets = [0]
+        self.data_format = {}
+        self.columns = {}
+        self.features = {}
+        if os.path.isfile(os.path.join(path, METADATA_FILE)):
+            store = EventStore(path)
+            self.names = [str(name) for name in store.names]
+            self.name_set = set(self.names)
+            self.photon_offsets = list(store.photon_offsets(0))
+            self.data_format = store.data_format(0)
+            for name in store.column_names:
+                self.columns[name] = list(store.column(name))
+            for name in store.feature_names:
+                self.features[name] = list(store.feature(name))
+
+        # Drop anything written after the last flush
+        self.times_file = open(os.path.join(path, TIMES_FILE), "ab")
+        self.times_file.truncate(self.photon_offsets[-1])
+        self.pixel_counts_file = open(os.path.join(path, PIXEL_COUNTS_FILE), "ab")
+        self.pixel_counts_file.truncate(len(self.names) * NUMBER_OF_PIXELS * 2)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return str(name) in self.name_set
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, name, data, data_format, features=None, cluster=None):
+        """
+        Appends one event, takes the same [data, data_format, features, cluster] the event files were pickled with
+
+        :param name: Name of the event, <run>_<counter> for the event files
+        :param data: List of the list of lists of photons and the event values, ordered by data_format
+        :param data_format: Dictionary of value name to index in data, with the photons at "Image"
+        :param features: Dictionary of extracted Hillas features, only scalar values are stored
+        :param cluster: Unused, the clustering is not stored
+        """
+        photons = data[data_format["Image"]]
+        pixel_counts = np.fromiter(
+            (len(pixel) for pixel in photons), dtype=np.uint16, count=len(photons)
+        )
+        times = np.fromiter(
+            (time for pixel in photons for time in pixel),
+            dtype=np.uint8,
+            count=int(np.sum(pixel_counts, dtype=np.int64)),
+        )
+        self.times_file.write(times.tobytes())
+        self.pixel_counts_file.write(pixel_counts.tobytes())
+
+        num_events = len(self.names)
+        for key, index in data_format.items():
+            if key == "Image":
+                continue
+            if key not in self.columns:
+                self.columns[key] = [None] * num_events
+                self.data_format[key] = index
+            self.columns[key].append(data[index])
+        self.data_format["Image"] = data_format["Image"]
+        for key in self.columns:
+            if len(self.columns[key]) == num_events:
+                self.columns[key].append(None)
+
+        if features is None:
+            features = {}
+        for key, value in features.items():
+            if not np.isscalar(value):
+                continue
+            if key not in self.features:
+                self.features[key] = [None] * num_events
+            self.features[key].append(value)
+        for key in self.features:
+            if len(self.features[key]) == num_events:
+                self.features[key].append(None)
+
+        self.names.append(str(name))
+        self.name_set.add(str(name))
+        self.photon_offsets.append(self.photon_offsets[-1] + len(times))
+
+    def flush(self):
+        """
+        Writes the event index and columns, events appended before the flush are then readable
+        """
+        self.times_file.flush()
+        self.pixel_counts_file.flush()
+        save_array(
+            os.path.join(self.path, "photon_offsets.npy"),
+            np.asarray(self.photon_offsets, dtype=np.int64),
+        )
+        save_array(
+            os.path.join(self.path, "names.npy"), np.asarray(self.names, dtype=str)
+        )
+        for key, values in self.columns.items():
+            save_array(
+                os.path.join(self.path, "columns", key + ".npy"), to_column(values)
+            )
+        for key, values in self.features.items():
+            save_array(
+                os.path.join(self.path, "features", key + ".npy"), to_column(values)
+            )
+        metadata = {
+            "num_events": len(self.names),
+            "num_photons": int(self.photon_offsets[-1]),
+            "data_format": self.data_format,
+            "columns": sorted(self.columns),
+            "features": sorted(self.features),
+        }
+        temp_path = os.path.join(self.path, METADATA_FILE + ".tmp")
+        with open(temp_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(temp_path, os.path.join(self.path, METADATA_FILE))
+
+    def close(self):
+        self.flush()
+        self.times_file.close()
+        self.pixel_counts_file.close()
+
+
+class EventStore(object):
+    """
+    Random access reader for packed event stores, over all the shards of one or more stores
+
+    The arrays are memory mapped read-only when first used and events are returned as views into them, so nothing is
+    unpickled or copied. Only the paths are pickled, so the reader can be handed to DataLoader or Keras
+    multiprocessing workers, which map the same files again and share their pages through the page cache instead
+    of each holding a copy
+    """
+
+    def __init__(self, paths):
+        """
+        :param paths: Path or list of paths, each either a shard or a directory of shards
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self.shards = []
+        for path in paths:
+            if os.path.isfile(os.path.join(path, METADATA_FILE)):
+                self.shards.append(path)
+            else:
+                for shard in sorted(os.listdir(path)):
+                    if os.path.isfile(os.path.join(path, shard, METADATA_FILE)):
+                        self.shards.append(os.path.join(path, shard))
+        self.metadata = []
+        for shard in self.shards:
+            with open(os.path.join(shard, METADATA_FILE)) as metadata_file:
+                self.metadata.append(json.load(metadata_file))
+        self.event_offsets = np.cumsum(
+            [0] + [metadata["num_events"] for metadata in self.metadata]
+        )
+        self.column_names = sorted(
+            set(name for metadata in self.metadata for name in metadata["columns"])
+        )
+        self.feature_names = sorted(
+            set(name for metadata in self.metadata for name in metadata["features"])
+        )
+        self.arrays = {}
+        self.name_index = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["arrays"] = {}
+        state["name_index"] = None
+        return state
+
+    def __len__(self):
+        return int(self.event_offsets[-1])
+
+    def array(self, shard, name, dtype=None, shape=None):
+        """
+        Memory maps one array of a shard, once
+        :param shard: Index of the shard
+        :param name: File name of the array in the shard
+        :param dtype: dtype of raw .bin files, .npy files are loaded with their own
+        :param shape: shape of raw .bin files
+        :return: Read-only memory mapped array
+        """
+        key = (shard, name)
+        if key not in self.arrays:
+            path = os.path.join(self.shards[shard], name)
+            if name.endswith(".npy"):
+                # Files written after the last metadata flush can be longer than the shard
+                num_events = self.metadata[shard]["num_events"]
+                if name == "photon_offsets.npy":
+                    num_events += 1
+                self.arrays[key] = np.load(path, mmap_mode="r")[:num_events]
+            elif np.prod(shape) == 0:
+                self.arrays[key] = np.zeros(shape, dtype=dtype)
+            else:
+                self.arrays[key] = np.memmap(path, dtype=dtype, mode="r", shape=shape)
+        return self.arrays[key]
+
+    def locate(self, index):
+        """
+        Finds the shard of an event
+        :param index: Index of the event in the store, or its name
+        :return: (shard, index of the event in the shard)
+        """
+        if isinstance(index, str):
+            index = self.index(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Event index " + str(index) + " out of range")
+        shard = int(np.searchsorted(self.event_offsets, index, side="right")) - 1
+        return shard, int(index - self.event_offsets[shard])
+
+    def index(self, name):
+        """
+        :param name: Name of the event
+        :return: Index of the event in the store
+        """
+        if self.name_index is None:
+            self.name_index = {
+                str(event_name): index for index, event_name in enumerate(self.names)
+            }
+        return self.name_index[name]
+
+    @property
+    def names(self):
+        return np.concatenate(
+            [self.array(shard, "names.npy") for shard in range(len(self.shards))]
+        )
+
+    def photon_offsets(self, shard):
+        return self.array(shard, "photon_offsets.npy")
+
+    def data_format(self, shard):
+        return dict(self.metadata[shard]["data_format"])
+
+    def pixel_counts(self, shard):
+        return self.array(
+            shard,
+            PIXEL_COUNTS_FILE,
+            dtype=np.uint16,
+            shape=(self.metadata[shard]["num_events"], NUMBER_OF_PIXELS),
+        )
+
+    def times(self, shard):
+        return self.array(
+            shard,
+            TIMES_FILE,
+            dtype=np.uint8,
+            shape=(self.metadata[shard]["num_photons"],),
+        )
+
+    def column(self, name, prefix="columns"):
+        """
+        Gets one column over all events, missing values are NaN
+        :param name: Name of the column, i.e. Energy
+        :param prefix: "columns" for the data_format values, "features" for the Hillas features
+        :return: Array of the column values
+        """
+        values = []
+        for shard, metadata in enumerate(self.metadata):
+            if name in metadata[prefix]:
+                values.append(self.array(shard, os.path.join(prefix, name + ".npy")))
+            else:
+                values.append(np.full(metadata["num_events"], np.nan))
+        return np.concatenate(values)
+
+    def feature(self, name):
+        return self.column(name, prefix="features")
+
+    def pixel_counts_of(self, index):
+        """
+        :param index: Index of the event in the store, or its name
+        :return: View of the number of photons in each CHID of the event
+        """
+        shard, local_index = self.locate(index)
+        return self.pixel_counts(shard)[local_index]
+
+    def photon_times(self, index):
+        """
+        :param index: Index of the event in the store, or its name
+        :return: View of the arrival time slices of the photons of the event, in CHID order
+        """
+        shard, local_index = self.locate(index)
+        offsets = self.photon_offsets(shard)
+        return self.times(shard)[offsets[local_index] : offsets[local_index + 1]]
+
+    def photon_chids(self, index):
+        """
+        :param index: Index of the event in the store, or its name
+        :return: CHID of each photon of the event, matching photon_times
+        """
+        return np.repeat(
+            np.arange(NUMBER_OF_PIXELS, dtype=np.int16), self.pixel_counts_of(index)
+        )
+
+    def point_cloud(self, index):
+        """
+        Same point cloud as photon_stream's raw_phs_to_point_cloud, without going through the list of lists
+
+        :param index: Index of the event in the store, or its name
+        :return: (number of photons, 3) array of the x and y angle of the CHID and the arrival time in seconds
+        """
+        return arrays_to_point_cloud(self.photon_chids(index), self.photon_times(index))
+
+    def photons(self, index):
+        """
+        :param index: Index of the event in the store, or its name
+        :return: Photon stream list of lists representation of the event
+        """
+        times = self.photon_times(index)
+        pixel_counts = self.pixel_counts_of(index)
+        return [
+            pixel.tolist()
+            for pixel in np.split(times, np.cumsum(pixel_counts[:-1], dtype=np.int64))
+        ]
+
+    def event(self, index, as_arrays=False):
+        """
+        Reads one event in the layout of the pickled event files
+
+        :param index: Index of the event in the store, or its name
+        :param as_arrays: Whether the photons are the (photon_chids, photon_times) arrays instead of the list of lists,
+        which the rebinning takes directly
+        :return: [data, data_format, features, cluster], with cluster always None
+        """
+        shard, local_index = self.locate(index)
+        metadata = self.metadata[shard]
+        data_format = self.data_format(shard)
+        data = [None] * (max(data_format.values()) + 1)
+        if as_arrays:
+            data[data_format["Image"]] = (
+                self.photon_chids(index),
+                self.photon_times(index),
+            )
+        else:
+            data[data_format["Image"]] = self.photons(index)
+        for name in metadata["columns"]:
+            value = self.array(shard, os.path.join("columns", name + ".npy"))[
+                local_index
+            ]
+            data[data_format[name]] = value.item() if value.ndim == 0 else value
+        features = {}
+        for name in metadata["features"]:
+            value = self.array(shard, os.path.join("features", name + ".npy"))[
+                local_index
+            ]
+            features[name] = value.item()
+        return [data, data_format, features, None]
@@ -1,11 +1,28 @@
 import h5py
+import numpy as np
 
+# Size of the chunks of the datasets, so random batches read a few large chunks instead of many small ones
+CHUNK_BYTES = 1024 ** 2
 
-def create_dataset(preprocessor, output_file="output.hdf5"):
+
+def chunk_shape(shape, dtype, chunk_bytes=CHUNK_BYTES):
+    """
+    Chunks of whole events, as many as fit in chunk_bytes, so a chunk is read with one contiguous read
+    :param shape: Shape of the dataset, events along the first axis
+    :param dtype: dtype of the dataset
+    :param chunk_bytes: Size of the chunks in bytes
+    :return: Chunk shape, the number of events of a chunk followed by the other axes of the dataset
+    """
+    event_bytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    return (max(1, chunk_bytes // max(event_bytes, 1)),) + tuple(shape[1:])
+
+
+def create_dataset(preprocessor, output_file="output.hdf5", chunk_bytes=CHUNK_BYTES):
     """
     Create an HDF5 dataset from a preprocessor's output
     :param preprocessor: The preprocessor to use, outputs data, data_format on each call of next
     :param output_file: Name of the output file
+    :param chunk_bytes: Size of the chunks of each dataset in bytes, see chunk_shape
     :return:
     """
     gen = preprocessor.batch_processor()
@@ -17,23 +34,27 @@ def create_dataset(preprocessor, output_file="output.hdf5"):
     with h5py.File(output_file, "w") as hdf:
         # Now go through each key in data_format, create the dataset
         dset_sets = [None for i in formatted_batch]
-        for key, value in data_format:
+        for key, value in data_format.items():
             maxshape = (None,) + formatted_batch[value].shape[1:]
             dset = hdf.create_dataset(
                 key,
-                shape=formatted_batch[key].shape,
+                shape=formatted_batch[value].shape,
                 maxshape=maxshape,
-                chunks=formatted_batch[key].shape,
-                dtype=formatted_batch[key].dtype,
+                chunks=chunk_shape(
+                    formatted_batch[value].shape,
+                    formatted_batch[value].dtype,
+                    chunk_bytes,
+                ),
+                dtype=formatted_batch[value].dtype,
             )
             dset_sets[value] = dset
-            dset_sets[value][:] = formatted_batch[key]
+            dset_sets[value][:] = formatted_batch[value]
 
         for batch in gen:
             batch, data_format = batch
             formatted_batch = preprocessor.format(batch)
 
-            shape = formatted_batch[1].shape[0]
+            shape = formatted_batch[data_format["Image"]].shape[0]
             for index, dset in enumerate(dset_sets):
                 dset.resize(row_count + shape, axis=0)
                 dset[row_count:] = formatted_batch[index]
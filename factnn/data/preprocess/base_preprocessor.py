@@ -1,11 +1,191 @@
 import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
 import fact
 from fact.instrument import get_pixel_coords
 from fact.instrument.constants import PIXEL_SPACING_MM
 from sklearn.cluster import DBSCAN
-import pickle
+import gzip
+import itertools
 import os
-import pkg_resources as res
+import pickle
+import struct
+import tempfile
+import warnings
+import zipfile
+import zlib
+
+from factnn.data.dataset.event_store import EventStore, EventStoreWriter
+from factnn.data.preprocess.clustering import (
+    CLUSTERING_BACKENDS,
+    SklearnDBSCAN,
+    scale_point_cloud,
+)
+from factnn.utils.phs import (
+    photon_arrays,
+    raw_to_arrays,
+    arrays_to_raw,
+    arrays_to_point_cloud,
+)
+
+REBINNING_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "resources",
+    "rebinning.npz",
+)
+# Grid sizes shipped in REBINNING_FILE, other sizes are generated and cached on first use
+SHIPPED_REBIN_SIZES = (5, 10, 20, 25, 40, 50, 64, 75, 100)
+_rebinning_tables = None
+_pixel_tree = None
+
+
+def memmap_npz(path):
+    """
+    Memory maps the arrays of an uncompressed .npz file, so they load without reading the file and forked workers
+    share the same pages
+
+    :param path: Path to a .npz file written with np.savez
+    :return: Dictionary of read-only np.memmap arrays by name
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as npz_file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(info.filename + " is compressed, cannot memory map it")
+            # Local file header is 30 bytes followed by the file name and the extra field
+            npz_file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", npz_file.read(4))
+            npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+            if np.lib.format.read_magic(npz_file) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(
+                    npz_file
+                )
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(
+                    npz_file
+                )
+            arrays[info.filename[: -len(".npy")]] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=npz_file.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def load_rebinning_tables():
+    """
+    Memory maps the shipped rebinning tables once per process
+
+    The tables are CSR over the CHIDs for every shipped grid size: for sizes[i], the entries of the CHID c are
+    offsets[i] + indptr[i, c] up to offsets[i] + indptr[i, c + 1] in grid_index and weight
+
+    :return: Dictionary with the sizes, offsets, indptr, grid_index and weight arrays
+    """
+    global _rebinning_tables
+    if _rebinning_tables is None:
+        _rebinning_tables = memmap_npz(REBINNING_FILE)
+    return _rebinning_tables
+
+
+def memmap_rebinning(path):
+    """
+    Memory maps a rebinning operator written uncompressed by scipy.sparse.save_npz, so forked workers share its pages
+
+    :param path: Path to the .npz file of a csc_matrix
+    :return: scipy.sparse.csc_matrix backed by read-only np.memmap arrays
+    """
+    arrays = memmap_npz(path)
+    if arrays["format"][()] != b"csc":
+        raise ValueError(path + " is not a csc_matrix")
+    return sp.csc_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]),
+        shape=tuple(arrays["shape"]),
+        copy=False,
+    )
+
+
+def pixel_chids(point_cloud):
+    """
+    Finds the CHID of the pixel each photon of a point cloud is on, for point clouds without their CHIDs
+
+    The pixel positions are loaded and put in a KD tree once per process
+
+    :param point_cloud: Point cloud of an event, x and y angle in radians in the first two columns
+    :return: CHID of each photon, -1 for photons not on the position of any pixel
+    """
+    global _pixel_tree
+    if _pixel_tree is None:
+        pixels = fact.instrument.get_pixel_dataframe()
+        pixels.sort_values("CHID", inplace=True)
+        _pixel_tree = cKDTree(
+            np.column_stack(
+                (np.deg2rad(pixels.x_angle.values), np.deg2rad(pixels.y_angle.values))
+            )
+        )
+    positions = np.asarray(point_cloud)[:, :2]
+    _, chids = _pixel_tree.query(positions)
+    on_pixel = np.isclose(positions, _pixel_tree.data[chids]).all(axis=1)
+    return np.where(on_pixel, chids, -1)
+
+
+def range_file_name(path, first):
+    """
+    Name of the uncompressed file of the range of events of a photon stream file starting at first, as written by
+    factnn.utils.io.split_event_ranges
+    :param path: Path of the .phs.jsonl.gz file
+    :param first: First event counter of the range, counting from 1
+    :return: File name, unique for the path
+    """
+    return "{:08x}_{}_{}.phs.jsonl".format(
+        zlib.crc32(os.path.abspath(path).encode()),
+        os.path.basename(path).split(".phs")[0],
+        first,
+    )
+
+
+def events_in_range(open_reader, path, event_range=None, range_directory=None):
+    """
+    Iterates over the events of a photon stream file with their counters, counting from 1
+
+    With an event_range, the events are read from the uncompressed file of the range in range_directory when there is
+    one, which convert_events splits out of each file in a single pass. Otherwise the lines of the events before the
+    range are decompressed and skipped, not parsed, and the lines of the range are copied uncompressed to a temporary
+    file the reader is opened on. That decompresses the file from its start for every range, so without a
+    range_directory a file should only be split into a few ranges
+
+    :param open_reader: Function opening a photon stream reader on a path, such as ps.EventListReader
+    :param path: Path of the .phs.jsonl.gz file
+    :param event_range: (first, stop) of the event counters to read, counting from 1, or None for all of them
+    :param range_directory: Directory of the files of the ranges split out of the photon stream files, or None
+    :return: Generator of (counter, event)
+    """
+    if event_range is None:
+        yield from enumerate(open_reader(path), start=1)
+        return
+    if range_directory is not None:
+        range_path = os.path.join(
+            range_directory, range_file_name(path, event_range[0])
+        )
+        if os.path.isfile(range_path):
+            yield from enumerate(
+                itertools.islice(
+                    open_reader(range_path), event_range[1] - event_range[0]
+                ),
+                start=event_range[0],
+            )
+            return
+    with tempfile.TemporaryDirectory() as directory:
+        range_path = os.path.join(
+            directory, os.path.basename(path).split(".phs")[0] + ".phs.jsonl"
+        )
+        with gzip.open(path, "rb") as phs_file, open(range_path, "wb") as range_file:
+            range_file.writelines(
+                itertools.islice(phs_file, event_range[0] - 1, event_range[1] - 1)
+            )
+        yield from enumerate(open_reader(range_path), start=event_range[0])
 
 
 class BasePreprocessor(object):
@@ -29,22 +209,21 @@ class BasePreprocessor(object):
             self.dl2_file = None
 
         if "rebin_size" in config:
-            if config["rebin_size"] <= 300:
-                try:
-                    with open(
-                        res.resource_filename(
-                            "factnn.data.resources",
-                            "rebinning_" + str(config["rebin_size"]) + ".p",
-                        ),
-                        "rb",
-                    ) as rebinning_file:
-                        self.rebinning = pickle.load(rebinning_file)
-                except Exception as e:
-                    self.rebinning = self.generate_rebinning(config["rebin_size"])
-            else:
-                self.rebinning = self.generate_rebinning(config["rebin_size"])
+            self.rebin_size = config["rebin_size"]
         else:
-            self.rebinning = self.generate_rebinning(50)
+            self.rebin_size = 50
+
+        if "rebinning_cache" in config:
+            self.rebinning_cache = config["rebinning_cache"]
+        else:
+            self.rebinning_cache = os.path.join(
+                os.path.expanduser("~"), ".cache", "factnn"
+            )
+
+        # Sparse (rebin_size**2, 1440) operator, so rebinning an event is one sparse-dense matmul
+        self.rebinning = self.shipped_rebinning(self.rebin_size)
+        if self.rebinning is None:
+            self.rebinning = self.cached_rebinning(self.rebin_size)
 
         if "gaussian" in config:
             if config["gaussian"]:
@@ -60,8 +239,8 @@ class BasePreprocessor(object):
 
         self.shape = [
             -1,
-            config["rebin_size"],
-            config["rebin_size"],
+            self.rebin_size,
+            self.rebin_size,
             self.end - self.start,
         ]
 
@@ -73,6 +252,26 @@ class BasePreprocessor(object):
 
         self.num_events = -1
 
+        # Packed event store to read events from instead of the pickled event files
+        if "event_store" in config:
+            self.event_store = EventStore(config["event_store"])
+        else:
+            self.event_store = None
+        # Name of the shard event_processor writes to in each output directory when packed
+        if "event_shard" in config:
+            self.event_shard = config["event_shard"]
+        else:
+            self.event_shard = "events"
+        self.event_writers = {}
+        # Directory of the ranges convert_events split out of the photon stream files, for events_in_range
+        self.range_directory = None
+
+        # Clustering backend of clean_image, see factnn.data.preprocess.clustering
+        if "clustering" in config:
+            self.clustering = CLUSTERING_BACKENDS[config["clustering"]]()
+        else:
+            self.clustering = SklearnDBSCAN()
+
         if "as_channels" in config:
             self.as_channels = config["as_channels"]
         else:
@@ -124,88 +323,270 @@ class BasePreprocessor(object):
         return pixel_fractions
 
     def generate_rebinning(self, size):
+        """
+        Computes the overlap of every camera pixel hexagon with the squares of a size x size grid
 
-        from shapely.geometry import Point, Polygon, MultiPoint
-        from shapely.affinity import translate
-
-        p = Point(0.0, 0.0)
-        PIXEL_EDGE = 9.51 / np.sqrt(3)
-        # Top one
-        p1 = Point(0.0, PIXEL_EDGE)
-        # Bottom one
-        p2 = Point(0.0, -PIXEL_EDGE)
-        # Bottom right
-        p3 = Point(-PIXEL_EDGE * (np.sqrt(3) / 2), -PIXEL_EDGE * 0.5)
-        # Bottom left
-        p4 = Point(PIXEL_EDGE * (np.sqrt(3) / 2), PIXEL_EDGE * 0.5)
-        # right
-        p5 = Point(PIXEL_EDGE * (np.sqrt(3) / 2), -PIXEL_EDGE * 0.5)
-        #  left
-        p6 = Point(-PIXEL_EDGE * (np.sqrt(3) / 2), PIXEL_EDGE * 0.5)
-
-        hexagon = MultiPoint([p1, p2, p3, p4, p5, p6]).convex_hull
-
-        square_start = 186
+        The hexagon-square overlap is integrated analytically: along x the height of the intersection is piecewise
+        linear, so the trapezoid rule over its breakpoints is exact. Only the squares inside the bounding box of a
+        hexagon are checked, which the regular grid gives directly without a spatial index
 
-        steps = size  # Now size of 100 should make a 100x100 grid
+        Fractions, CHID order and grid indices are the same as the shapely sweep this replaced, which built the
+        pickled tables that used to be shipped in factnn/data/resources
 
-        square_size = np.abs(
-            square_start * 2 / steps
-        )  # Now this is the size of the grid
+        :param size: Size of one side of square grid, i.e. 100 => 100x100
+        :return: scipy.sparse.csc_matrix of shape (size*size, 1440), shipped in float32 by shipped_rebinning for the
+            common sizes and cached by cached_rebinning for the others
+        """
+        pixel_edge = 9.51 / np.sqrt(3)
+        half_width = pixel_edge * np.sqrt(3) / 2
+        hexagon_area = 3 * np.sqrt(3) / 2 * pixel_edge**2
+        square_start = 186
+        square_size = np.abs(square_start * 2 / size)
 
-        square = Polygon(
+        x, y = get_pixel_coords()
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+
+        # Range of grid steps inside the bounding box of each hexagon, x steps go right and y steps go down
+        first_x = np.floor((x - half_width + square_start) / square_size).astype(int)
+        last_x = np.floor((x + half_width + square_start) / square_size).astype(int)
+        first_y = np.floor((square_start - y - pixel_edge) / square_size).astype(int)
+        last_y = np.floor((square_start - y + pixel_edge) / square_size).astype(int)
+        offset_x, offset_y = np.meshgrid(
+            np.arange(np.max(last_x - first_x) + 1),
+            np.arange(np.max(last_y - first_y) + 1),
+            indexing="ij",
+        )
+        chid = np.repeat(np.arange(1440), offset_x.size)
+        x_step = (first_x[:, None] + offset_x.ravel()).ravel()
+        y_step = (first_y[:, None] + offset_y.ravel()).ravel()
+        inside = (
+            (x_step <= last_x[chid])
+            & (y_step <= last_y[chid])
+            & (x_step >= 0)
+            & (x_step < size)
+            & (y_step >= 0)
+            & (y_step < size)
+        )
+        chid = chid[inside]
+        x_step = x_step[inside]
+        y_step = y_step[inside]
+
+        # Square edges relative to the hexagon center
+        left = -square_start + x_step * square_size - x[chid]
+        right = left + square_size
+        top = square_start - y_step * square_size - y[chid]
+        bottom = top - square_size
+
+        # Hexagon spans |v| <= pixel_edge - |u| / sqrt(3), breakpoints are where that crosses a square edge
+        left = np.maximum(left, -half_width)
+        right = np.minimum(right, half_width)
+        crossings = np.sqrt(3) * (pixel_edge - np.abs(np.stack([top, bottom], axis=1)))
+        breakpoints = np.concatenate(
             [
-                (-square_start, square_start),
-                (-square_start + square_size, square_start),
-                (-square_start + square_size, square_start - square_size),
-                (-square_start, square_start - square_size),
-                (-square_start, square_start),
-            ]
+                left[:, None],
+                right[:, None],
+                np.zeros((len(chid), 1)),
+                crossings,
+                -crossings,
+            ],
+            axis=1,
+        )
+        breakpoints = np.sort(
+            np.clip(breakpoints, left[:, None], right[:, None]), axis=1
+        )
+        height = pixel_edge - np.abs(breakpoints) / np.sqrt(3)
+        length = np.maximum(
+            0.0,
+            np.minimum(top[:, None], height) - np.maximum(bottom[:, None], -height),
+        )
+        area = np.sum(
+            np.diff(breakpoints, axis=1) * (length[:, 1:] + length[:, :-1]) / 2, axis=1
+        )
+        fraction = area / hexagon_area
+
+        # Index into the old list of squares, which started with a duplicate of square (0, 0)
+        pixel_index = x_step * size + y_step + 1
+        first_square = (x_step == 0) & (y_step == 0)
+        pixel_index = np.concatenate([pixel_index, np.zeros(np.sum(first_square), int)])
+        chid = np.concatenate([chid, chid[first_square]])
+        fraction = np.concatenate([fraction, fraction[first_square]])
+
+        # Squares past the end of the grid and close to zero overlaps were never added
+        keep = (pixel_index < size * size) & ~np.isclose(fraction, 0.0)
+        pixel_index = pixel_index[keep]
+        rows = (pixel_index % size) * size + pixel_index // size
+        return sp.csc_matrix(
+            (fraction[keep], (rows, 1439 - chid[keep])),
+            shape=(size * size, 1440),
+            dtype=np.float64,
         )
 
-        list_of_squares = [square]
+    def cached_rebinning(self, size):
+        """
+        Memory maps the rebinning operator for a grid size from the on-disk cache, generating and caching it the first
+        time a size is used
 
-        pixel_index_to_grid = {}
-        pix_index = 0
-        # Generate tessellation of grid
-        for x_step in range(steps):
-            for y_step in range(steps):
-                new_square = translate(
-                    square, xoff=x_step * square_size, yoff=-square_size * y_step
+        :param size: Size of one side of square grid, i.e. 100 => 100x100
+        :return: scipy.sparse.csc_matrix of shape (size*size, 1440)
+        """
+        cache_file = os.path.join(
+            self.rebinning_cache, "rebinning_" + str(size) + ".npz"
+        )
+        if os.path.isfile(cache_file):
+            try:
+                return memmap_rebinning(cache_file)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                warnings.warn(
+                    "Could not load cached rebinning "
+                    + cache_file
+                    + ", generating it again: "
+                    + str(e)
                 )
-                pixel_index_to_grid[pix_index] = [x_step, y_step]
-                pix_index += 1
-                list_of_squares.append(new_square)
+        rebinning = self.generate_rebinning(size)
+        try:
+            os.makedirs(self.rebinning_cache, exist_ok=True)
+            # Written under a temporary name first, so other workers never load a partial file
+            temp_file = os.path.join(
+                self.rebinning_cache,
+                "rebinning_" + str(size) + "." + str(os.getpid()) + ".npz",
+            )
+            sp.save_npz(temp_file, rebinning, compressed=False)
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            warnings.warn("Could not cache rebinning: " + str(e))
+        return rebinning
 
-        x, y = get_pixel_coords()
-        list_hexagons = []
-        for index, x_coor in enumerate(x):
-            list_hexagons.append(translate(hexagon, x_coor, y[index]))
-        list_pixels_and_fractions = {}
-        for i in range(len(list_of_squares)):
-            list_pixels_and_fractions[i] = []
-
-        chid_to_pixel = {}
-        for i in range(1440):
-            chid_to_pixel[i] = []
-
-        for pixel_index, pixel in enumerate(list_of_squares):
-            for chid, hexagon in enumerate(list_hexagons):
-                # Do the dirty work, hexagons should be in CHID order because translate in that order and append
-                if pixel.intersects(hexagon):
-                    intersection = pixel.intersection(hexagon)
-                    fraction_whole = intersection.area / hexagon.area
-                    if not np.isclose(fraction_whole, 0.0):
-                        # so not close to zero overlap, add to list for that pixel
-                        list_pixels_and_fractions[np.abs(pixel_index)].append(
-                            (chid, fraction_whole)
-                        )
-                        chid_to_pixel[np.abs(1439 - chid)].append(
-                            (pixel_index, fraction_whole)
-                        )
-
-        hex_to_grid = [chid_to_pixel, pixel_index_to_grid]
-        return hex_to_grid
+    def shipped_rebinning(self, size):
+        """
+        Gets the rebinning operator for a grid size from the shipped tables, without copying it out of the memory map
+
+        :param size: Size of one side of square grid, i.e. 100 => 100x100
+        :return: scipy.sparse.csc_matrix of shape (size*size, 1440), or None if no table is shipped for that size
+        """
+        if not os.path.isfile(REBINNING_FILE):
+            return None
+        tables = load_rebinning_tables()
+        index = np.searchsorted(tables["sizes"], size)
+        if index == len(tables["sizes"]) or tables["sizes"][index] != size:
+            return None
+        first = tables["offsets"][index]
+        last = tables["offsets"][index + 1]
+        return sp.csc_matrix(
+            (
+                tables["weight"][first:last],
+                tables["grid_index"][first:last],
+                tables["indptr"][index],
+            ),
+            shape=(size * size, 1440),
+            copy=False,
+        )
+
+    def write_rebinning_tables(self, path=REBINNING_FILE, sizes=SHIPPED_REBIN_SIZES):
+        """
+        Writes the tables shipped_rebinning reads, generated with generate_rebinning, with float32 weights to keep the
+        shipped file small
+
+        :param path: Path of the uncompressed .npz file
+        :param sizes: Grid sizes to write the tables of
+        :return:
+        """
+        sizes = np.sort(np.asarray(sizes, dtype=np.int64))
+        rebinnings = []
+        for size in sizes:
+            rebinning = self.generate_rebinning(int(size))
+            rebinning.sum_duplicates()
+            rebinning.sort_indices()
+            rebinnings.append(rebinning)
+        np.savez(
+            path,
+            sizes=sizes,
+            offsets=np.cumsum([0] + [rebinning.nnz for rebinning in rebinnings]),
+            indptr=np.stack([rebinning.indptr for rebinning in rebinnings]).astype(
+                np.int32
+            ),
+            grid_index=np.concatenate(
+                [rebinning.indices for rebinning in rebinnings]
+            ).astype(np.int32),
+            weight=np.concatenate([rebinning.data for rebinning in rebinnings]).astype(
+                np.float32
+            ),
+        )
+
+    def time_slice_indices(
+        self, times, start, end, num_slices, clip_end=False, equal_slices=False
+    ):
+        """
+        Maps photon arrival times to the index of the time slice of the image they are added to
+
+        :param times: Arrival time slices of the photons
+        :param start: First time slice used, either a scalar or one value per photon
+        :param end: Time slice to stop before, either a scalar or one value per photon
+        :param num_slices: Number of time slices in the image
+        :param clip_end: Whether photons past the last slice are summed into the last slice instead of dropped
+        :param equal_slices: Whether to sum equal sized groups of time slices into each slice, as in on_files_processor
+        :return: (indices, mask) where mask selects the photons that end up in the image
+        """
+        times = np.asarray(times, dtype=np.int64)
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        mask = (times >= start) & (times < end)
+        if equal_slices:
+            slice_size = np.ceil((end - start) / num_slices).astype(np.int64)
+            safe_size = np.maximum(slice_size, 1)
+            # First slice index where (index * slice_size) < time <= (index * slice_size) + start
+            indices = np.maximum(0, -((start - times) // safe_size))
+            mask &= (
+                (slice_size > 0)
+                & (indices < num_slices)
+                & (indices * slice_size < times)
+            )
+        else:
+            indices = times - start
+            if clip_end:
+                indices = np.minimum(indices, num_slices - 1)
+            else:
+                mask &= indices < num_slices
+        return indices, mask
+
+    def rebin_photons(
+        self,
+        photons,
+        start=None,
+        end=None,
+        clip_end=False,
+        equal_slices=False,
+        weight=1.0,
+    ):
+        """
+        Rebins one event onto the square grid, replaces the loop over the CHIDs, rebinning entries and photons
+
+        A (1440, time_slices) histogram of the photon arrival times is built with np.bincount and then multiplied with
+        the sparse rebinning operator
+
+        :param photons: Photon stream list of lists representation of the event, or its (chids, times) arrays
+        :param start: First time slice to use, defaults to self.start
+        :param end: Time slice to stop before, defaults to self.end
+        :param clip_end: Whether photons past the last slice are summed into the last slice instead of dropped
+        :param equal_slices: Whether to sum equal sized groups of time slices into each slice
+        :param weight: Value each photon adds to the image, scaled by the overlap fraction
+        :return: Image of shape (rebin_size, rebin_size, time_slices), in the same orientation as
+        np.fliplr(np.rot90(input_matrix, 3))
+        """
+        if start is None:
+            start = self.start
+        if end is None:
+            end = self.end
+        num_slices = self.shape[3]
+        chids, times = photon_arrays(photons)
+        indices, mask = self.time_slice_indices(
+            times, start, end, num_slices, clip_end=clip_end, equal_slices=equal_slices
+        )
+        histogram = np.bincount(
+            chids[mask] * num_slices + indices[mask], minlength=1440 * num_slices
+        ).reshape(1440, num_slices)
+        image = self.rebinning.dot(histogram * weight)
+        return image.reshape(self.rebin_size, self.rebin_size, num_slices)
 
     def batch_processor(self, clean_images=False):
         return NotImplemented
@@ -236,14 +617,82 @@ class BasePreprocessor(object):
         """
         return NotImplementedError
 
-    def event_processor(self, directory, clean_images=False):
+    def event_processor(
+        self,
+        directory,
+        clean_images=False,
+        packed=False,
+        event_range=None,
+        check_existing=True,
+    ):
         """
         Goes through each event in all the files specified in self.paths and returns each event individually, including the
         default photon-stream representation, and auxiliary data and saves it to a new file based on the
+
+        The simulation and observation event_processors also take a clump_size, or a list of clump sizes. A list
+        cleans each event for all of them in one pass with clean_image_sizes, so the neighbour search of the
+        clustering backend is shared between them
+
+        :param packed: Whether to append the events to a packed event store in each output directory, instead of
+        pickling each one to its own file
+        :param event_range: (first, stop) of the event counters to convert in each file, counting from 1, or None for
+        all of them. Used by factnn.utils.io.convert_events to split large files between processes. The simulation
+        preprocessors read the range with events_in_range, from its file in self.range_directory if it was split
+        out, the observation preprocessor counts only events in the DL2 file, so it still parses them. Errors are
+        raised instead of printed, so convert_events can tell a failed range from a converted one
+        :param check_existing: Whether to skip events whose event files already exist, which costs a stat per event.
+        convert_events keeps track of the converted events itself and turns this off
         :return:
         """
         return NotImplementedError
 
+    def is_converted(self, directory, name, clump_sizes):
+        """
+        Whether event_processor already wrote the clump and core event files of an event for every clump size
+
+        :param directory: Output directory of event_processor
+        :param name: <run>_<counter> name of the event
+        :param clump_sizes: Clump sizes the event is cleaned with
+        :return:
+        """
+        return all(
+            os.path.isfile(os.path.join(directory, "clump" + str(clump_size), name))
+            and os.path.isfile(os.path.join(directory, "core" + str(clump_size), name))
+            for clump_size in clump_sizes
+        )
+
+    def save_event(self, path, data_dict, packed=False):
+        """
+        Saves one event from event_processor
+
+        :param path: Path of the event file, directory and <run>_<counter> name
+        :param data_dict: [data, data_format, features, cluster] of the event, features and cluster are optional
+        :param packed: Whether to append the event to the self.event_shard shard of the packed event store in the
+        directory of path instead of pickling it to path. Events already in the shard are skipped
+        :return:
+        """
+        if packed:
+            directory, name = os.path.split(path)
+            if directory not in self.event_writers:
+                self.event_writers[directory] = EventStoreWriter(
+                    os.path.join(directory, self.event_shard)
+                )
+            writer = self.event_writers[directory]
+            if name not in writer:
+                writer.append(name, *data_dict)
+        else:
+            with open(path, "wb") as event_file:
+                pickle.dump(data_dict, event_file)
+
+    def close_event_stores(self):
+        """
+        Flushes and closes the event store shards written by save_event
+        :return:
+        """
+        for writer in self.event_writers.values():
+            writer.close()
+        self.event_writers = {}
+
     def count_events(self):
         """
         Ideally to count the number of events in the files for the streaming data
@@ -378,9 +827,11 @@ class BasePreprocessor(object):
 
         return NotImplementedError
 
-    def select_clustered_photons(self, dbscan, point_cloud, debug=True, only_core=True):
+    def select_clustered_photons(
+        self, dbscan, point_cloud, debug=True, only_core=True, chids=None
+    ):
         """
-        Take DBSCAN output on the point cloud and translate it back to a list of lists of photons
+        Take DBSCAN output on the point cloud and translate it back to a raw photon stream
 
         Useful for using the clustering to reduce the noise in the image stacks later, image cleaning
 
@@ -392,89 +843,36 @@ class BasePreprocessor(object):
         and we can test discarding them to clean the image further, so only dbscan.core_sample_indicies_ is
         needed really
 
-        Raw to point cloud is given below where cx and cy are the geometry of the image, but not needed here
-
-        def raw_phs_to_point_cloud(raw_phs, cx, cy):
-            number_photons = len(raw_phs) - NUMBER_OF_PIXELS
-            cloud = np.zeros(shape=(number_photons, 3))
-            pixel_chid = 0
-            p = 0
-            for s in raw_phs:
-                if s == io.binary.LINEBREAK:
-                    pixel_chid += 1
-                else:
-                    cloud[p, 0] = cx[pixel_chid]
-                    cloud[p, 1] = cy[pixel_chid]
-                    cloud[p, 2] = s*TIME_SLICE_DURATION_S
-                    p += 1
-            return cloud
-
-               # Now have each index into the point cloud, so start backwards, include all those not with -1
-                    current_photon = point_cloud[idx]
-                    for index in range(1440):
-                        if np.isclose(current_photon[0], x_angle[index]) and np.isclose(current_photon[1], y_angle[index]):
-                            time_slice = int(np.round(current_photon[2] / TIME_SLICE_DURATION_S))
-                            list_of_slices.append(time_slice)
-                            # Now add to new_raw
-                            new_list_of_list[index].append(time_slice)
-        # Convert back to raw
-
-        :param dbscan:
-        :param raw_photons:
+        :param dbscan: DBSCAN fitted on the point cloud
+        :param point_cloud: Point cloud of the event, one photon per row
+        :param debug: Whether to print statistics of the kept photons
+        :param only_core: Whether to only keep the core samples, otherwise all photons in a cluster are kept
+        :param chids: CHID of each photon of the point cloud, as from raw_to_arrays. If None, the CHIDs are found
+        from the pixel closest to each photon
         :return: New raw photon event, or None if no clumps are found
         """
         TIME_SLICE_DURATION_S = 0.5e-9  # Taken from FACT magic constants
 
-        core_sample = dbscan.core_sample_indices_
         labels = dbscan.labels_
-        number = len(set(dbscan.labels_)) - (1 if -1 in dbscan.labels_ else 0)
-        # Now go backwards through the raw photons and gather those ones in a new raw photon format
-        # That format will be passed to raw_photons_to_list_of_lists to create a new list_of_lists repr
-
-        pixels = fact.instrument.get_pixel_dataframe()
-        pixels.sort_values("CHID", inplace=True)
-
-        x_angle = np.deg2rad(pixels.x_angle.values)
-        y_angle = np.deg2rad(pixels.y_angle.values)
-        new_list_of_list = [[] for _ in range(1440)]
-        list_of_slices = []
-        if only_core:
-            used_labels = core_sample
-        else:
-            used_labels = labels
-        for idx, element in enumerate(used_labels):
-            # Now have each index into the point cloud, so start backwards
-            if element >= 0:
-                if only_core:
-                    current_photon = point_cloud[element]
-                else:
-                    current_photon = point_cloud[idx]
-                for index in range(1440):
-                    if np.isclose(current_photon[0], x_angle[index]) and np.isclose(
-                        current_photon[1], y_angle[index]
-                    ):
-                        time_slice = int(
-                            np.round(current_photon[2] / TIME_SLICE_DURATION_S)
-                        )
-                        list_of_slices.append(time_slice)
-                        # Now add to new_raw
-                        new_list_of_list[index].append(time_slice)
-        # Convert back to raw
-        new_raw = []
-        for sublist in new_list_of_list:
-            # Go through each sublist in order, adding 255 for each one
-            if not sublist:
-                new_raw.append(255)
-                # List is empty
-            else:
-                # Go through sublist, adding its stuff to it
-                for item in sublist:
-                    new_raw.append(item)
-                # Done with sublist, so add end one
-                new_raw.append(255)
+        number = len(set(labels)) - (1 if -1 in labels else 0)
         if number == 0:
             # No clumps, so returns None
             return None
+
+        point_cloud = np.asarray(point_cloud)
+        if chids is None:
+            chids = pixel_chids(point_cloud)
+        if only_core:
+            selected = np.zeros(len(point_cloud), dtype=bool)
+            selected[dbscan.core_sample_indices_] = True
+        else:
+            selected = labels >= 0
+        # Photons that are not on any pixel have a CHID of -1 and are dropped
+        selected &= chids >= 0
+        list_of_slices = np.round(
+            point_cloud[selected, 2] / TIME_SLICE_DURATION_S
+        ).astype(np.int64)
+        new_raw = arrays_to_raw(chids[selected], list_of_slices)
         if debug:
             print(
                 "Start: {}, End: {}, Mean: {}, Std: {} Clumps: {} Photons Before: {} Photons Saved: {}".format(
@@ -506,32 +904,43 @@ class BasePreprocessor(object):
         :return: The same Photon Stream Event with only photons in a cluster
         """
 
-        point_cloud = event.photon_stream.point_cloud
-
         if method == "dbscan":
-            dbscan = self.find_clumps(point_cloud, min_samples, eps)
-            core_photons = self.select_clustered_photons(
-                dbscan, point_cloud, only_core=True
-            )
-            clump_photons = self.select_clustered_photons(
-                dbscan, point_cloud, only_core=False
-            )
+            return self.clean_image_sizes(event, [min_samples], eps)[min_samples]
         elif method == "facttools":
-            dbscan = None
             return NotImplementedError
         else:
             raise NotImplementedError("Only dbscan or facttools implemented for now")
+
+    def clean_image_sizes(self, event, min_samples_list, eps=0.1):
+        """
+        Cleans the image with DBSCAN for several min_samples at once, with the clustering backend of the preprocessor
+
+        :param event: PhotonStream Event
+        :param min_samples_list: Min samples for DBSCAN, such as the clump sizes [5, 10, 15, 20]
+        :param eps: maximal distance between two samples to be considered same neighborhood
+        :return: Dictionary of (all_photons, clump_photons, core_photons, dbscan) by min_samples, as from clean_image
+        """
+        # CHIDs are kept next to the point cloud, so the clustered photons go back to the raw stream by index
+        chids, times = raw_to_arrays(event.photon_stream.raw)
+        point_cloud = arrays_to_point_cloud(chids, times)
         all_photons = event.photon_stream.raw
 
-        return all_photons, clump_photons, core_photons, dbscan
+        cleaned = {}
+        for min_samples, dbscan in zip(
+            min_samples_list,
+            self.clustering.fit_many(chids, times, min_samples_list, eps),
+        ):
+            core_photons = self.select_clustered_photons(
+                dbscan, point_cloud, only_core=True, chids=chids
+            )
+            clump_photons = self.select_clustered_photons(
+                dbscan, point_cloud, only_core=False, chids=chids
+            )
+            cleaned[min_samples] = (all_photons, clump_photons, core_photons, dbscan)
+        return cleaned
 
     def find_clumps(self, point_cloud, min_samples=20, eps=0.1):
-        deg_over_s = 0.35e9
-        xyt = point_cloud.copy()
-        xyt[:, 2] *= np.deg2rad(deg_over_s)
-
-        fov_radius = np.deg2rad(fact.instrument.camera.FOV_RADIUS)
-        abs_eps = eps * (2.0 * fov_radius)
+        xyt, abs_eps = scale_point_cloud(point_cloud, eps)
 
         dbscan = DBSCAN(eps=abs_eps, min_samples=min_samples).fit(xyt)
 
@@ -539,28 +948,21 @@ class BasePreprocessor(object):
 
     def dynamic_size(self, photon_stream):
         """
-        Takes a photon stream list of lists representation and finds the start and end of the photons in that and returns the indexes
+        Takes a photon stream list of lists representation, or its (chids, times) arrays, and finds the start and end of the photons in that and returns the indexes
 
         If the start and end is less than the number of slices wanted, then the extra is added to the end to ensure constant size
         :param photon_stream:
         :return: (start,end)
         """
 
-        length = len(sorted(photon_stream, key=len, reverse=True)[0])
-        arr = np.array([xi + [np.nan] * (length - len(xi)) for xi in photon_stream])
-        try:
-            start = int(np.nanmin(arr))
-            end = int(np.nanmax(arr))
-            mean = np.nanmean(arr)
-            std = np.nanstd(arr)
-        except Exception as e:
-            # Should only fail if no photons are present
-            # print("Failed")
-            # print(photon_stream)
-            # print(len(photon_stream))
-            start = self.start
-            end = self.end
+        _, times = photon_arrays(photon_stream)
+        if times.size == 0:
+            # No photons are present
             return -1, -1, -1, -1
+        start = int(np.min(times))
+        end = int(np.max(times))
+        mean = np.mean(times)
+        std = np.std(times)
 
         return (start, end, mean, std)
 
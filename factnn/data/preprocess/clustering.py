@@ -0,0 +1,309 @@
+import numpy as np
+import fact
+from photon_stream.geometry import GEOMETRY
+from photon_stream.io.magic_constants import NUMBER_OF_PIXELS, TIME_SLICE_DURATION_S
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from sklearn.cluster import DBSCAN
+
+from factnn.utils.phs import arrays_to_point_cloud
+
+# Same scaling of the arrival times as pyfact and photon_stream use for DBSCAN
+DEG_OVER_S = 0.35e9
+# Photon arrival times are stored as uint8 time slices
+NUMBER_OF_TIME_SLICES = 256
+
+
+def absolute_eps(eps=0.1):
+    """
+    :param eps: Maximal distance of two neighbours, as a fraction of the field of view diameter
+    :return: eps in radians
+    """
+    fov_radius = np.deg2rad(fact.instrument.camera.FOV_RADIUS)
+    return eps * (2.0 * fov_radius)
+
+
+def scale_point_cloud(point_cloud, eps=0.1):
+    """
+    Scales the time axis of a point cloud so that it can be clustered with one distance, like pyfact
+
+    :param point_cloud: Point cloud of an event, x and y angle in radians and arrival time in seconds
+    :param eps: Maximal distance of two neighbours, as a fraction of the field of view diameter
+    :return: (scaled point cloud, eps in the units of the scaled point cloud)
+    """
+    xyt = np.array(point_cloud, dtype=np.float64)
+    xyt[:, 2] *= np.deg2rad(DEG_OVER_S)
+    return xyt, absolute_eps(eps)
+
+
+def csr_indptr(rows, num_rows=NUMBER_OF_PIXELS):
+    """
+    :param rows: Sorted row of each entry
+    :param num_rows: Number of rows
+    :return: CSR indptr of the entries
+    """
+    return np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_rows))))
+
+
+def expand_csr(indptr, rows):
+    """
+    Lists the entries of some rows of a CSR table
+
+    :param indptr: CSR indptr of the table
+    :param rows: Rows to list the entries of
+    :return: (index into rows, entry) for every entry of the rows
+    """
+    lengths = indptr[rows + 1] - indptr[rows]
+    index = np.repeat(np.arange(len(rows)), lengths)
+    entry = np.arange(len(index)) - np.repeat(
+        np.cumsum(lengths) - lengths - indptr[rows], lengths
+    )
+    return index, entry
+
+
+class DBSCANResult(object):
+    """
+    Labels of a clustering, with the same attributes as a fitted sklearn DBSCAN
+    """
+
+    def __init__(self, labels, core_sample_indices):
+        self.labels_ = labels
+        self.core_sample_indices_ = core_sample_indices
+
+
+class ClusteringBackend(object):
+    """
+    Clusters the photons of an event with DBSCAN, given as the CHID and arrival time slice of each photon
+
+    fit_many clusters with several min_samples at once, so backends can share the neighbour search between them
+    """
+
+    def fit(self, chids, times, min_samples=20, eps=0.1):
+        """
+        :param chids: CHID of each photon
+        :param times: Arrival time slice of each photon
+        :param min_samples: Min samples for DBSCAN
+        :param eps: Maximal distance of two neighbours, as a fraction of the field of view diameter
+        :return: Fitted DBSCAN, or an object with the same labels_ and core_sample_indices_
+        """
+        return self.fit_many(chids, times, [min_samples], eps)[0]
+
+    def fit_many(self, chids, times, min_samples_list, eps=0.1):
+        """
+        :param chids: CHID of each photon
+        :param times: Arrival time slice of each photon
+        :param min_samples_list: Min samples for DBSCAN to cluster with
+        :param eps: Maximal distance of two neighbours, as a fraction of the field of view diameter
+        :return: List with the clustering for each of min_samples_list
+        """
+        raise NotImplementedError
+
+
+class SklearnDBSCAN(ClusteringBackend):
+    """
+    sklearn DBSCAN on the point cloud, as in pyfact, fitted once for each min_samples
+    """
+
+    def fit_many(self, chids, times, min_samples_list, eps=0.1):
+        xyt, abs_eps = scale_point_cloud(arrays_to_point_cloud(chids, times), eps)
+        return [
+            DBSCAN(eps=abs_eps, min_samples=min_samples).fit(xyt)
+            for min_samples in min_samples_list
+        ]
+
+
+class GridDBSCAN(ClusteringBackend):
+    """
+    DBSCAN on the lattice of pixel positions and time slices the photons are on
+
+    Photons with the same CHID and time slice are at the same point, so the neighbourhoods are found between the
+    occupied (CHID, time slice) sites. Which pixels are in reach of each other, and over how many time slices, only
+    depends on the camera geometry, so it is computed once per eps and neighbours are then found by looking up the
+    sites of those pixels. The labels are the same as those of sklearn DBSCAN, including which cluster border
+    photons between two clusters go to
+    """
+
+    def __init__(self):
+        self.neighbourhoods = {}
+        # Site of each (CHID, time slice) key of the event being clustered, -1 for keys without photons
+        self.site_lookup = np.full(
+            NUMBER_OF_PIXELS * NUMBER_OF_TIME_SLICES, -1, dtype=np.int64
+        )
+
+    def neighbourhood(self, eps):
+        """
+        Pixels and lattice sites in reach of each pixel, computed once per eps
+
+        :param eps: Maximal distance of two neighbours, as a fraction of the field of view diameter
+        :return: Dictionary with
+            window_index: for each pixel, where the time windows of the pixels in reach of it, including itself, are
+            in windows, padded with an empty pixel
+            windows and num_windows: buffer fit_many counts the photons of every pixel in each window size in
+            site_indptr, key_offset and dt: CSR table of the sites in reach of a site of each pixel, as the offsets
+            of their keys and time slices
+        """
+        if eps not in self.neighbourhoods:
+            xy = np.column_stack(
+                (np.asarray(GEOMETRY.x_angle), np.asarray(GEOMETRY.y_angle))
+            )
+            abs_eps = absolute_eps(eps)
+            tree = cKDTree(xy)
+            distances = tree.sparse_distance_matrix(
+                tree, abs_eps, output_type="coo_matrix"
+            )
+            # Every pixel is in reach of itself
+            off_diagonal = distances.row != distances.col
+            pixel = np.concatenate(
+                (distances.row[off_diagonal], np.arange(NUMBER_OF_PIXELS))
+            )
+            neighbour = np.concatenate(
+                (distances.col[off_diagonal], np.arange(NUMBER_OF_PIXELS))
+            )
+            distance = np.concatenate(
+                (distances.data[off_diagonal], np.zeros(NUMBER_OF_PIXELS))
+            )
+            order = np.argsort(pixel, kind="stable")
+            pixel, neighbour, distance = pixel[order], neighbour[order], distance[order]
+
+            # Same distance as DBSCAN on the scaled point cloud, for photons dt time slices apart
+            slice_length = TIME_SLICE_DURATION_S * np.deg2rad(DEG_OVER_S)
+            reach = int(abs_eps / slice_length) + 1
+            dt = np.arange(-reach, reach + 1)
+            within = (
+                np.sqrt(distance[:, None] ** 2 + (dt[None, :] * slice_length) ** 2)
+                <= abs_eps
+            )
+            pair, dt_index = np.nonzero(within)
+            # Photons up to max_dt time slices apart in the pixels of a pair are neighbours
+            max_dt = (within.sum(axis=1) - 1) // 2
+            pair_indptr = csr_indptr(pixel)
+            width = np.diff(pair_indptr).max()
+            window_index = np.full(
+                (NUMBER_OF_PIXELS, width),
+                NUMBER_OF_PIXELS * NUMBER_OF_TIME_SLICES,
+                dtype=np.int64,
+            )
+            window_index[pixel, np.arange(len(pixel)) - pair_indptr[pixel]] = (
+                max_dt * (NUMBER_OF_PIXELS + 1) + neighbour
+            ) * NUMBER_OF_TIME_SLICES
+            self.neighbourhoods[eps] = {
+                "num_windows": max_dt.max() + 1,
+                "windows": np.zeros(
+                    (max_dt.max() + 1, NUMBER_OF_PIXELS + 1, NUMBER_OF_TIME_SLICES),
+                    dtype=np.int64,
+                ),
+                "window_index": window_index,
+                "site_indptr": csr_indptr(pixel[pair]),
+                "key_offset": (neighbour[pair] - pixel[pair]) * NUMBER_OF_TIME_SLICES
+                + dt[dt_index],
+                "dt": dt[dt_index],
+            }
+        return self.neighbourhoods[eps]
+
+    def fit_many(self, chids, times, min_samples_list, eps=0.1):
+        chids = np.asarray(chids, dtype=np.int64)
+        times = np.asarray(times, dtype=np.int64)
+        if len(chids) == 0:
+            return [
+                DBSCANResult(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+                for _ in min_samples_list
+            ]
+        neighbourhood = self.neighbourhood(eps)
+
+        # Sites are the occupied (CHID, time slice) pairs, each photon is on one site
+        keys = chids * NUMBER_OF_TIME_SLICES + times
+        site_keys, first_photon, photon_site = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        photon_site = photon_site.reshape(-1)
+        site_chids, site_times = np.divmod(site_keys, NUMBER_OF_TIME_SLICES)
+
+        # Photons within eps of each site, including its own, from the photons in the time window of each pixel pair
+        num_times = int(times.max()) + 1
+        max_dt = neighbourhood["num_windows"] - 1
+        photons_before = np.zeros(
+            (NUMBER_OF_PIXELS + 1, num_times + 2 * max_dt + 1), dtype=np.int64
+        )
+        photons_before[:-1, max_dt + 1 : max_dt + 1 + num_times] = np.cumsum(
+            np.bincount(
+                chids * num_times + times, minlength=NUMBER_OF_PIXELS * num_times
+            ).reshape(NUMBER_OF_PIXELS, num_times),
+            axis=1,
+        )
+        photons_before[:, max_dt + 1 + num_times :] = photons_before[
+            :, max_dt + num_times, None
+        ]
+        windows = neighbourhood["windows"]
+        for dt in range(max_dt + 1):
+            np.subtract(
+                photons_before[:, max_dt + dt + 1 : max_dt + dt + 1 + num_times],
+                photons_before[:, max_dt - dt : max_dt - dt + num_times],
+                out=windows[dt, :, :num_times],
+            )
+        windows = windows.reshape(-1)
+        neighbour_counts = windows[
+            neighbourhood["window_index"][site_chids] + site_times[:, None]
+        ].sum(axis=1)
+
+        # Edges are only needed from the sites that are core for some min_samples, edges are symmetric so these
+        # also connect the border sites to them
+        candidates = np.flatnonzero(neighbour_counts >= min(min_samples_list))
+        edge_source, offset = expand_csr(
+            neighbourhood["site_indptr"], site_chids[candidates]
+        )
+        edge_source = candidates[edge_source]
+        target_time = site_times[edge_source] + neighbourhood["dt"][offset]
+        valid = (target_time >= 0) & (target_time < NUMBER_OF_TIME_SLICES)
+        edge_source = edge_source[valid]
+        self.site_lookup[site_keys] = np.arange(len(site_keys))
+        edge_target = self.site_lookup[
+            site_keys[edge_source] + neighbourhood["key_offset"][offset[valid]]
+        ]
+        self.site_lookup[site_keys] = -1
+        found = edge_target >= 0
+        edge_source = edge_source[found]
+        edge_target = edge_target[found]
+
+        results = []
+        for min_samples in min_samples_list:
+            core_site = neighbour_counts >= min_samples
+            core_edge = core_site[edge_source] & core_site[edge_target]
+            graph = coo_matrix(
+                (
+                    np.ones(np.count_nonzero(core_edge)),
+                    (edge_source[core_edge], edge_target[core_edge]),
+                ),
+                shape=(len(site_keys), len(site_keys)),
+            )
+            _, component = connected_components(graph, directed=False)
+            # sklearn numbers the clusters by their first core photon
+            cluster_start = np.full(len(site_keys), len(chids), dtype=np.int64)
+            np.minimum.at(cluster_start, component[core_site], first_photon[core_site])
+            order = np.argsort(cluster_start, kind="stable")
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            site_labels = np.where(core_site, rank[component], -1)
+            # Border sites go to the first cluster expanded into them, the lowest label of their core neighbours
+            border_edge = core_site[edge_source] & ~core_site[edge_target]
+            border_labels = np.full(len(site_keys), len(site_keys), dtype=np.int64)
+            np.minimum.at(
+                border_labels,
+                edge_target[border_edge],
+                site_labels[edge_source[border_edge]],
+            )
+            site_labels = np.where(
+                ~core_site & (border_labels < len(site_keys)),
+                border_labels,
+                site_labels,
+            )
+            results.append(
+                DBSCANResult(
+                    site_labels[photon_site],
+                    np.flatnonzero(core_site[photon_site]),
+                )
+            )
+        return results
+
+
+CLUSTERING_BACKENDS = {"sklearn": SklearnDBSCAN, "grid": GridDBSCAN}
@@ -1,12 +1,32 @@
 import numpy as np
+import scipy.sparse as sp
 from factnn.data.preprocess.base_preprocessor import BasePreprocessor
+from factnn.utils.phs import photon_arrays
 import pickle
 import os
 
 
 class EventFilePreprocessor(BasePreprocessor):
     def init(self):
-        pass
+        # CSC arrays of self.rebinning for rebin_batch, see rebinning_columns
+        self._rebinning_columns = None
+
+    def load_event(self, path, as_arrays=False):
+        """
+        Loads one event, from the packed event store if the preprocessor has one, otherwise from its pickled event file
+
+        :param path: Path of the event file, or the name or index of the event in the event store
+        :param as_arrays: Whether events from the event store have their photons as (chids, times) views instead of
+        the list of lists, which the rebinning takes without building the lists
+        :return: [data, data_format, features, cluster] of the event, or None if the event file is empty
+        """
+        if self.event_store is not None:
+            return self.event_store.event(path, as_arrays=as_arrays)
+        if os.path.getsize(path) > 0:
+            # Checks that file is not 0
+            with open(path, "rb") as pickled_event:
+                return pickle.load(pickled_event)
+        return None
 
     def check_files(self, paths, title):
         """
@@ -60,6 +80,101 @@ class EventFilePreprocessor(BasePreprocessor):
 
         return failed_paths
 
+    def rebin_batch(
+        self,
+        photon_lists,
+        starts=None,
+        ends=None,
+        clip_end=False,
+        equal_slices=False,
+        weight=1.0,
+    ):
+        """
+        Rebins a batch of events onto the square grid in one call, instead of one rebin_photons call per event
+
+        Every photon of the batch gets a flat (event, chid, slice) index, is spread over the grid pixels its CHID
+        overlaps, and all of them are summed with one np.bincount into the images
+
+        :param photon_lists: List of photon stream list of lists representations or (chids, times) arrays, one per event
+        :param starts: First time slice to use, either a scalar or one value per event, defaults to self.start
+        :param ends: Time slice to stop before, either a scalar or one value per event, defaults to self.end
+        :param clip_end: Whether photons past the last slice are summed into the last slice instead of dropped
+        :param equal_slices: Whether to sum equal sized groups of time slices into each slice
+        :param weight: Value each photon adds to the image, scaled by the overlap fraction
+        :return: Images of shape (len(photon_lists), rebin_size, rebin_size, time_slices), each the same as
+        rebin_photons returns for that event
+        """
+        if starts is None:
+            starts = self.start
+        if ends is None:
+            ends = self.end
+        num_events = len(photon_lists)
+        num_slices = self.shape[3]
+        shape = (num_events, self.rebin_size, self.rebin_size, num_slices)
+        if num_events == 0:
+            return np.zeros(shape, dtype=np.float32)
+
+        chids, times = zip(*[photon_arrays(photons) for photons in photon_lists])
+        events = np.repeat(np.arange(num_events), [len(event) for event in times])
+        chids = np.concatenate(chids)
+        times = np.concatenate(times)
+        starts = np.broadcast_to(np.asarray(starts, dtype=np.int64), (num_events,))
+        ends = np.broadcast_to(np.asarray(ends, dtype=np.int64), (num_events,))
+        indices, mask = self.time_slice_indices(
+            times,
+            starts[events],
+            ends[events],
+            num_slices,
+            clip_end=clip_end,
+            equal_slices=equal_slices,
+        )
+        events = events[mask]
+        chids = chids[mask]
+        indices = indices[mask]
+
+        # One entry per overlap of a photon's CHID with a grid pixel, taken straight from the CSC columns
+        indptr, grid_pixels, fractions = self.rebinning_columns()
+        first_entries = indptr[chids]
+        entries_per_photon = indptr[chids + 1] - first_entries
+        photons = np.repeat(np.arange(len(chids)), entries_per_photon)
+        entries = (
+            first_entries[photons]
+            + np.arange(len(photons))
+            - np.repeat(
+                np.cumsum(entries_per_photon) - entries_per_photon, entries_per_photon
+            )
+        )
+        flat_index = (
+            events[photons] * self.rebin_size**2 + grid_pixels[entries]
+        ) * num_slices + indices[photons]
+        images = np.bincount(
+            flat_index, weights=fractions[entries], minlength=int(np.prod(shape))
+        )
+        images = images.astype(np.float32).reshape(shape)
+        if weight != 1.0:
+            images *= weight
+        return images
+
+    def rebinning_columns(self):
+        """
+        Gets the CSC arrays of the rebinning operator, converted once and kept until self.rebinning is replaced
+
+        :return: (indptr, grid_pixels, fractions), the grid pixels a CHID overlaps and the fractions of the overlaps
+        are grid_pixels and fractions from indptr[chid] up to indptr[chid + 1]
+        """
+        if (
+            self._rebinning_columns is None
+            or self._rebinning_columns[0] is not self.rebinning
+        ):
+            rebinning = sp.csc_matrix(self.rebinning)
+            self._rebinning_columns = (
+                self.rebinning,
+                rebinning.indptr.astype(np.int64),
+                rebinning.indices.astype(np.int64),
+                rebinning.data,
+            )
+        return self._rebinning_columns[1:]
+
     def on_files_processor(
         self,
         paths,
@@ -73,129 +188,92 @@ class EventFilePreprocessor(BasePreprocessor):
         return_collapsed=False,
         norm_per_slice=False,
     ):
-        all_data = []
+        events = []
         for index, file in enumerate(paths):
-            # load the pickled file from the disk
-            if os.path.getsize(file) > 0:
-                # Checks that file is not 0
-                with open(file, "rb") as pickled_event:
-                    data, data_format, features, feature_cluster = pickle.load(
-                        pickled_event
-                    )
-                    if return_features:
-                        if features["extraction"] == 1:
-                            # Failed feature extraction, so ignore event
-                            continue
-                        else:
-                            # Based off a subset the Open Crab Sample Analysis
-                            feature_list = []
-                            feature_list.append(features["head_tail_ratio"])
-                            feature_list.append(features["length"])
-                            feature_list.append(features["width"])
-                            feature_list.append(features["time_gradient"])
-                            feature_list.append(features["number_photons"])
-                            feature_list.append(
-                                features["length"] * features["width"] * np.pi
-                            )
-                            feature_list.append(
-                                (
-                                    (features["length"] * features["width"] * np.pi)
-                                    / np.log(features["number_photons"]) ** 2
-                                )
+            # load the pickled file from the disk, or the event from the event store
+            event = self.load_event(file, as_arrays=True)
+            if event is not None:
+                data, data_format, features, feature_cluster = event
+                feature_list = None
+                if return_features:
+                    if features["extraction"] == 1:
+                        # Failed feature extraction, so ignore event
+                        continue
+                    else:
+                        # Based off a subset the Open Crab Sample Analysis
+                        feature_list = []
+                        feature_list.append(features["head_tail_ratio"])
+                        feature_list.append(features["length"])
+                        feature_list.append(features["width"])
+                        feature_list.append(features["time_gradient"])
+                        feature_list.append(features["number_photons"])
+                        feature_list.append(
+                            features["length"] * features["width"] * np.pi
+                        )
+                        feature_list.append(
+                            (
+                                (features["length"] * features["width"] * np.pi)
+                                / np.log(features["number_photons"]) ** 2
                             )
-                            feature_list.append(
-                                (
-                                    features["number_photons"]
-                                    / (features["length"] * features["width"] * np.pi)
-                                )
+                        )
+                        feature_list.append(
+                            (
+                                features["number_photons"]
+                                / (features["length"] * features["width"] * np.pi)
                             )
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    # Do dynamic resizing if wanted, so start and end are only within the bounds, potentially saving memory
-                    if dynamic_resize:
-                        self.start, self.end, _, _ = self.dynamic_size(
-                            data[data_format["Image"]]
                         )
+                # Do dynamic resizing if wanted, so start and end are only within the bounds, potentially saving memory
+                if dynamic_resize:
+                    self.start, self.end, _, _ = self.dynamic_size(
+                        data[data_format["Image"]]
+                    )
 
-                    if truncate:
-                        # Truncates the images at x timesteps in, each slice is one temporal slice
-                        self.end = self.start + self.shape[3]
-
-                    if equal_slices:
-                        # Creates a slice size that then assignes all values in those set of slices to a single slice to fit
-                        # within the orignal constraints, each slice is an equal number of timeslices summed up
-                        slice_size = int(
-                            np.ceil((self.end - self.start) / self.shape[3])
-                        )
-                        slice_sizes = []
-                        for i in range(self.shape[3]):
-                            # Organized smallest to largest
-                            slice_sizes.append(((i) * slice_size) + self.start)
+                if truncate:
+                    # Truncates the images at x timesteps in, each slice is one temporal slice
+                    self.end = self.start + self.shape[3]
+                events.append((data, data_format, feature_list, self.start, self.end))
 
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in data[data_format["Image"]][index]:
-                                if self.end > value >= self.start:
-                                    # Now add more logic for the other cases
-                                    # Nothing for truncate, end is already specified
-                                    # Equal slices is only real one
-                                    if equal_slices:
-                                        for idx, number in enumerate(slice_sizes):
-                                            if (idx * slice_size) < value <= number:
-                                                # In the range of the slice, add to it
-                                                input_matrix[coords[0]][coords[1]][
-                                                    idx
-                                                ] += (element[1] * 1)
-                                                break
-                                    elif not truncate:
-                                        # Now sum up last one, as equal already used, so last frame has all the rest of the frames
-                                        if value - self.start >= self.shape[3]:
-                                            input_matrix[coords[0]][coords[1]][
-                                                self.shape[3] - 1
-                                            ] += (element[1] * 1)
-                                        else:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
-                                    else:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
+        # Rebin the whole batch at once, each event with its own start and end
+        # If equal_slices, each slice is an equal number of timeslices summed up, to fit within the
+        # original constraints, otherwise if not truncating the last slice has all the rest of the frames
+        images = self.rebin_batch(
+            [data[data_format["Image"]] for data, data_format, _, _, _ in events],
+            starts=[start for _, _, _, start, _ in events],
+            ends=[end for _, _, _, _, end in events],
+            clip_end=not truncate,
+            equal_slices=equal_slices,
+        )
 
-                    # Now have image in resized format, all other data is set
-                    data[data_format["Image"]] = np.fliplr(np.rot90(input_matrix, 3))
-                    # need to do the format thing here, and add auxiliary structure
-                    data = self.format([data, data_format])
-                    if return_collapsed:
-                        collapsed_data = self.collapse_image_time(
-                            data[0], 1, self.as_channels
-                        )
-                    if normalize:
-                        data = list(data)
-                        data[0] = self.normalize_image(
-                            data[0], per_slice=norm_per_slice
-                        )
-                        data = tuple(data)
-                        if return_collapsed:
-                            collapsed_data = self.normalize_image(
-                                collapsed_data, per_slice=False
-                            )
-                    if collapse_time:
-                        data = list(data)
-                        data[0] = self.collapse_image_time(
-                            data[0], final_slices, self.as_channels
-                        )
-                        data = tuple(data)
-                temp_data = [data, data_format]
-                if return_features:
-                    temp_data.append(feature_list)
+        all_data = []
+        for (data, data_format, feature_list, _, _), input_matrix in zip(
+            events, images
+        ):
+            # Now have image in resized format, all other data is set
+            data[data_format["Image"]] = input_matrix
+            # need to do the format thing here, and add auxiliary structure
+            data = self.format([data, data_format])
+            if return_collapsed:
+                collapsed_data = self.collapse_image_time(data[0], 1, self.as_channels)
+            if normalize:
+                data = list(data)
+                data[0] = self.normalize_image(data[0], per_slice=norm_per_slice)
+                data = tuple(data)
                 if return_collapsed:
-                    temp_data.append(collapsed_data)
-                all_data.append(temp_data)
+                    collapsed_data = self.normalize_image(
+                        collapsed_data, per_slice=False
+                    )
+            if collapse_time:
+                data = list(data)
+                data[0] = self.collapse_image_time(
+                    data[0], final_slices, self.as_channels
+                )
+                data = tuple(data)
+            temp_data = [data, data_format]
+            if return_features:
+                temp_data.append(feature_list)
+            if return_collapsed:
+                temp_data.append(collapsed_data)
+            all_data.append(temp_data)
         # Now have all the data transformed as necessary, return as list of list of images, data_formats
         return all_data
 
@@ -218,20 +296,10 @@ class EventFilePreprocessor(BasePreprocessor):
         """
         with open(filepath, "rb") as data_file:
             data, data_format = pickle.load(data_file)
-            input_matrix = np.zeros([self.shape[1], self.shape[2], self.shape[3]])
-            chid_to_pixel = self.rebinning[0]
-            pixel_index_to_grid = self.rebinning[1]
-            for index in range(1440):
-                for element in chid_to_pixel[index]:
-                    coords = pixel_index_to_grid[element[0]]
-                    for value in data[data_format["Image"]][index]:
-                        if self.end > value >= self.start:
-                            input_matrix[coords[0]][coords[1]][value - self.start] += (
-                                element[1] * 1
-                            )
+            input_matrix = self.rebin_photons(data[data_format["Image"]])
 
             # Now have image in resized format, all other data is set
-            data[data_format["Image"]] = np.fliplr(np.rot90(input_matrix, 3))
+            data[data_format["Image"]] = input_matrix
             # need to do the format thing here, and add auxiliary structure
             data = self.format([data, data_format])
             if normalize:
@@ -4,7 +4,6 @@ import photon_stream as ps
 from fact.io import read_h5py
 import datetime
 import os
-import pickle
 
 from factnn.data.preprocess.base_preprocessor import BasePreprocessor
 
@@ -29,147 +28,194 @@ class ObservationPreprocessor(BasePreprocessor):
                 "pointing_position_zd",
             ],
         )
+        # Row of each (night, run_id, event_num), so events are matched with a lookup instead of a scan of the file
+        self.dl2_index = {}
+        for row, key in enumerate(
+            zip(
+                self.dl2_file["night"].values.tolist(),
+                self.dl2_file["run_id"].values.tolist(),
+                self.dl2_file["event_num"].values.tolist(),
+            )
+        ):
+            self.dl2_index.setdefault(key, row)
+
+    def dl2_event(self, event):
+        """
+        Finds the DL2 row of an observed event from its night, run and event number
+
+        :param event: Photon stream observation event
+        :return: DataFrame with the matching row, empty if the event is not in the DL2 file
+        """
+        # Past the last row when there is no match, which gives an empty DataFrame
+        row = self.dl2_index.get(
+            (
+                event.observation_info.night,
+                event.observation_info.run,
+                event.observation_info.event,
+            ),
+            len(self.dl2_file),
+        )
+        return self.dl2_file.iloc[row : row + 1]
 
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        clump_size=20,
+        packed=False,
+        event_range=None,
+        check_existing=True,
     ):
+        clump_sizes = (
+            clump_size if isinstance(clump_size, (list, tuple)) else [clump_size]
+        )
         for index, file in enumerate(self.paths):
             file_name = file.split("/")[-1].split(".phs")[0]
             try:
                 sim_reader = ps.EventListReader(file)
                 counter = 0
                 for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (self.dl2_file["event_num"] == event.observation_info.event)
-                        & (self.dl2_file["night"] == event.observation_info.night)
-                        & (self.dl2_file["run_id"] == event.observation_info.run)
-                    ]
+                    df_event = self.dl2_event(event)
                     if not df_event.empty:
                         counter += 1
+                        if event_range is not None:
+                            if counter >= event_range[1]:
+                                break
+                            if counter < event_range[0]:
+                                continue
 
-                        if os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "clump" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
-                            )
-                        ) and os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "core" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
-                            )
+                        if check_existing and self.is_converted(
+                            directory, str(file_name) + "_" + str(counter), clump_sizes
                         ):
                             print("True: " + str(file_name) + "_" + str(counter))
                             continue
 
                         if clean_images:
                             # Do it for no clumps, all clump, and only core into different subfolders
-                            all_photons, clump_photons, core_photons = self.clean_image(
-                                event, only_core=only_core, min_samples=clump_size
-                            )
-                            if core_photons is None:
-                                print("No Clumps, skip")
-                                continue
-                            else:
-                                for key, photon_set in {
-                                    "no_clean": all_photons,
-                                    "clump": clump_photons,
-                                    "core": core_photons,
-                                }.items():
-                                    event.photon_stream.raw = photon_set
-                                    # In the event chosen from the file
-                                    # Each event is the same as each line below
-                                    source_pos_x = df_event["source_position_x"].values[
-                                        0
-                                    ]
-                                    source_pos_y = df_event["source_position_y"].values[
-                                        0
-                                    ]
-                                    timestamp = (
-                                        df_event["timestamp"]
-                                        .values[0]
-                                        .astype(datetime.datetime)
-                                    )
-                                    event_photons = event.photon_stream.list_of_lists
-                                    zd_deg = event.zd
-                                    az_deg = event.az
-                                    cog_x = df_event["cog_x"].values[0]
-                                    cog_y = df_event["cog_y"].values[0]
-                                    sky_source_az = df_event[
-                                        "source_position_az"
-                                    ].values[0]
-                                    sky_source_zd = df_event[
-                                        "source_position_zd"
-                                    ].values[0]
-                                    zd_deg1 = df_event["pointing_position_zd"].values[0]
-                                    az_deg1 = df_event["pointing_position_az"].values[0]
-                                    event_num = event.observation_info.event
-                                    night = event.observation_info.night
-                                    run = event.observation_info.run
-                                    data_dict = [
-                                        [
-                                            event_photons,
-                                            timestamp,
-                                            zd_deg,
-                                            az_deg,
-                                            cog_x,
-                                            cog_y,
-                                            sky_source_az,
-                                            sky_source_zd,
-                                            zd_deg1,
-                                            az_deg1,
-                                            source_pos_x,
-                                            source_pos_y,
-                                            event_num,
-                                            night,
-                                            run,
-                                        ],
-                                        {
-                                            "Image": 0,
-                                            "Timestamp": 1,
-                                            "Zd_Deg": 2,
-                                            "Az_Deg": 3,
-                                            "COG_X": 4,
-                                            "COG_Y": 5,
-                                            "Source_Position_Az": 6,
-                                            "Source_Position_Zd": 7,
-                                            "Pointing_Position_Zd": 8,
-                                            "Pointing_Position_Az": 9,
-                                            "Source_Position_X": 10,
-                                            "Source_Position_Y": 11,
-                                            "Event_Number": 12,
-                                            "Night": 13,
-                                            "Run": 14,
-                                        },
-                                    ]
-                                    if key != "no_clean":
-                                        with open(
-                                            os.path.join(
-                                                directory,
-                                                key + str(clump_size),
-                                                str(file_name) + "_" + str(counter),
-                                            ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
-                                    else:
-                                        if not os.path.isfile(
-                                            os.path.join(
-                                                directory,
-                                                key,
-                                                str(file_name) + "_" + str(counter),
-                                            )
-                                        ):
-                                            with open(
+                            # The uncleaned event is written once, by the first clump size that found clumps
+                            no_clean = None
+                            for clump_size, (
+                                all_photons,
+                                clump_photons,
+                                core_photons,
+                                dbscan,
+                            ) in self.clean_image_sizes(event, clump_sizes).items():
+                                if core_photons is None:
+                                    print("No Clumps, skip")
+                                    continue
+                                else:
+                                    photon_sets = {
+                                        "clump": clump_photons,
+                                        "core": core_photons,
+                                    }
+                                    if no_clean is None:
+                                        photon_sets = dict(
+                                            no_clean=all_photons, **photon_sets
+                                        )
+                                    for key, photon_set in photon_sets.items():
+                                        event.photon_stream.raw = photon_set
+                                        # In the event chosen from the file
+                                        # Each event is the same as each line below
+                                        source_pos_x = df_event[
+                                            "source_position_x"
+                                        ].values[0]
+                                        source_pos_y = df_event[
+                                            "source_position_y"
+                                        ].values[0]
+                                        timestamp = (
+                                            df_event["timestamp"]
+                                            .values[0]
+                                            .astype(datetime.datetime)
+                                        )
+                                        event_photons = (
+                                            event.photon_stream.list_of_lists
+                                        )
+                                        zd_deg = event.zd
+                                        az_deg = event.az
+                                        cog_x = df_event["cog_x"].values[0]
+                                        cog_y = df_event["cog_y"].values[0]
+                                        sky_source_az = df_event[
+                                            "source_position_az"
+                                        ].values[0]
+                                        sky_source_zd = df_event[
+                                            "source_position_zd"
+                                        ].values[0]
+                                        zd_deg1 = df_event[
+                                            "pointing_position_zd"
+                                        ].values[0]
+                                        az_deg1 = df_event[
+                                            "pointing_position_az"
+                                        ].values[0]
+                                        event_num = event.observation_info.event
+                                        night = event.observation_info.night
+                                        run = event.observation_info.run
+                                        data_dict = [
+                                            [
+                                                event_photons,
+                                                timestamp,
+                                                zd_deg,
+                                                az_deg,
+                                                cog_x,
+                                                cog_y,
+                                                sky_source_az,
+                                                sky_source_zd,
+                                                zd_deg1,
+                                                az_deg1,
+                                                source_pos_x,
+                                                source_pos_y,
+                                                event_num,
+                                                night,
+                                                run,
+                                            ],
+                                            {
+                                                "Image": 0,
+                                                "Timestamp": 1,
+                                                "Zd_Deg": 2,
+                                                "Az_Deg": 3,
+                                                "COG_X": 4,
+                                                "COG_Y": 5,
+                                                "Source_Position_Az": 6,
+                                                "Source_Position_Zd": 7,
+                                                "Pointing_Position_Zd": 8,
+                                                "Pointing_Position_Az": 9,
+                                                "Source_Position_X": 10,
+                                                "Source_Position_Y": 11,
+                                                "Event_Number": 12,
+                                                "Night": 13,
+                                                "Run": 14,
+                                            },
+                                        ]
+                                        if key != "no_clean":
+                                            self.save_event(
                                                 os.path.join(
                                                     directory,
-                                                    key,
+                                                    key + str(clump_size),
                                                     str(file_name) + "_" + str(counter),
                                                 ),
-                                                "wb",
-                                            ) as event_file:
-                                                pickle.dump(data_dict, event_file)
+                                                data_dict,
+                                                packed,
+                                            )
+                                        else:
+                                            no_clean = data_dict
+                                if no_clean is not None and (
+                                    not check_existing
+                                    or not os.path.isfile(
+                                        os.path.join(
+                                            directory,
+                                            "no_clean",
+                                            str(file_name) + "_" + str(counter),
+                                        )
+                                    )
+                                ):
+                                    self.save_event(
+                                        os.path.join(
+                                            directory,
+                                            "no_clean",
+                                            str(file_name) + "_" + str(counter),
+                                        ),
+                                        no_clean,
+                                        packed,
+                                    )
                         else:
                             # In the event chosen from the file
                             # Each event is the same as each line below
@@ -229,16 +275,21 @@ class ObservationPreprocessor(BasePreprocessor):
                                     "Run": 14,
                                 },
                             ]
-                            with open(
+                            self.save_event(
                                 os.path.join(
                                     directory, str(file_name) + "_" + str(counter)
                                 ),
-                                "wb",
-                            ) as event_file:
-                                pickle.dump(data_dict, event_file)
+                                data_dict,
+                                packed,
+                            )
             except Exception as e:
+                if event_range is not None:
+                    # Raised so convert_events converts the range again instead of recording it as done
+                    self.close_event_stores()
+                    raise
                 print(str(e))
                 pass
+        self.close_event_stores()
 
     def batch_processor(self, clean_images=False):
         self.init()
@@ -248,11 +299,7 @@ class ObservationPreprocessor(BasePreprocessor):
                 sim_reader = ps.EventListReader(file)
                 data = []
                 for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (self.dl2_file["event_num"] == event.observation_info.event)
-                        & (self.dl2_file["night"] == event.observation_info.night)
-                        & (self.dl2_file["run_id"] == event.observation_info.run)
-                    ]
+                    df_event = self.dl2_event(event)
                     if not df_event.empty:
                         if clean_images:
                             event = self.clean_image(event)
@@ -275,23 +322,11 @@ class ObservationPreprocessor(BasePreprocessor):
                         event_num = event.observation_info.event
                         night = event.observation_info.night
                         run = event.observation_info.run
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
+                        input_matrix = self.rebin_photons(event_photons)
 
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -328,11 +363,7 @@ class ObservationPreprocessor(BasePreprocessor):
                     sim_reader = ps.EventListReader(file)
                     for event in sim_reader:
                         data = []
-                        df_event = self.dl2_file.loc[
-                            (self.dl2_file["event_num"] == event.observation_info.event)
-                            & (self.dl2_file["night"] == event.observation_info.night)
-                            & (self.dl2_file["run_id"] == event.observation_info.run)
-                        ]
+                        df_event = self.dl2_event(event)
                         if not df_event.empty:
                             if clean_images:
                                 event = self.clean_image(event)
@@ -357,23 +388,11 @@ class ObservationPreprocessor(BasePreprocessor):
                             event_num = event.observation_info.event
                             night = event.observation_info.night
                             run = event.observation_info.run
-                            input_matrix = np.zeros(
-                                [self.shape[1], self.shape[2], self.shape[3]]
-                            )
-                            chid_to_pixel = self.rebinning[0]
-                            pixel_index_to_grid = self.rebinning[1]
-                            for index in range(1440):
-                                for element in chid_to_pixel[index]:
-                                    coords = pixel_index_to_grid[element[0]]
-                                    for value in event_photons[index]:
-                                        if self.end >= value >= self.start:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
+                            input_matrix = self.rebin_photons(event_photons)
 
                             data.append(
                                 [
-                                    np.fliplr(np.rot90(input_matrix, 3)),
+                                    input_matrix,
                                     energy,
                                     zd_deg,
                                     az_deg,
@@ -424,11 +443,7 @@ class ObservationPreprocessor(BasePreprocessor):
                     print("Trying...")
                     crab_reader = ps.EventListReader(file)
                     for event in crab_reader:
-                        df_event = self.dl2_file.loc[
-                            (self.dl2_file["event_num"] == event.observation_info.event)
-                            & (self.dl2_file["night"] == event.observation_info.night)
-                            & (self.dl2_file["run_id"] == event.observation_info.run)
-                        ]
+                        df_event = self.dl2_event(event)
                         if not df_event.empty:
                             count += 1
                     print(count)
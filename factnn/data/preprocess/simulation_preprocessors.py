@@ -3,9 +3,8 @@ import h5py
 import fact
 import photon_stream as ps
 from fact.io import read_h5py
-from factnn.data.preprocess.base_preprocessor import BasePreprocessor
+from factnn.data.preprocess.base_preprocessor import BasePreprocessor, events_in_range
 from sklearn.utils import shuffle
-import pickle
 import os
 from factnn.utils.hillas import extract_single_simulation_features
 
@@ -16,115 +15,116 @@ class SimulationPreprocessor(BasePreprocessor):
         directory,
         clean_type="dbscan",
         clean_images=False,
-        only_core=True,
         clump_size=20,
+        packed=False,
+        event_range=None,
+        check_existing=True,
     ):
+        clump_sizes = (
+            clump_size if isinstance(clump_size, (list, tuple)) else [clump_size]
+        )
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
             file_name = file.split("/")[-1].split(".phs")[0]
             try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
+                events = events_in_range(
+                    lambda path: ps.SimulationReader(
+                        photon_stream_path=path, mmcs_corsika_path=mc_truth
+                    ),
+                    file,
+                    event_range,
+                    self.range_directory,
                 )
-                counter = 0
-                for event in sim_reader:
-                    counter += 1
+                for counter, event in events:
 
-                    if os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "clump" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
+                    if check_existing and self.is_converted(
+                        directory, str(file_name) + "_" + str(counter), clump_sizes
                     ):
                         print("True: " + str(file_name) + "_" + str(counter))
                         continue
 
                     if clean_images:
                         # Do it for no clumps, all clump, and only core into different subfolders
-                        (
+                        # The uncleaned event is written once, by the first clump size that found clumps
+                        no_clean = None
+                        for clump_size, (
                             all_photons,
                             clump_photons,
                             core_photons,
                             dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
-                        )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        for key, photon_set in {
-                            "no_clean": all_photons,
-                            "clump": clump_photons,
-                            "core": core_photons,
-                        }.items():
-                            event.photon_stream.raw = photon_set
-                            # Extract parameters from the file, if cleaning type is 'facttools', then this still calls DBSCAN currently
-                            # TODO Get features from FeatureStream without DBSCAN
-                            features, cluster = extract_single_simulation_features(
-                                event, cluster=dbscan, min_samples=clump_size
-                            )
-                            # In the event chosen from the file
-                            # Each event is the same as each line below
-                            energy = event.simulation_truth.air_shower.energy
-                            event_photons = event.photon_stream.list_of_lists
-                            zd_deg = event.zd
-                            az_deg = event.az
-                            act_phi = event.simulation_truth.air_shower.phi
-                            act_theta = event.simulation_truth.air_shower.theta
-                            data_dict = [
-                                [
-                                    event_photons,
-                                    energy,
-                                    zd_deg,
-                                    az_deg,
-                                    act_phi,
-                                    act_theta,
-                                ],
-                                {
-                                    "Image": 0,
-                                    "Energy": 1,
-                                    "Zd_Deg": 2,
-                                    "Az_Deg": 3,
-                                    "Phi": 4,
-                                    "Theta": 5,
-                                },
-                                features,
-                                cluster,
-                            ]
-                            if key != "no_clean":
-                                with open(
-                                    os.path.join(
-                                        directory,
-                                        key + str(clump_size),
-                                        str(file_name) + "_" + str(counter),
-                                    ),
-                                    "wb",
-                                ) as event_file:
-                                    pickle.dump(data_dict, event_file)
-                            else:
-                                if not os.path.isfile(
-                                    os.path.join(
-                                        directory,
-                                        key,
-                                        str(file_name) + "_" + str(counter),
-                                    )
-                                ):
-                                    with open(
+                        ) in self.clean_image_sizes(event, clump_sizes).items():
+                            if core_photons is None:
+                                print("No Clumps, skip")
+                                continue
+                            photon_sets = {"clump": clump_photons, "core": core_photons}
+                            if no_clean is None:
+                                photon_sets = dict(no_clean=all_photons, **photon_sets)
+                            for key, photon_set in photon_sets.items():
+                                event.photon_stream.raw = photon_set
+                                # Extract parameters from the file, if cleaning type is 'facttools', then this still calls DBSCAN currently
+                                # TODO Get features from FeatureStream without DBSCAN
+                                features, cluster = extract_single_simulation_features(
+                                    event, cluster=dbscan, min_samples=clump_size
+                                )
+                                # In the event chosen from the file
+                                # Each event is the same as each line below
+                                energy = event.simulation_truth.air_shower.energy
+                                event_photons = event.photon_stream.list_of_lists
+                                zd_deg = event.zd
+                                az_deg = event.az
+                                act_phi = event.simulation_truth.air_shower.phi
+                                act_theta = event.simulation_truth.air_shower.theta
+                                data_dict = [
+                                    [
+                                        event_photons,
+                                        energy,
+                                        zd_deg,
+                                        az_deg,
+                                        act_phi,
+                                        act_theta,
+                                    ],
+                                    {
+                                        "Image": 0,
+                                        "Energy": 1,
+                                        "Zd_Deg": 2,
+                                        "Az_Deg": 3,
+                                        "Phi": 4,
+                                        "Theta": 5,
+                                    },
+                                    features,
+                                    cluster,
+                                ]
+                                if key != "no_clean":
+                                    self.save_event(
                                         os.path.join(
                                             directory,
-                                            key,
+                                            key + str(clump_size),
                                             str(file_name) + "_" + str(counter),
                                         ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
+                                        data_dict,
+                                        packed,
+                                    )
+                                else:
+                                    no_clean = data_dict
+                        if no_clean is not None and (
+                            not check_existing
+                            or not os.path.isfile(
+                                os.path.join(
+                                    directory,
+                                    "no_clean",
+                                    str(file_name) + "_" + str(counter),
+                                )
+                            )
+                        ):
+                            self.save_event(
+                                os.path.join(
+                                    directory,
+                                    "no_clean",
+                                    str(file_name) + "_" + str(counter),
+                                ),
+                                no_clean,
+                                packed,
+                            )
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -148,16 +148,21 @@ class SimulationPreprocessor(BasePreprocessor):
                             features,
                             cluster,
                         ]
-                        with open(
+                        self.save_event(
                             os.path.join(
                                 directory, str(file_name) + "_" + str(counter)
                             ),
-                            "wb",
-                        ) as event_file:
-                            pickle.dump(data_dict, event_file)
+                            data_dict,
+                            packed,
+                        )
             except Exception as e:
+                if event_range is not None:
+                    # Raised so convert_events converts the range again instead of recording it as done
+                    self.close_event_stores()
+                    raise
                 print(str(e))
                 pass
+        self.close_event_stores()
 
     def batch_processor(self, clean_images=False):
         for index, file in enumerate(self.paths):
@@ -181,22 +186,10 @@ class SimulationPreprocessor(BasePreprocessor):
                     az_deg = event.az
                     act_phi = event.simulation_truth.air_shower.phi
                     act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
+                    input_matrix = self.rebin_photons(event_photons)
                     data.append(
                         [
-                            np.fliplr(np.rot90(input_matrix, 3)),
+                            input_matrix,
                             energy,
                             zd_deg,
                             az_deg,
@@ -240,22 +233,10 @@ class SimulationPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 100)
+                        input_matrix = self.rebin_photons(event_photons, weight=100)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -319,113 +300,118 @@ class SimulationPreprocessor(BasePreprocessor):
 
 class ProtonPreprocessor(BasePreprocessor):
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        clump_size=20,
+        packed=False,
+        event_range=None,
+        check_existing=True,
     ):
+        clump_sizes = (
+            clump_size if isinstance(clump_size, (list, tuple)) else [clump_size]
+        )
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
             file_name = file.split("/")[-1].split(".phs")[0]
             try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
+                events = events_in_range(
+                    lambda path: ps.SimulationReader(
+                        photon_stream_path=path, mmcs_corsika_path=mc_truth
+                    ),
+                    file,
+                    event_range,
+                    self.range_directory,
                 )
-                counter = 0
-                for event in sim_reader:
-                    counter += 1
+                for counter, event in events:
 
-                    if os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "clump" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
+                    if check_existing and self.is_converted(
+                        directory, str(file_name) + "_" + str(counter), clump_sizes
                     ):
                         print("True: " + str(file_name) + "_" + str(counter))
                         continue
 
                     if clean_images:
                         # Do it for no clumps, all clump, and only core into different subfolders
-                        (
+                        # The uncleaned event is written once, by the first clump size that found clumps
+                        no_clean = None
+                        for clump_size, (
                             all_photons,
                             clump_photons,
                             core_photons,
                             dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
-                        )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        for key, photon_set in {
-                            "no_clean": all_photons,
-                            "clump": clump_photons,
-                            "core": core_photons,
-                        }.items():
-                            event.photon_stream.raw = photon_set
-                            # Extract parameters from the file
-                            features, cluster = extract_single_simulation_features(
-                                event, min_samples=1
-                            )
-                            # In the event chosen from the file
-                            # Each event is the same as each line below
-                            energy = event.simulation_truth.air_shower.energy
-                            event_photons = event.photon_stream.list_of_lists
-                            zd_deg = event.zd
-                            az_deg = event.az
-                            act_phi = event.simulation_truth.air_shower.phi
-                            act_theta = event.simulation_truth.air_shower.theta
-                            data_dict = [
-                                [
-                                    event_photons,
-                                    energy,
-                                    zd_deg,
-                                    az_deg,
-                                    act_phi,
-                                    act_theta,
-                                ],
-                                {
-                                    "Image": 0,
-                                    "Energy": 1,
-                                    "Zd_Deg": 2,
-                                    "Az_Deg": 3,
-                                    "Phi": 4,
-                                    "Theta": 5,
-                                },
-                                features,
-                                cluster,
-                            ]
-                            if key != "no_clean":
-                                with open(
-                                    os.path.join(
-                                        directory,
-                                        key + str(clump_size),
-                                        str(file_name) + "_" + str(counter),
-                                    ),
-                                    "wb",
-                                ) as event_file:
-                                    pickle.dump(data_dict, event_file)
-                            else:
-                                if not os.path.isfile(
-                                    os.path.join(
-                                        directory,
-                                        key,
-                                        str(file_name) + "_" + str(counter),
-                                    )
-                                ):
-                                    with open(
+                        ) in self.clean_image_sizes(event, clump_sizes).items():
+                            if core_photons is None:
+                                print("No Clumps, skip")
+                                continue
+                            photon_sets = {"clump": clump_photons, "core": core_photons}
+                            if no_clean is None:
+                                photon_sets = dict(no_clean=all_photons, **photon_sets)
+                            for key, photon_set in photon_sets.items():
+                                event.photon_stream.raw = photon_set
+                                # Extract parameters from the file
+                                features, cluster = extract_single_simulation_features(
+                                    event, min_samples=1
+                                )
+                                # In the event chosen from the file
+                                # Each event is the same as each line below
+                                energy = event.simulation_truth.air_shower.energy
+                                event_photons = event.photon_stream.list_of_lists
+                                zd_deg = event.zd
+                                az_deg = event.az
+                                act_phi = event.simulation_truth.air_shower.phi
+                                act_theta = event.simulation_truth.air_shower.theta
+                                data_dict = [
+                                    [
+                                        event_photons,
+                                        energy,
+                                        zd_deg,
+                                        az_deg,
+                                        act_phi,
+                                        act_theta,
+                                    ],
+                                    {
+                                        "Image": 0,
+                                        "Energy": 1,
+                                        "Zd_Deg": 2,
+                                        "Az_Deg": 3,
+                                        "Phi": 4,
+                                        "Theta": 5,
+                                    },
+                                    features,
+                                    cluster,
+                                ]
+                                if key != "no_clean":
+                                    self.save_event(
                                         os.path.join(
                                             directory,
-                                            key,
+                                            key + str(clump_size),
                                             str(file_name) + "_" + str(counter),
                                         ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
+                                        data_dict,
+                                        packed,
+                                    )
+                                else:
+                                    no_clean = data_dict
+                        if no_clean is not None and (
+                            not check_existing
+                            or not os.path.isfile(
+                                os.path.join(
+                                    directory,
+                                    "no_clean",
+                                    str(file_name) + "_" + str(counter),
+                                )
+                            )
+                        ):
+                            self.save_event(
+                                os.path.join(
+                                    directory,
+                                    "no_clean",
+                                    str(file_name) + "_" + str(counter),
+                                ),
+                                no_clean,
+                                packed,
+                            )
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -450,16 +436,21 @@ class ProtonPreprocessor(BasePreprocessor):
                             features,
                             cluster,
                         ]
-                        with open(
+                        self.save_event(
                             os.path.join(
                                 directory, str(file_name) + "_" + str(counter)
                             ),
-                            "wb",
-                        ) as event_file:
-                            pickle.dump(data_dict, event_file)
+                            data_dict,
+                            packed,
+                        )
             except Exception as e:
+                if event_range is not None:
+                    # Raised so convert_events converts the range again instead of recording it as done
+                    self.close_event_stores()
+                    raise
                 print(str(e))
                 pass
+        self.close_event_stores()
 
     def batch_processor(self, clean_images=False, only_core=True):
         for index, file in enumerate(self.paths):
@@ -484,22 +475,10 @@ class ProtonPreprocessor(BasePreprocessor):
                     az_deg = event.az
                     act_phi = event.simulation_truth.air_shower.phi
                     act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
+                    input_matrix = self.rebin_photons(event_photons)
                     data.append(
                         [
-                            np.fliplr(np.rot90(input_matrix, 3)),
+                            input_matrix,
                             energy,
                             zd_deg,
                             az_deg,
@@ -546,22 +525,10 @@ class ProtonPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
+                        input_matrix = self.rebin_photons(event_photons)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -626,113 +593,125 @@ class ProtonPreprocessor(BasePreprocessor):
 
 class GammaPreprocessor(BasePreprocessor):
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        clump_size=20,
+        packed=False,
+        event_range=None,
+        check_existing=True,
     ):
+        clump_sizes = (
+            clump_size if isinstance(clump_size, (list, tuple)) else [clump_size]
+        )
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
             file_name = file.split("/")[-1].split(".phs")[0]
             try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
+                events = events_in_range(
+                    lambda path: ps.SimulationReader(
+                        photon_stream_path=path, mmcs_corsika_path=mc_truth
+                    ),
+                    file,
+                    event_range,
+                    self.range_directory,
                 )
-                counter = 0
-                for event in sim_reader:
-                    counter += 1
+                for counter, event in events:
 
-                    if os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "clump" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
-                    ) and os.path.isfile(
-                        os.path.join(
-                            directory,
-                            "core" + str(clump_size),
-                            str(file_name) + "_" + str(counter),
-                        )
+                    if check_existing and self.is_converted(
+                        directory, str(file_name) + "_" + str(counter), clump_sizes
                     ):
                         print("True: " + str(file_name) + "_" + str(counter))
                         continue
 
                     if clean_images:
                         # Do it for no clumps, all clump, and only core into different subfolders
-                        (
+                        # The uncleaned event is written once, by the first clump size that found clumps
+                        no_clean = None
+                        for clump_size, (
                             all_photons,
                             clump_photons,
                             core_photons,
                             dbscan,
-                        ) = self.clean_image(
-                            event, only_core=only_core, min_samples=clump_size
-                        )
-                        if core_photons is None:
-                            print("No Clumps, skip")
-                            continue
-                        else:
-                            for key, photon_set in {
-                                "no_clean": all_photons,
-                                "clump": clump_photons,
-                                "core": core_photons,
-                            }.items():
-                                event.photon_stream.raw = photon_set
-                                features, cluster = extract_single_simulation_features(
-                                    event, min_samples=1
-                                )
-                                # In the event chosen from the file
-                                # Each event is the same as each line below
-                                energy = event.simulation_truth.air_shower.energy
-                                event_photons = event.photon_stream.list_of_lists
-                                zd_deg = event.zd
-                                az_deg = event.az
-                                act_phi = event.simulation_truth.air_shower.phi
-                                act_theta = event.simulation_truth.air_shower.theta
-                                data_dict = [
-                                    [
-                                        event_photons,
-                                        energy,
-                                        zd_deg,
-                                        az_deg,
-                                        act_phi,
-                                        act_theta,
-                                    ],
-                                    {
-                                        "Image": 0,
-                                        "Energy": 1,
-                                        "Zd_Deg": 2,
-                                        "Az_Deg": 3,
-                                        "Phi": 4,
-                                        "Theta": 5,
-                                    },
-                                    features,
-                                    cluster,
-                                ]
-                                if key != "no_clean":
-                                    with open(
-                                        os.path.join(
-                                            directory,
-                                            key + str(clump_size),
-                                            str(file_name) + "_" + str(counter),
-                                        ),
-                                        "wb",
-                                    ) as event_file:
-                                        pickle.dump(data_dict, event_file)
-                                else:
-                                    if not os.path.isfile(
-                                        os.path.join(
-                                            directory,
-                                            key,
-                                            str(file_name) + "_" + str(counter),
+                        ) in self.clean_image_sizes(event, clump_sizes).items():
+                            if core_photons is None:
+                                print("No Clumps, skip")
+                                continue
+                            else:
+                                photon_sets = {
+                                    "clump": clump_photons,
+                                    "core": core_photons,
+                                }
+                                if no_clean is None:
+                                    photon_sets = dict(
+                                        no_clean=all_photons, **photon_sets
+                                    )
+                                for key, photon_set in photon_sets.items():
+                                    event.photon_stream.raw = photon_set
+                                    features, cluster = (
+                                        extract_single_simulation_features(
+                                            event, min_samples=1
                                         )
-                                    ):
-                                        with open(
+                                    )
+                                    # In the event chosen from the file
+                                    # Each event is the same as each line below
+                                    energy = event.simulation_truth.air_shower.energy
+                                    event_photons = event.photon_stream.list_of_lists
+                                    zd_deg = event.zd
+                                    az_deg = event.az
+                                    act_phi = event.simulation_truth.air_shower.phi
+                                    act_theta = event.simulation_truth.air_shower.theta
+                                    data_dict = [
+                                        [
+                                            event_photons,
+                                            energy,
+                                            zd_deg,
+                                            az_deg,
+                                            act_phi,
+                                            act_theta,
+                                        ],
+                                        {
+                                            "Image": 0,
+                                            "Energy": 1,
+                                            "Zd_Deg": 2,
+                                            "Az_Deg": 3,
+                                            "Phi": 4,
+                                            "Theta": 5,
+                                        },
+                                        features,
+                                        cluster,
+                                    ]
+                                    if key != "no_clean":
+                                        self.save_event(
                                             os.path.join(
                                                 directory,
-                                                key,
+                                                key + str(clump_size),
                                                 str(file_name) + "_" + str(counter),
                                             ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
+                                            data_dict,
+                                            packed,
+                                        )
+                                    else:
+                                        no_clean = data_dict
+                            if no_clean is not None and (
+                                not check_existing
+                                or not os.path.isfile(
+                                    os.path.join(
+                                        directory,
+                                        "no_clean",
+                                        str(file_name) + "_" + str(counter),
+                                    )
+                                )
+                            ):
+                                self.save_event(
+                                    os.path.join(
+                                        directory,
+                                        "no_clean",
+                                        str(file_name) + "_" + str(counter),
+                                    ),
+                                    no_clean,
+                                    packed,
+                                )
                     else:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -756,16 +735,21 @@ class GammaPreprocessor(BasePreprocessor):
                             features,
                             cluster,
                         ]
-                        with open(
+                        self.save_event(
                             os.path.join(
                                 directory, str(file_name) + "_" + str(counter)
                             ),
-                            "wb",
-                        ) as event_file:
-                            pickle.dump(data_dict, event_file)
+                            data_dict,
+                            packed,
+                        )
             except Exception as e:
+                if event_range is not None:
+                    # Raised so convert_events converts the range again instead of recording it as done
+                    self.close_event_stores()
+                    raise
                 print(str(e))
                 pass
+        self.close_event_stores()
 
     def batch_processor(self, clean_images=False):
         for index, file in enumerate(self.paths):
@@ -789,22 +773,10 @@ class GammaPreprocessor(BasePreprocessor):
                     az_deg = event.az
                     act_phi = event.simulation_truth.air_shower.phi
                     act_theta = event.simulation_truth.air_shower.theta
-                    input_matrix = np.zeros(
-                        [self.shape[1], self.shape[2], self.shape[3]]
-                    )
-                    chid_to_pixel = self.rebinning[0]
-                    pixel_index_to_grid = self.rebinning[1]
-                    for index in range(1440):
-                        for element in chid_to_pixel[index]:
-                            coords = pixel_index_to_grid[element[0]]
-                            for value in event_photons[index]:
-                                if self.end >= value >= self.start:
-                                    input_matrix[coords[0]][coords[1]][
-                                        value - self.start
-                                    ] += (element[1] * 1)
+                    input_matrix = self.rebin_photons(event_photons)
                     data.append(
                         [
-                            np.fliplr(np.rot90(input_matrix, 3)),
+                            input_matrix,
                             energy,
                             zd_deg,
                             az_deg,
@@ -849,22 +821,10 @@ class GammaPreprocessor(BasePreprocessor):
                         az_deg = event.az
                         act_phi = event.simulation_truth.air_shower.phi
                         act_theta = event.simulation_truth.air_shower.theta
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 100)
+                        input_matrix = self.rebin_photons(event_photons, weight=100)
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 energy,
                                 zd_deg,
                                 az_deg,
@@ -948,161 +908,203 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                 "run_id",
             ],
         )
+        # Sorted by run and energy, so events are matched with a binary search instead of a scan of the whole file
+        run_ids = self.dl2_file["run_id"].values
+        energies = self.dl2_file["corsika_event_header_total_energy"].values
+        self.dl2_order = np.lexsort((energies, run_ids))
+        self.dl2_run_ids = run_ids[self.dl2_order]
+        self.dl2_energies = energies[self.dl2_order]
+
+    def dl2_event(self, event):
+        """
+        Finds the DL2 row of a simulated event, the first row of its run with an energy np.isclose to its energy
+
+        :param event: Photon stream simulation event
+        :return: DataFrame with the matching row, empty if the event is not in the DL2 file
+        """
+        energy = event.simulation_truth.air_shower.energy
+        run_start, run_end = (
+            np.searchsorted(self.dl2_run_ids, event.simulation_truth.run, side=side)
+            for side in ("left", "right")
+        )
+        # Wider than the np.isclose tolerance, the candidates are then checked with np.isclose itself
+        tolerance = 1e-8 + 2e-5 * abs(energy)
+        run_energies = self.dl2_energies[run_start:run_end]
+        start = np.searchsorted(run_energies, energy - tolerance, side="left")
+        end = np.searchsorted(run_energies, energy + tolerance, side="right")
+        candidates = self.dl2_order[run_start + start : run_start + end][
+            np.isclose(run_energies[start:end], energy)
+        ]
+        # Past the last row when there is no match, which gives an empty DataFrame
+        row = candidates.min() if len(candidates) else len(self.dl2_file)
+        return self.dl2_file.iloc[row : row + 1]
 
     def event_processor(
-        self, directory, clean_images=False, only_core=True, clump_size=20
+        self,
+        directory,
+        clean_images=False,
+        clump_size=20,
+        packed=False,
+        event_range=None,
+        check_existing=True,
     ):
+        clump_sizes = (
+            clump_size if isinstance(clump_size, (list, tuple)) else [clump_size]
+        )
         for index, file in enumerate(self.paths):
             mc_truth = file.split(".phs")[0] + ".ch.gz"
             file_name = file.split("/")[-1].split(".phs")[0]
             try:
-                sim_reader = ps.SimulationReader(
-                    photon_stream_path=file, mmcs_corsika_path=mc_truth
+                events = events_in_range(
+                    lambda path: ps.SimulationReader(
+                        photon_stream_path=path, mmcs_corsika_path=mc_truth
+                    ),
+                    file,
+                    event_range,
+                    self.range_directory,
                 )
-                counter = 0
-                for event in sim_reader:
+                for counter, event in events:
                     print(f"Event Count: {counter}")
-                    df_event = self.dl2_file.loc[
-                        (
-                            np.isclose(
-                                self.dl2_file["corsika_event_header_total_energy"],
-                                event.simulation_truth.air_shower.energy,
-                            )
-                        )
-                        & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                    ]
-                    counter += 1
+                    df_event = self.dl2_event(event)
                     if not df_event.empty:
-                        if os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "clump" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
-                            )
-                        ) and os.path.isfile(
-                            os.path.join(
-                                directory,
-                                "core" + str(clump_size),
-                                str(file_name) + "_" + str(counter),
-                            )
+                        if check_existing and self.is_converted(
+                            directory, str(file_name) + "_" + str(counter), clump_sizes
                         ):
                             print("True: " + str(file_name) + "_" + str(counter))
                             continue
 
                         if clean_images:
-                            (
+                            # The uncleaned event is written once, by the first clump size that found clumps
+                            no_clean = None
+                            for clump_size, (
                                 all_photons,
                                 clump_photons,
                                 core_photons,
                                 dbscan,
-                            ) = self.clean_image(
-                                event, only_core=only_core, min_samples=clump_size
-                            )
-                            if core_photons is None:
-                                print("No Clumps, skip")
-                                continue
-                            else:
-                                for key, photon_set in {
-                                    "no_clean": all_photons,
-                                    "clump": clump_photons,
-                                    "core": core_photons,
-                                }.items():
-                                    event.photon_stream.raw = photon_set
-                                    # Now extract parameters from the available photons and save them to a file
-                                    features = extract_single_simulation_features(
-                                        event, min_samples=1
-                                    )
-                                    # In the event chosen from the file
-                                    # Each event is the same as each line below
-                                    cog_x = df_event["cog_x"].values[0]
-                                    cog_y = df_event["cog_y"].values[0]
-                                    act_sky_source_zero = df_event[
-                                        "source_position_x"
-                                    ].values[0]
-                                    act_sky_source_one = df_event[
-                                        "source_position_y"
-                                    ].values[0]
-                                    event_photons = event.photon_stream.list_of_lists
-                                    zd_deg = event.zd
-                                    az_deg = event.az
-                                    delta = df_event["delta"].values[0]
-                                    energy = event.simulation_truth.air_shower.energy
-                                    sky_source_zd = df_event[
-                                        "source_position_zd"
-                                    ].values[0]
-                                    sky_source_az = df_event[
-                                        "source_position_az"
-                                    ].values[0]
-                                    zd_deg1 = df_event[
-                                        "aux_pointing_position_az"
-                                    ].values[0]
-                                    az_deg1 = df_event[
-                                        "aux_pointing_position_zd"
-                                    ].values[0]
-                                    data_dict = [
-                                        [
-                                            event_photons,
-                                            act_sky_source_zero,
-                                            act_sky_source_one,
-                                            cog_x,
-                                            cog_y,
-                                            zd_deg,
-                                            az_deg,
-                                            sky_source_zd,
-                                            sky_source_az,
-                                            delta,
-                                            energy,
-                                            zd_deg1,
-                                            az_deg1,
-                                        ],
-                                        {
-                                            "Image": 0,
-                                            "Source_X": 1,
-                                            "Source_Y": 2,
-                                            "COG_X": 3,
-                                            "COG_Y": 4,
-                                            "Zd_Deg": 5,
-                                            "Az_Deg": 6,
-                                            "Source_Zd": 7,
-                                            "Source_Az": 8,
-                                            "Delta": 9,
-                                            "Energy": 10,
-                                            "Pointing_Zd": 11,
-                                            "Pointing_Az": 12,
-                                        },
-                                        features,
-                                    ]
-                                    if key != "no_clean":
-                                        with open(
-                                            os.path.join(
-                                                directory,
-                                                key + str(clump_size),
-                                                str(file_name) + "_" + str(counter),
-                                            ),
-                                            "wb",
-                                        ) as event_file:
-                                            pickle.dump(data_dict, event_file)
-                                    else:
-                                        if not os.path.isfile(
-                                            os.path.join(
-                                                directory,
-                                                key,
-                                                str(file_name) + "_" + str(counter),
-                                            )
-                                        ):
-                                            with open(
+                            ) in self.clean_image_sizes(event, clump_sizes).items():
+                                if core_photons is None:
+                                    print("No Clumps, skip")
+                                    continue
+                                else:
+                                    photon_sets = {
+                                        "clump": clump_photons,
+                                        "core": core_photons,
+                                    }
+                                    if no_clean is None:
+                                        photon_sets = dict(
+                                            no_clean=all_photons, **photon_sets
+                                        )
+                                    for key, photon_set in photon_sets.items():
+                                        event.photon_stream.raw = photon_set
+                                        # Now extract parameters from the available photons and save them to a file
+                                        (
+                                            features,
+                                            cluster,
+                                        ) = extract_single_simulation_features(
+                                            event, min_samples=1
+                                        )
+                                        # In the event chosen from the file
+                                        # Each event is the same as each line below
+                                        cog_x = df_event["cog_x"].values[0]
+                                        cog_y = df_event["cog_y"].values[0]
+                                        act_sky_source_zero = df_event[
+                                            "source_position_x"
+                                        ].values[0]
+                                        act_sky_source_one = df_event[
+                                            "source_position_y"
+                                        ].values[0]
+                                        event_photons = (
+                                            event.photon_stream.list_of_lists
+                                        )
+                                        zd_deg = event.zd
+                                        az_deg = event.az
+                                        delta = df_event["delta"].values[0]
+                                        energy = (
+                                            event.simulation_truth.air_shower.energy
+                                        )
+                                        sky_source_zd = df_event[
+                                            "source_position_zd"
+                                        ].values[0]
+                                        sky_source_az = df_event[
+                                            "source_position_az"
+                                        ].values[0]
+                                        zd_deg1 = df_event[
+                                            "aux_pointing_position_az"
+                                        ].values[0]
+                                        az_deg1 = df_event[
+                                            "aux_pointing_position_zd"
+                                        ].values[0]
+                                        data_dict = [
+                                            [
+                                                event_photons,
+                                                act_sky_source_zero,
+                                                act_sky_source_one,
+                                                cog_x,
+                                                cog_y,
+                                                zd_deg,
+                                                az_deg,
+                                                sky_source_zd,
+                                                sky_source_az,
+                                                delta,
+                                                energy,
+                                                zd_deg1,
+                                                az_deg1,
+                                            ],
+                                            {
+                                                "Image": 0,
+                                                "Source_X": 1,
+                                                "Source_Y": 2,
+                                                "COG_X": 3,
+                                                "COG_Y": 4,
+                                                "Zd_Deg": 5,
+                                                "Az_Deg": 6,
+                                                "Source_Zd": 7,
+                                                "Source_Az": 8,
+                                                "Delta": 9,
+                                                "Energy": 10,
+                                                "Pointing_Zd": 11,
+                                                "Pointing_Az": 12,
+                                            },
+                                            features,
+                                            cluster,
+                                        ]
+                                        if key != "no_clean":
+                                            self.save_event(
                                                 os.path.join(
                                                     directory,
-                                                    key,
+                                                    key + str(clump_size),
                                                     str(file_name) + "_" + str(counter),
                                                 ),
-                                                "wb",
-                                            ) as event_file:
-                                                pickle.dump(data_dict, event_file)
+                                                data_dict,
+                                                packed,
+                                            )
+                                        else:
+                                            no_clean = data_dict
+                                if no_clean is not None and (
+                                    not check_existing
+                                    or not os.path.isfile(
+                                        os.path.join(
+                                            directory,
+                                            "no_clean",
+                                            str(file_name) + "_" + str(counter),
+                                        )
+                                    )
+                                ):
+                                    self.save_event(
+                                        os.path.join(
+                                            directory,
+                                            "no_clean",
+                                            str(file_name) + "_" + str(counter),
+                                        ),
+                                        no_clean,
+                                        packed,
+                                    )
                         else:
                             # In the event chosen from the file
                             # Each event is the same as each line below
-                            features = extract_single_simulation_features(event)
+                            features, cluster = extract_single_simulation_features(
+                                event
+                            )
                             cog_x = df_event["cog_x"].values[0]
                             cog_y = df_event["cog_y"].values[0]
                             act_sky_source_zero = df_event["source_position_x"].values[
@@ -1150,17 +1152,23 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                                     "Pointing_Az": 12,
                                 },
                                 features,
+                                cluster,
                             ]
-                            with open(
+                            self.save_event(
                                 os.path.join(
                                     directory, str(file_name) + "_" + str(counter)
                                 ),
-                                "wb",
-                            ) as event_file:
-                                pickle.dump(data_dict, event_file)
+                                data_dict,
+                                packed,
+                            )
             except Exception as e:
+                if event_range is not None:
+                    # Raised so convert_events converts the range again instead of recording it as done
+                    self.close_event_stores()
+                    raise
                 print(str(e))
                 pass
+        self.close_event_stores()
 
     def batch_processor(self, clean_images=False):
         for index, file in enumerate(self.paths):
@@ -1171,15 +1179,7 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                 )
                 data = []
                 for event in sim_reader:
-                    df_event = self.dl2_file.loc[
-                        (
-                            np.isclose(
-                                self.dl2_file["corsika_event_header_total_energy"],
-                                event.simulation_truth.air_shower.energy,
-                            )
-                        )
-                        & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                    ]
+                    df_event = self.dl2_event(event)
                     if not df_event.empty:
                         # In the event chosen from the file
                         # Each event is the same as each line below
@@ -1196,24 +1196,11 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                         sky_source_az = df_event["source_position_az"].values[0]
                         zd_deg1 = df_event["aux_pointing_position_az"].values[0]
                         az_deg1 = df_event["aux_pointing_position_zd"].values[0]
-                        input_matrix = np.zeros(
-                            [self.shape[1], self.shape[2], self.shape[3]]
-                        )
-                        chid_to_pixel = self.rebinning[0]
-                        pixel_index_to_grid = self.rebinning[1]
-                        for index in range(1440):
-                            for element in chid_to_pixel[index]:
-                                # Now get the first 60 event photons
-                                coords = pixel_index_to_grid[element[0]]
-                                for value in event_photons[index]:
-                                    if self.end >= value >= self.start:
-                                        input_matrix[coords[0]][coords[1]][
-                                            value - self.start
-                                        ] += (element[1] * 1)
+                        input_matrix = self.rebin_photons(event_photons)
 
                         data.append(
                             [
-                                np.fliplr(np.rot90(input_matrix, 3)),
+                                input_matrix,
                                 act_sky_source_zero,
                                 act_sky_source_one,
                                 cog_x,
@@ -1251,15 +1238,7 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                     )
                     for event in sim_reader:
                         data = []
-                        df_event = self.dl2_file.loc[
-                            (
-                                np.isclose(
-                                    self.dl2_file["corsika_event_header_total_energy"],
-                                    event.simulation_truth.air_shower.energy,
-                                )
-                            )
-                            & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                        ]
+                        df_event = self.dl2_event(event)
                         if not df_event.empty:
                             if clean_images:
                                 event = self.clean_image(event)
@@ -1283,23 +1262,10 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                             sky_source_az = df_event["source_position_zd"].values[0]
                             zd_deg1 = df_event["aux_pointing_position_az"].values[0]
                             az_deg1 = df_event["aux_pointing_position_zd"].values[0]
-                            input_matrix = np.zeros(
-                                [self.shape[1], self.shape[2], self.shape[3]]
-                            )
-                            chid_to_pixel = self.rebinning[0]
-                            pixel_index_to_grid = self.rebinning[1]
-                            for index in range(1440):
-                                for element in chid_to_pixel[index]:
-                                    # Now get the first 60 event photons
-                                    coords = pixel_index_to_grid[element[0]]
-                                    for value in event_photons[index]:
-                                        if self.end >= value >= self.start:
-                                            input_matrix[coords[0]][coords[1]][
-                                                value - self.start
-                                            ] += (element[1] * 1)
+                            input_matrix = self.rebin_photons(event_photons)
                             data.append(
                                 [
-                                    np.fliplr(np.rot90(input_matrix, 3)),
+                                    input_matrix,
                                     act_sky_source_zero,
                                     act_sky_source_one,
                                     cog_x,
@@ -1358,15 +1324,7 @@ class GammaDiffusePreprocessor(BasePreprocessor):
                         photon_stream_path=file, mmcs_corsika_path=mc_truth
                     )
                     for event in sim_reader:
-                        df_event = self.dl2_file.loc[
-                            (
-                                np.isclose(
-                                    self.dl2_file["corsika_event_header_total_energy"],
-                                    event.simulation_truth.air_shower.energy,
-                                )
-                            )
-                            & (self.dl2_file["run_id"] == event.simulation_truth.run)
-                        ]
+                        df_event = self.dl2_event(event)
                         if not df_event.empty:
                             count += 1
                 except Exception as e:
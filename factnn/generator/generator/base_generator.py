@@ -1,7 +1,10 @@
 from factnn.utils.augment import (
+    ChunkShuffler,
     get_random_from_list,
+    get_random_from_chunks,
     get_chunk_from_list,
     get_random_from_paths,
+    hdf5_dataset,
 )
 import numpy as np
 
@@ -79,6 +82,17 @@ class BaseGenerator(object):
         else:
             self.chunked = False
 
+        # Whether training batches are drawn a chunk of the HDF5 file at a time, by a ChunkShuffler
+        if "chunk_shuffle" in config:
+            self.chunk_shuffle = config["chunk_shuffle"]
+        else:
+            self.chunk_shuffle = False
+        if "shuffle_buffer" in config:
+            self.shuffle_buffer = config["shuffle_buffer"]
+        else:
+            self.shuffle_buffer = None
+        self.chunk_shuffler = None
+
         if "verbose" in config:
             self.verbose = config["verbose"]
         else:
@@ -118,7 +132,28 @@ class BaseGenerator(object):
         """
         if not self.from_directory:
             while True:
-                if self.mode == "train":
+                if self.mode == "train" and self.chunk_shuffle:
+                    if self.chunk_shuffler is None:
+                        chunks = hdf5_dataset(self.input).chunks
+                        self.chunk_shuffler = ChunkShuffler(
+                            self.train_data,
+                            chunk_rows=chunks[0] if chunks is not None else 1,
+                            buffer_size=self.shuffle_buffer,
+                            seed=getattr(self, "seed", None),
+                        )
+                    batch_images, batch_image_label = get_random_from_chunks(
+                        self.chunk_shuffler,
+                        size=self.batch_size,
+                        time_slice=self.start_slice,
+                        total_slices=self.number_slices,
+                        labels=self.labels,
+                        augment=self.augment,
+                        gamma=self.input,
+                        proton_input=self.second_input,
+                        shape=self.input_shape,
+                    )
+                    return batch_images, batch_image_label
+                elif self.mode == "train":
                     batch_images, batch_image_label = get_random_from_list(
                         self.train_data,
                         size=self.batch_size,
@@ -0,0 +1,161 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def path_groups(preprocessor, paths):
+    """
+    Groups the events by the file they are read from, the shard of the event store of the preprocessor, or the
+    directory of the event files
+    :param preprocessor: EventFilePreprocessor the events are read with
+    :param paths: Paths of the event files, or names of the events in the event store
+    :return: List of the list of paths of each group, in the order they are first seen
+    """
+    groups = {}
+    for path in paths:
+        if preprocessor.event_store is not None:
+            group = preprocessor.event_store.locate(path)[0]
+        else:
+            group = os.path.dirname(path)
+        groups.setdefault(group, []).append(path)
+    return list(groups.values())
+
+
+def path_dataset(preprocessor, paths, cycle_length=4, shuffle=False, seed=None):
+    """
+    Dataset of the paths of the events, interleaving cycle_length files at a time, so each batch reads from a few
+    shards of the event store instead of all of them
+    :param preprocessor: EventFilePreprocessor the events are read with
+    :param paths: Paths of the event files, or names of the events in the event store
+    :param cycle_length: Number of files to interleave the events of
+    :param shuffle: Whether to shuffle the files and the events every epoch
+    :param seed: Seed of the shuffling
+    :return: tf.data.Dataset of the paths
+    """
+    groups = tf.ragged.constant(
+        [[str(path) for path in group] for group in path_groups(preprocessor, paths)]
+    )
+    dataset = tf.data.Dataset.from_tensor_slices(groups)
+    if shuffle:
+        dataset = dataset.shuffle(
+            groups.nrows(), seed=seed, reshuffle_each_iteration=True
+        )
+    dataset = dataset.interleave(
+        tf.data.Dataset.from_tensor_slices,
+        cycle_length=cycle_length,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=not shuffle,
+    )
+    if shuffle:
+        # Mixes the events of the interleaved files over more than one batch
+        dataset = dataset.shuffle(
+            16 * cycle_length, seed=seed, reshuffle_each_iteration=True
+        )
+    return dataset
+
+
+def augment_images(images, labels, as_channels=False):
+    """
+    Flips and rotates each image of a batch at random, with the same chances as image_augmenter, and shuffles the
+    batch, as tensor ops over the whole batch
+    :param images: Batch of images, (batch_size, time slices, x, y, 1), or (batch_size, x, y, channels) as channels
+    :param labels: Labels of the images
+    :param as_channels: Whether the time slices are the channels
+    :return: (images, labels)
+    """
+    x_axis, y_axis = (1, 2) if as_channels else (2, 3)
+    batch_size = tf.shape(images)[0]
+    rank = len(images.shape)
+
+    def where(condition, changed, images):
+        return tf.where(tf.reshape(condition, [-1] + [1] * (rank - 1)), changed, images)
+
+    flip_x = tf.random.uniform([batch_size]) < 0.5
+    images = where(flip_x, tf.reverse(images, [x_axis]), images)
+    flip_y = tf.random.uniform([batch_size]) < 0.5
+    images = where(flip_y, tf.reverse(images, [y_axis]), images)
+    # Swapping the x and y axes after or before flipping y is the same as np.rot90 by 90 or 270 degrees
+    swap_axes = list(range(rank))
+    swap_axes[x_axis], swap_axes[y_axis] = y_axis, x_axis
+    rotation = tf.random.uniform([batch_size])
+    rotated_90 = tf.transpose(tf.reverse(images, [y_axis]), swap_axes)
+    rotated_270 = tf.reverse(tf.transpose(images, swap_axes), [y_axis])
+    images = where(rotation < 0.3, rotated_90, images)
+    images = where(rotation > 0.7, rotated_270, images)
+    order = tf.random.shuffle(tf.range(batch_size))
+    return tf.gather(images, order), tf.gather(labels, order)
+
+
+def event_file_dataset(generator, shuffle=False, cycle_length=4, seed=None):
+    """
+    Builds a tf.data.Dataset of the batches of an EventFileGenerator, for Keras fit instead of the Sequence
+
+    The paths are interleaved over the files they are read from, batched, and built into images by the rebinning of
+    the preprocessors, one batch per call, with as many calls in parallel as tf.data tunes them to. The augmentation
+    runs as tensor ops, and batches are prefetched while the model trains
+
+    :param generator: EventFileGenerator with the paths, preprocessors and options of the batches, without
+    return_collapsed and return_features
+    :param shuffle: Whether to shuffle the events every epoch
+    :param cycle_length: Number of files to interleave the events of
+    :param seed: Seed of the shuffling
+    :return: tf.data.Dataset of (images, labels) batches, one pass over the events per epoch
+    """
+    if generator.multiple:
+        raise ValueError(
+            "return_collapsed and return_features are not supported for tf.data"
+        )
+    batches = path_dataset(
+        generator.preprocessor, generator.paths, cycle_length, shuffle, seed
+    ).batch(generator.batch_size)
+    if generator.proton_paths is not None:
+        proton_batches = path_dataset(
+            generator.proton_preprocessor,
+            generator.proton_paths,
+            cycle_length,
+            shuffle,
+            seed,
+        ).batch(generator.batch_size)
+        batches = tf.data.Dataset.zip((batches, proton_batches))
+    else:
+        batches = batches.map(lambda paths: (paths, tf.constant([], dtype=tf.string)))
+
+    def load_batch(paths, proton_paths):
+        paths = [path.decode() for path in paths]
+        proton_paths = (
+            [path.decode() for path in proton_paths]
+            if generator.proton_paths is not None
+            else None
+        )
+        images, labels = generator.load_batch(paths, proton_paths, augment=False)
+        return np.asarray(images, dtype=np.float32), np.asarray(
+            labels, dtype=np.float32
+        )
+
+    # The shapes of the images and labels are taken from a first batch, as the numpy function does not give them
+    first_images, first_labels = load_batch(
+        *next(iter(batches.take(1).as_numpy_iterator()))
+    )
+
+    def build_batch(paths, proton_paths):
+        images, labels = tf.numpy_function(
+            load_batch, [paths, proton_paths], [tf.float32, tf.float32]
+        )
+        images.set_shape((None,) + first_images.shape[1:])
+        labels.set_shape((None,) + first_labels.shape[1:])
+        return images, labels
+
+    dataset = batches.map(
+        build_batch,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=not shuffle,
+    )
+    if generator.augment:
+        dataset = dataset.map(
+            lambda images, labels: augment_images(
+                images, labels, generator.as_channels
+            ),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        )
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -65,6 +65,19 @@ class EventFileGenerator(Sequence):
             proton_batch_files = self.proton_paths[
                 index * self.batch_size : (index + 1) * self.batch_size
             ]
+        else:
+            proton_batch_files = None
+        return self.load_batch(batch_files, proton_batch_files, augment=self.augment)
+
+    def load_batch(self, batch_files, proton_batch_files=None, augment=False):
+        """
+        Builds the images and labels of a batch of event files
+        :param batch_files: Paths of the gamma events, or their names in the event store of the preprocessor
+        :param proton_batch_files: Paths of the proton events, None if there are no proton events
+        :param augment: Whether to flip, rotate and shuffle the images
+        :return: (images, labels) of the batch
+        """
+        if proton_batch_files is not None:
             proton_images = self.proton_preprocessor.on_files_processor(
                 paths=proton_batch_files,
                 final_slices=self.final_slices,
@@ -91,8 +104,8 @@ class EventFileGenerator(Sequence):
             images,
             proton_images=proton_images,
             type_training=self.training_type,
-            augment=self.augment,
-            swap=self.augment,
+            augment=augment,
+            swap=augment,
             shape=[
                 -1,
                 self.final_slices,
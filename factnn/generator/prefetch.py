@@ -0,0 +1,201 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Source of the batches of a worker process of a Prefetcher, set once by _init_worker instead of being sent with
+# every batch
+_worker_source = None
+
+
+class SharedArray(object):
+    """
+    A numpy array written to shared memory by a worker process, so only its name, shape and dtype are pickled
+    """
+
+    def __init__(self, array):
+        self.shape = array.shape
+        self.dtype = array.dtype
+        shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=shared_memory.buf)[...] = array
+        self.name = shared_memory.name
+        shared_memory.close()
+
+    def read(self):
+        """
+        Copies the array out of the shared memory and frees the shared memory
+        :return: The array
+        """
+        shared_memory = SharedMemory(name=self.name)
+        array = np.ndarray(self.shape, self.dtype, buffer=shared_memory.buf).copy()
+        shared_memory.close()
+        shared_memory.unlink()
+        return array
+
+
+def to_shared(batch):
+    """
+    Moves the numpy arrays of a batch to shared memory
+    :param batch: Array, or nested lists and tuples of arrays, such as (images, labels)
+    :return: The batch with each array replaced by a SharedArray
+    """
+    if isinstance(batch, np.ndarray):
+        return SharedArray(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_shared(item) for item in batch)
+    return batch
+
+
+def from_shared(batch):
+    """
+    Reads the arrays of a batch made by to_shared back out of shared memory
+    :param batch: Batch of SharedArrays
+    :return: The batch with each SharedArray replaced by its array
+    """
+    if isinstance(batch, SharedArray):
+        return batch.read()
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(from_shared(item) for item in batch)
+    return batch
+
+
+def _init_worker(source):
+    global _worker_source
+    _worker_source = source
+    # Forked workers would otherwise all draw the same random batches
+    np.random.seed()
+
+
+def _worker_batch(index):
+    if index is None:
+        return to_shared(next(_worker_source))
+    return to_shared(_worker_source[index])
+
+
+class Prefetcher(object):
+    """
+    Makes the batches of a Keras Sequence, or of an iterator such as a BaseGenerator, ahead of time with a pool of
+    threads or processes, holding up to depth ready batches, so training does not wait for the preprocessing
+
+    The batches of a Sequence are returned in order, calling its on_epoch_end after each pass over it, forever. With
+    processes, the workers are forked with their own copy of the source, so it is not pickled, and send the arrays of
+    the batches back through shared memory. They are forked again every epoch, after on_epoch_end. Iterators are
+    called by every worker process on its own copy, so only random batches, such as the training mode of a
+    BaseGenerator, should use more than one process
+
+    Pass iter(prefetcher) to Keras fit and evaluate, a Python generator of the batches, which Keras 3 requires
+    """
+
+    def __init__(self, source, depth=8, workers=4, processes=False):
+        """
+        :param source: Keras Sequence, anything with __getitem__ and __len__, or an iterator of batches
+        :param depth: Number of batches to make ahead
+        :param workers: Number of threads or processes making the batches
+        :param processes: Whether to make the batches in processes instead of threads
+        """
+        self.source = source
+        self.depth = depth
+        self.workers = workers
+        self.processes = processes
+        self.is_sequence = hasattr(source, "__getitem__") and hasattr(source, "__len__")
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = deque()
+        self.index = 0
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        while True:
+            try:
+                batch = next(self)
+            except StopIteration:
+                return
+            yield batch
+
+    def __next__(self):
+        self.fill()
+        batch = self.pending.popleft().result()
+        if self.processes:
+            batch = from_shared(batch)
+        if self.is_sequence and self.index == len(self.source) and not self.pending:
+            self.end_epoch()
+        self.fill()
+        return batch
+
+    def next(self):
+        return self.__next__()
+
+    def start(self):
+        if self.processes:
+            # Workers share the resource tracker of this process, which frees the shared memory they leave behind
+            resource_tracker.ensure_running()
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker,
+                initargs=(self.source,),
+            )
+        else:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def fill(self):
+        """
+        Starts making batches until depth batches are made or being made
+        """
+        if self.executor is None:
+            self.start()
+        while len(self.pending) < self.depth:
+            if not self.is_sequence:
+                index = None
+            elif self.index < len(self.source):
+                index = self.index
+                self.index += 1
+            else:
+                break
+            if self.processes:
+                self.pending.append(self.executor.submit(_worker_batch, index))
+            else:
+                self.pending.append(self.executor.submit(self.batch, index))
+
+    def batch(self, index):
+        if index is None:
+            with self.lock:
+                return next(self.source)
+        return self.source[index]
+
+    def end_epoch(self):
+        if hasattr(self.source, "on_epoch_end"):
+            self.source.on_epoch_end()
+        self.index = 0
+        if self.processes:
+            # The workers have the state of the source before on_epoch_end, such as the order of the paths
+            self.close()
+
+    def close(self):
+        """
+        Stops the workers, freeing the batches that were made ahead
+        """
+        if self.executor is None:
+            return
+        for future in self.pending:
+            if future.cancel() or not self.processes:
+                continue
+            try:
+                from_shared(future.result())
+            except Exception:
+                pass  # The batch failed, so it left no shared memory
+        self.pending.clear()
+        self.executor.shutdown()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
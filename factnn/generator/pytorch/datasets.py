@@ -4,24 +4,53 @@ import pickle
 import numpy as np
 from zlib import crc32
 import pkg_resources as res
+import copy
+from collections import OrderedDict
 from functools import partial
+from itertools import chain
+from queue import Full, Queue
+from threading import Event, Thread
 
 
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 
 import torch
+from torch.utils.data import IterableDataset, Sampler, get_worker_info
 from torch_geometric.data import Dataset
 from torch_geometric.data import Data
 
-from photon_stream.representations import (
-    list_of_lists_to_raw_phs,
-    raw_phs_to_point_cloud,
-)
-from photon_stream.geometry import GEOMETRY
 import photon_stream as ps
 
 
+from factnn.data.dataset.event_store import EventStore
 from factnn.utils.augment import euclidean_distance, true_sign
+from factnn.utils.phs import (
+    arrays_to_point_cloud,
+    in_photons,
+    photon_arrays,
+    raw_to_arrays,
+)
+
+
+# Function run by each worker process of imap_events, set once by _init_worker instead of being sent with every chunk
+_worker_function = None
+
+# Attribute of the processed events that is the label of each task
+TASK_LABELS = {
+    "energy": "energy",
+    "phi": "phi",
+    "theta": "theta",
+    "separation": "event_type",
+}
+
+# Split assignments of split_assignment in each split
+SPLIT_ASSIGNMENTS = {
+    "train": (0,),
+    "val": (1,),
+    "trainval": (0, 1),
+    "test": (2,),
+    "all": (0, 1, 2),
+}
 
 
 def to_list(x):
@@ -30,6 +59,531 @@ def to_list(x):
     return x
 
 
+def load_event(raw_dir, raw_path, event_store=None):
+    """
+    Loads one event, from the packed event store if there is one, otherwise from its pickled event file
+    :param raw_dir: Directory of the pickled event files
+    :param raw_path: Name of the event file, also the name of the event in the event store
+    :param event_store: EventStore to read from, or None to read the pickled event file
+    :return: The pickled event, [data, data_format, features, cluster] for the event stores, with (chids, times)
+    arrays as the Image
+    """
+    if event_store is not None:
+        return event_store.event(raw_path, as_arrays=True)
+    with open(osp.join(raw_dir, raw_path), "rb") as pickled_event:
+        return pickle.load(pickled_event)
+
+
+def _init_worker(function):
+    global _worker_function
+    _worker_function = function
+
+
+def _call_worker(argument):
+    return _worker_function(argument)
+
+
+def imap_events(function, events, workers=None, chunksize=64):
+    """
+    Runs function on each event in a Pool, yielding the results in the order they finish
+    :param function: Function to run on each event, sent to each worker once
+    :param events: Events to run the function on
+    :param workers: Number of worker processes, None for the number of CPUs
+    :param chunksize: Number of events sent to a worker at once
+    :return: Generator of the result of each event
+    """
+    with Pool(workers, initializer=_init_worker, initargs=(function,)) as pool:
+        for result in pool.imap_unordered(_call_worker, events, chunksize=chunksize):
+            yield result
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, "r") as manifest_file:
+        return manifest_file.read().splitlines()
+
+
+def write_manifest(manifest_path, filenames):
+    """
+    Writes the names of the processed files, replacing the manifest at once so an interrupted write is not read back
+    :param manifest_path: Path of the manifest
+    :param filenames: Names of the processed files
+    """
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        manifest_file.write("\n".join(filenames))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def existing_filenames(directory):
+    """
+    Names of the files already in a directory, listed once so processing skips events that were saved by an
+    interrupted run without checking for the file of each event
+    :param directory: Directory of the processed files
+    :return: Set of the file names
+    """
+    return set(os.listdir(directory)) if osp.isdir(directory) else set()
+
+
+def load_processed(dataset):
+    """
+    Loads the events processed by an earlier run of dataset.process, from its shards or manifest
+    :param dataset: EventDataset, DiffuseDataset or ClusterDataset
+    :return: Whether the processed events were found
+    """
+    if dataset.shard_size is not None:
+        if not CollatedShards.exists(dataset.processed_dir, dataset.processed_prefix):
+            return False
+        dataset.shards = CollatedShards(dataset.processed_dir, dataset.processed_prefix)
+    else:
+        if not osp.exists(dataset.manifest_path):
+            return False
+        dataset.processed_filenames = read_manifest(dataset.manifest_path)
+    return True
+
+
+def collate(data_list):
+    """
+    Concatenates the attributes of the events along their first dimension, in the style of InMemoryDataset.collate
+    :param data_list: List of Data objects with the same attributes
+    :return: (data, slices) dictionaries, the concatenated tensor of each attribute and the offsets of each event in it
+    """
+    data = {}
+    slices = {}
+    for key, _ in data_list[0]:
+        values = [torch.as_tensor(event[key]) for event in data_list]
+        values = [value.view(1) if value.dim() == 0 else value for value in values]
+        slices[key] = torch.tensor(
+            np.cumsum([0] + [value.size(0) for value in values]), dtype=torch.long
+        )
+        data[key] = torch.cat(values, dim=0)
+    return data, slices
+
+
+class CollatedShards(object):
+    """
+    Processed events stored as a few large shards of collated events, instead of one torch.save per event
+
+    Each attribute of a shard is its own .npy file, with the slices of each event in a second file, so an event is
+    found by an offset lookup and only the attributes that are asked for are memory mapped and read. An index file
+    lists the shards, the number of events in each and the attributes
+    """
+
+    def __init__(self, directory, prefix):
+        """
+        :param directory: Directory holding the shards
+        :param prefix: Name the shards were written with
+        """
+        index = torch.load(osp.join(directory, f"{prefix}_shards.pt"))
+        self.directory = directory
+        self.files = index["files"]
+        self.keys = index["keys"]
+        self.offsets = np.cumsum([0] + index["counts"])
+        self.loaded = {}
+
+    @staticmethod
+    def exists(directory, prefix):
+        return osp.exists(osp.join(directory, f"{prefix}_shards.pt"))
+
+    @staticmethod
+    def write(directory, prefix, data_iterable, shard_size):
+        """
+        Collates the events into shards of shard_size events and writes them and their index
+        :param directory: Directory to write the shards to
+        :param prefix: Name of the shards
+        :param data_iterable: Iterable of the Data of each event, None for events that are skipped
+        :param shard_size: Number of events per shard
+        :return: CollatedShards of the written shards
+        """
+        files = []
+        counts = []
+        keys = []
+        data_list = []
+
+        def write_shard():
+            files.append(f"{prefix}_shard{len(files)}")
+            counts.append(len(data_list))
+            data, slices = collate(data_list)
+            for key in data:
+                np.save(
+                    osp.join(directory, f"{files[-1]}_{key}.npy"), data[key].numpy()
+                )
+                np.save(
+                    osp.join(directory, f"{files[-1]}_{key}_slices.npy"),
+                    slices[key].numpy(),
+                )
+            keys[:] = list(data)
+            del data_list[:]
+
+        for data in data_iterable:
+            if data is None:
+                continue
+            data_list.append(data)
+            if len(data_list) == shard_size:
+                write_shard()
+        if data_list:
+            write_shard()
+        # Index is written last, so an interrupted processing is redone instead of leaving missing shards
+        torch.save(
+            {"files": files, "counts": counts, "keys": keys},
+            osp.join(directory, f"{prefix}_shards.pt"),
+        )
+        return CollatedShards(directory, prefix)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def field(self, number, key):
+        """
+        Memory maps one attribute of one shard the first time it is used
+        :param number: Number of the shard
+        :param key: Name of the attribute
+        :return: (values, slices), the tensor of the attribute of all events of the shard and the offsets of each event
+        """
+        if (number, key) not in self.loaded:
+            path = osp.join(self.directory, f"{self.files[number]}_{key}")
+            # Copy on write, so the tensors are writable without reading the whole file
+            self.loaded[number, key] = (
+                torch.from_numpy(np.load(path + ".npy", mmap_mode="c")),
+                np.load(path + "_slices.npy"),
+            )
+        return self.loaded[number, key]
+
+    def column(self, key):
+        """
+        Gets an attribute with one value per event, such as a label, for all events of all the shards
+        :param key: Name of the attribute
+        :return: Tensor of the attribute of each event, in the order of the events
+        """
+        return torch.cat(
+            [self.field(number, key)[0].view(-1) for number in range(len(self.files))]
+        )
+
+    def get(self, idx, keys=None):
+        """
+        Gets the attributes of one event, as views of the shard it is in
+        :param idx: Index of the event over all the shards
+        :param keys: Attributes to get, None for all of them
+        :return: Dictionary of the tensor of each attribute of the event
+        """
+        number = np.searchsorted(self.offsets, idx, side="right") - 1
+        idx = idx - self.offsets[number]
+        if keys is None:
+            keys = self.keys
+        event = {}
+        for key in keys:
+            values, slices = self.field(number, key)
+            event[key] = values[slices[idx] : slices[idx + 1]]
+        return event
+
+
+def farthest_point_sampling(pos, num_points):
+    """
+    Chooses num_points points that are spread out over the point cloud, starting from the first point
+    :param pos: (number of points, 3) tensor of the point cloud
+    :param num_points: Number of points to choose, at most the number of points
+    :return: Indices of the chosen points
+    """
+    distances = torch.full((pos.size(0),), float("inf"), dtype=pos.dtype)
+    index = torch.zeros(num_points, dtype=torch.long)
+    for i in range(1, num_points):
+        distances = torch.min(distances, ((pos - pos[index[i - 1]]) ** 2).sum(-1))
+        index[i] = distances.argmax()
+    return index
+
+
+class FixedSizePoints(object):
+    """
+    Samples or pads a point cloud to a fixed number of points, so DenseDataLoader can stack a batch into one
+    (batch_size, num_points, 3) tensor instead of collating ragged point clouds. Padded points are zero, and the mask
+    attribute is True for the real points
+    """
+
+    def __init__(self, num_points, method="random", point_keys=("pos",)):
+        """
+        :param num_points: Number of points of each point cloud
+        :param method: How larger point clouds are subsampled, either 'random' or 'fps' for farthest point sampling
+        :param point_keys: Attributes with one entry per point, which are sampled and padded the same as pos
+        """
+        if method not in ("random", "fps"):
+            raise ValueError("method is not one of: 'random', 'fps'")
+        self.num_points = num_points
+        self.method = method
+        self.point_keys = point_keys
+
+    def __call__(self, data):
+        num_points = data.pos.size(0)
+        if num_points <= self.num_points:
+            index = torch.arange(num_points)
+        elif self.method == "fps":
+            index = farthest_point_sampling(data.pos, self.num_points)
+        else:
+            index = torch.randperm(num_points)[: self.num_points].sort()[0]
+        for key in self.point_keys:
+            values = torch.as_tensor(data[key])[index]
+            padded = values.new_zeros((self.num_points,) + values.shape[1:])
+            padded[: len(index)] = values
+            data[key] = padded
+        data.mask = torch.arange(self.num_points) < len(index)
+        return data
+
+    def __repr__(self):
+        return "{}({}, method={})".format(
+            self.__class__.__name__, self.num_points, self.method
+        )
+
+
+class EventCache(object):
+    """
+    Least recently used cache of the Data of processed events, limited by the bytes of their tensors, so events used
+    again in later epochs are served from memory instead of being loaded from disk again. The cache is local to each
+    process, so every DataLoader worker has its own, kept across epochs with persistent_workers=True
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: Bytes of tensors to keep at most, the least recently used events are evicted beyond it
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._events = OrderedDict()
+        self._sizes = {}
+
+    @staticmethod
+    def size(data):
+        """
+        :param data: Data of an event
+        :return: Bytes of the tensors of the event
+        """
+        return sum(
+            value.element_size() * value.numel()
+            for _, value in data
+            if torch.is_tensor(value)
+        )
+
+    def get(self, key, load):
+        """
+        Gets an event from the cache, loading and caching it if it is not there
+        :param key: Index of the event
+        :param load: Function loading the event of an index
+        :return: Shallow copy of the Data of the event, so transforms setting attributes do not change the cached event
+        """
+        data = self._events.get(key)
+        if data is not None:
+            self.hits += 1
+            self._events.move_to_end(key)
+        else:
+            self.misses += 1
+            data = load(key)
+            if isinstance(data, Data):
+                self.put(key, data)
+        return copy.copy(data)
+
+    def put(self, key, data):
+        size = self.size(data)
+        if size > self.max_bytes:
+            return
+        if key in self._events:
+            self.nbytes -= self._sizes[key]
+        self._events[key] = data
+        self._events.move_to_end(key)
+        self._sizes[key] = size
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            evicted, _ = self._events.popitem(last=False)
+            self.nbytes -= self._sizes.pop(evicted)
+
+    def clear(self):
+        self._events.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._events)
+
+    def __repr__(self):
+        return "{}({} events, {}/{} bytes, {} hits, {} misses)".format(
+            self.__class__.__name__,
+            len(self),
+            self.nbytes,
+            self.max_bytes,
+            self.hits,
+            self.misses,
+        )
+
+
+class BalancedSampler(Sampler):
+    """
+    Samples the indices of a dataset by the integer label of each event, drawing a new set of events every epoch,
+    instead of fixing the events with balanced_classes and fraction when processing
+
+    Only the indices of the events sorted by class are kept, each epoch draws from them with a random permutation
+    """
+
+    def __init__(self, labels, balanced=True, fraction=1.0, generator=None):
+        """
+        :param labels: Integer label of each event of the dataset, such as EventDataset.event_types
+        :param balanced: Whether to draw the same number of events of each class, the number of the smallest class
+        :param fraction: Fraction of the events of each class to draw each epoch, if not 1.0
+        :param generator: torch.Generator to draw with, None for the default generator
+        """
+        labels = torch.as_tensor(labels, dtype=torch.long)
+        self.order = torch.argsort(labels, stable=True)
+        self.counts = torch.bincount(labels)
+        self.counts = self.counts[self.counts > 0]
+        self.offsets = torch.cumsum(self.counts, 0) - self.counts
+        num_samples = self.counts.clone()
+        if balanced:
+            num_samples[:] = self.counts.min()
+        if 0.0 < fraction < 1.0:
+            num_samples = (num_samples.double() * fraction).long()
+        self.num_samples = num_samples
+        self.generator = generator
+
+    def __iter__(self):
+        indices = torch.cat(
+            [
+                self.order[
+                    offset
+                    + torch.randperm(int(count), generator=self.generator)[
+                        : int(num_samples)
+                    ]
+                ]
+                for offset, count, num_samples in zip(
+                    self.offsets, self.counts, self.num_samples
+                )
+            ]
+        )
+        return iter(
+            indices[torch.randperm(len(indices), generator=self.generator)].tolist()
+        )
+
+    def __len__(self):
+        return int(self.num_samples.sum())
+
+
+def photon_stream_data(event, raw_path, simulated=True):
+    """
+    Builds the Data of an event read from a photon stream file
+    :param event: Event from ps.SimulationReader or ps.EventListReader
+    :param raw_path: Path of the photon stream file, which tells if simulated events are proton or gamma events
+    :param simulated: Whether this is on simulated data or real data
+    :return: Data of the event, or None if the event type of a simulated event is not known
+    """
+    # Convert the raw photon stream to Point Cloud, then truncation is simply cutting in the z direction
+    point_cloud = arrays_to_point_cloud(
+        *raw_to_arrays(event.photon_stream.raw), dtype=np.float32
+    )
+    data = Data(pos=torch.from_numpy(point_cloud))  # Just need x,y,z ignore derived features
+    if simulated:
+        if "proton" in raw_path:
+            data.event_type = torch.tensor(0, dtype=torch.int8)
+        elif "gamma" in raw_path:
+            data.event_type = torch.tensor(1, dtype=torch.int8)
+        else:
+            print("No Event Type")
+            return
+        data.energy = torch.tensor(
+            event.simulation_truth.air_shower.energy, dtype=torch.float
+        )
+        data.phi = torch.tensor(
+            event.simulation_truth.air_shower.phi, dtype=torch.float
+        )
+        data.theta = torch.tensor(
+            event.simulation_truth.air_shower.theta, dtype=torch.float
+        )
+    return data
+
+
+def read_photon_stream(raw_path, simulated=True):
+    """
+    Opens the reader of a photon stream file
+    :param raw_path: Path of the .phs.jsonl.gz file
+    :param simulated: Whether to read the simulation truth from the .ch.gz file next to it
+    :return: Iterable of the events of the file
+    """
+    if simulated:
+        mc_truth = raw_path.split(".phs")[0] + ".ch.gz"
+        return ps.SimulationReader(
+            photon_stream_path=raw_path, mmcs_corsika_path=mc_truth
+        )
+    return ps.EventListReader(raw_path)
+
+
+def prefetch(iterable, size):
+    """
+    Iterates over iterable in one background thread, so reading the next events overlaps with the work done on the
+    current ones. Only the gzip decompression releases the GIL, the JSON parsing does not, so this is one thread of
+    overlap and not parallel decoding, which comes from each DataLoader worker reading its own files
+
+    When the consumer stops early, the thread stops at its next item and closes iterable, so its files are closed
+    :param iterable: Iterable to read ahead
+    :param size: Maximum number of items read ahead
+    :return: Generator of the items of iterable
+    """
+    queue = Queue(maxsize=size)
+    end = object()
+    errors = []
+    stop = Event()
+
+    def put(item):
+        # Waits for space in the queue until the consumer stops
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            put(end)
+
+    thread = Thread(target=fill, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def shuffle_buffer(iterable, buffer_size, rng):
+    """
+    Shuffles an iterable approximately, keeping at most buffer_size items in memory
+    :param iterable: Iterable to shuffle
+    :param buffer_size: Number of items to choose the next item from
+    :param rng: np.random.RandomState to shuffle with
+    :return: Generator of the items of iterable
+    """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randint(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
 class PhotonStreamDataset(Dataset):
     def __init__(
         self,
@@ -45,9 +599,11 @@ class PhotonStreamDataset(Dataset):
 
         Dataset for generating the events from the PhotonStream files, instead of the preprocessed files
 
+        Use PhotonStreamIterableDataset to stream the events without saving them
+
         :param task: Either 'Separation', or 'Energy'
         :param split: Splits to include, either 'train', 'val', 'test', or 'trainval' or 'all' for training, validation, test, training and validation sets, or all data respectively
-        :param root: Root directory for the dataset
+        :param root: Root directory for the dataset, with the .phs.jsonl.gz files in its raw directory
         :param include_proton: Whether to include proton events or not
         :param simulated: Whether this is on simulated data or real data
         """
@@ -60,7 +616,11 @@ class PhotonStreamDataset(Dataset):
 
     @property
     def raw_file_names(self):
-        return NotImplementedError
+        if not osp.isdir(self.raw_dir):
+            return []
+        return sorted(
+            name for name in os.listdir(self.raw_dir) if name.endswith("phs.jsonl.gz")
+        )
 
     @property
     def processed_file_names(self):
@@ -71,60 +631,38 @@ class PhotonStreamDataset(Dataset):
 
     def process(self):
 
-        used_paths = split_data(self.raw_paths)[self.split]
+        used_paths = split_data(self.raw_file_names)[self.split]
+        os.makedirs(osp.join(self.processed_dir, self.split), exist_ok=True)
 
-        for raw_path in used_paths:
-            if not self.include_proton and "proton" in raw_path:
+        for raw_name in used_paths:
+            if not self.include_proton and "proton" in raw_name:
                 continue
-            # load the pickled file from the disk
-            if osp.exists(osp.join(self.processed_dir, self.split, f"{raw_path}.pt")):
-                self.processed_filenames.append(f"{raw_path}.pt")
-            else:
-                if self.simulated:
-                    mc_truth = raw_path.split(".phs")[0] + ".ch.gz"
-                    event_reader = ps.SimulationReader(
-                        photon_stream_path=raw_path, mmcs_corsika_path=mc_truth
-                    )
-                else:
-                    event_reader = ps.EventListReader(raw_path)
-                for event in event_reader:
-                    print(raw_path)
-                    # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                    point_cloud = np.asarray(event.photon_stream.point_cloud)
-                    # Read data from `raw_path`.
-                    data = Data(
-                        pos=point_cloud
-                    )  # Just need x,y,z ignore derived features
-                    if self.simulated:
-                        if "proton" in raw_path:
-                            data.event_type = torch.tensor(0, dtype=torch.int8)
-                        elif "gamma" in raw_path:
-                            data.event_type = torch.tensor(1, dtype=torch.int8)
-                        else:
-                            print("No Event Type")
-                            continue
-                        data.energy = torch.tensor(
-                            event.simulation_truth.air_shower.energy, dtype=torch.float
-                        )
-                        data.phi = torch.tensor(
-                            event.simulation_truth.air_shower.phi, dtype=torch.float
-                        )
-                        data.theta = torch.tensor(
-                            event.simulation_truth.air_shower.theta, dtype=torch.float
-                        )
-                    if self.pre_filter is not None and not self.pre_filter(data):
-                        continue
-
-                    if self.pre_transform is not None:
-                        data = self.pre_transform(data)
-
-                    torch.save(
-                        data,
-                        osp.join(
-                            self.processed_dir, self.split, "{}.pt".format(raw_path)
-                        ),
-                    )
-                    self.processed_filenames.append("{}.pt".format(raw_path))
+            name = raw_name.split(".phs")[0]
+            manifest_path = osp.join(self.processed_dir, self.split, f"{name}_manifest.txt")
+            if osp.exists(manifest_path):
+                self.processed_filenames += read_manifest(manifest_path)
+                continue
+            print(raw_name)
+            event_filenames = []
+            raw_path = osp.join(self.raw_dir, raw_name)
+            for event_number, event in enumerate(read_photon_stream(raw_path, self.simulated)):
+                data = photon_stream_data(event, raw_path, self.simulated)
+                if data is None:
+                    continue
+                if self.pre_filter is not None and not self.pre_filter(data):
+                    continue
+
+                if self.pre_transform is not None:
+                    data = self.pre_transform(data)
+
+                # One file per event, named by its number in the photon stream file
+                event_filenames.append(f"{name}_{event_number}.pt")
+                torch.save(
+                    data,
+                    osp.join(self.processed_dir, self.split, event_filenames[-1]),
+                )
+            write_manifest(manifest_path, event_filenames)
+            self.processed_filenames += event_filenames
 
     def len(self):
         return len(self.processed_file_names)
@@ -148,6 +686,93 @@ class PhotonStreamDataset(Dataset):
         return data
 
 
+class PhotonStreamIterableDataset(IterableDataset):
+    def __init__(
+        self,
+        paths,
+        task="separation",
+        simulated=True,
+        include_proton=True,
+        shuffle_size=0,
+        prefetch_size=256,
+        seed=None,
+        transform=None,
+    ):
+        """
+        Dataset streaming the events straight from the PhotonStream files to point clouds, without a processing pass
+        or any processed files
+
+        With DataLoader workers, each worker reads its own share of the files, which is what decodes files in
+        parallel. Each worker also reads its events ahead in one background thread, so the gzip decompression overlaps
+        with building the point clouds
+
+        :param paths: Paths of the .phs.jsonl.gz files
+        :param task: Either 'separation', 'energy', 'phi', or 'theta', only used for simulated data
+        :param simulated: Whether this is on simulated data or real data
+        :param include_proton: Whether to include proton events or not
+        :param shuffle_size: Number of events to shuffle the events among, 0 to keep the order of the files
+        :param prefetch_size: Number of events each worker reads ahead
+        :param seed: Seed for the order of the files and events, None for a different order every epoch
+        :param transform: Transform applied to each Data
+        """
+        super(PhotonStreamIterableDataset, self).__init__()
+        self.paths = [
+            path for path in to_list(paths) if include_proton or "proton" not in path
+        ]
+        self.task = task.lower()
+        self.simulated = simulated
+        self.shuffle_size = shuffle_size
+        self.prefetch_size = prefetch_size
+        self.seed = seed
+        self.transform = transform
+
+    def worker_paths(self, rng):
+        """
+        Files read by the current DataLoader worker, each file is read by exactly one worker
+        :param rng: np.random.RandomState to shuffle the files with, seeded the same in all workers
+        :return: Paths of the files
+        """
+        paths = list(self.paths)
+        if self.shuffle_size > 0:
+            rng.shuffle(paths)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return paths
+        return paths[worker_info.id :: worker_info.num_workers]
+
+    def events(self, paths):
+        for raw_path in paths:
+            for event in read_photon_stream(raw_path, self.simulated):
+                yield raw_path, event
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id + 1
+        if self.seed is not None:
+            seed = self.seed
+        elif worker_info is not None:
+            # DataLoader seeds the workers of an epoch with base_seed + id, so they all shuffle the files the same
+            seed = worker_info.seed - worker_info.id
+        else:
+            seed = np.random.randint(2 ** 31)
+        paths = self.worker_paths(np.random.RandomState(seed % 2 ** 32))
+        rng = np.random.RandomState((seed + worker_id) % 2 ** 32)
+        events = self.events(paths)
+        if self.prefetch_size > 0:
+            events = prefetch(events, self.prefetch_size)
+        if self.shuffle_size > 0:
+            events = shuffle_buffer(events, self.shuffle_size, rng)
+        for raw_path, event in events:
+            data = photon_stream_data(event, raw_path, self.simulated)
+            if data is None:
+                continue
+            if self.simulated:
+                data.y = data[TASK_LABELS[self.task]]
+            if self.transform is not None:
+                data = self.transform(data)
+            yield data
+
+
 class EventDataset(Dataset):
     def __init__(
         self,
@@ -160,6 +785,13 @@ class EventDataset(Dataset):
         fraction=1.0,
         transform=None,
         pre_transform=None,
+        event_store=None,
+        shard_size=None,
+        workers=None,
+        chunksize=64,
+        num_points=None,
+        sampling="random",
+        cache_bytes=0,
     ):
         """
         :param task: Either 'separation', 'energy', 'phi', or 'theta'
@@ -170,6 +802,15 @@ class EventDataset(Dataset):
         :param fraction: Fraction of dataset to use, if not 1.0, then takes randomly the fraction of the dataset to use
         :param cleanliness: str, which version of the DBSCAN cleaned files to use, and which raw filenames to load, one of 'no_clean', 'clump5',
         'clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'
+        :param event_store: Path(s) of a packed event store to read the events from, instead of the event files in raw_dir
+        :param shard_size: Number of events per collated shard of processed events, None to save one file per event.
+        Only the shards load the attributes of an event lazily, one file per event is always loaded whole
+        :param workers: Number of processes to process the events with, None for the number of CPUs
+        :param chunksize: Number of events sent to a process at once
+        :param num_points: Number of points to sample or pad each point cloud to when processing, with FixedSizePoints,
+        so they can be batched with DenseDataLoader, None to keep all the points
+        :param sampling: How point clouds with more than num_points points are subsampled, either 'random' or 'fps'
+        :param cache_bytes: Bytes of loaded events to keep in memory with an EventCache, per process, 0 to not cache
         """
         self.task = task.lower()
         self.split = split.lower()
@@ -177,6 +818,17 @@ class EventDataset(Dataset):
         self.balanced_classes = balanced_classes
         self.cleanliness = cleanliness.strip().lower()
         self.fraction = fraction
+        self.event_store = EventStore(event_store) if event_store is not None else None
+        self.shard_size = shard_size
+        self.shards = None
+        self.workers = workers
+        self.chunksize = chunksize
+        self.fixed_size = (
+            FixedSizePoints(num_points, sampling)
+            if num_points is not None
+            else None
+        )
+        self.cache = EventCache(cache_bytes) if cache_bytes else None
 
         try:
             self.event_dict = pickle.load(
@@ -193,7 +845,8 @@ class EventDataset(Dataset):
             )
         self.processed_filenames = (
             []
-        )  # Because of multithreading, its faster than using file_exists in base class on actual list
+        )  # Filled from the manifest, its faster than using file_exists in base class on actual list
+        self.existing_filenames = set()  # Listed by process before the events are saved
         super(EventDataset, self).__init__(root, transform, pre_transform)
 
     @property
@@ -210,106 +863,144 @@ class EventDataset(Dataset):
     def download(self):
         pass
 
+    @property
+    def processed_prefix(self):
+        """
+        Name of the collated shards and manifest, from the settings that choose which events are processed
+        """
+        prefix = f"{self.cleanliness}_{self.split}"
+        if self.task == "separation" and self.include_proton:
+            prefix += "_separation"
+            if self.balanced_classes:
+                prefix += "_balanced"
+        if 0.0 < self.fraction < 1.0:
+            prefix += f"_{self.fraction}"
+        return prefix + self.processed_suffix
+
+    @property
+    def processed_suffix(self):
+        """
+        Added to the names of the processed files, so point clouds of a fixed size are kept apart from the others
+        """
+        if self.fixed_size is None:
+            return ""
+        return f"_{self.fixed_size.num_points}{self.fixed_size.method}"
+
+    @property
+    def manifest_path(self):
+        return osp.join(self.processed_dir, f"{self.processed_prefix}_manifest.txt")
+
     def process_file(
-        self, is_proton, processed_list, raw_path
+        self, is_proton, raw_path
     ):
         """
         Processes a single file given the path
         :param is_proton: Whether the events are proton events or not
         :param raw_path: raw filename of the event to process
-        :param processed_list: Threadsafe list to append filenames to
-        :return:
+        :return: Filename of the processed event, or None if the event is skipped
+        """
+        filename = f"{raw_path}{self.processed_suffix}.pt"
+        if filename in self.existing_filenames:
+            return filename
+        data = self.build_data(is_proton, raw_path)
+        if data is None:
+            return
+        torch.save(data, osp.join(self.processed_dir, filename))
+        return filename
+
+    def build_data(self, is_proton, raw_path):
+        """
+        Builds the Data of a single event
+        :param is_proton: Whether the event is a proton event or not
+        :param raw_path: raw filename of the event to process
+        :return: Data of the event, or None if the event is skipped
         """
-        # load the pickled file from the disk
-        if osp.exists(osp.join(self.processed_dir, f"{raw_path}.pt")):
-            processed_list.append(f"{raw_path}.pt")
+        event_data, data_format, features, feature_cluster = load_event(
+            self.raw_dir, raw_path, self.event_store
+        )
+        # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+        point_cloud = arrays_to_point_cloud(
+            *photon_arrays(event_data[data_format["Image"]]), dtype=np.float32
+        )
+        # Read data from `raw_path`.
+        data = Data(
+            pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
+        )  # Just need x,y,z ignore derived features
+        if is_proton:
+            data.event_type = torch.tensor([0], dtype=torch.long
+            )
         else:
-            with open(osp.join(self.raw_dir, raw_path), "rb") as pickled_event:
-                event_data, data_format, features, feature_cluster = pickle.load(
-                    pickled_event
-                )
-                # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                event_photons = event_data[data_format["Image"]]
-                event_photons = list_of_lists_to_raw_phs(event_photons)
-                point_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                    )
-                )
-                # Read data from `raw_path`.
-                data = Data(
-                    pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
-                )  # Just need x,y,z ignore derived features
-                if is_proton:
-                    data.event_type = torch.tensor([0], dtype=torch.long
-                    )
-                else:
-                    data.event_type = torch.tensor([1], dtype=torch.long
-                    )
-                data.energy = torch.tensor(
-                    [event_data[data_format["Energy"]]],
-                    dtype=torch.long,
-                )
-                data.phi = torch.tensor(
-                    [event_data[4]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+            data.event_type = torch.tensor([1], dtype=torch.long
+            )
+        data.energy = torch.tensor(
+            [event_data[data_format["Energy"]]],
+            dtype=torch.long,
+        )
+        data.phi = torch.tensor(
+            [event_data[4]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
+        data.theta = torch.tensor(
+            [event_data[5]],
+            dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+        )
+
+        # Now add the features from the feature extraction
+        if (
+            features["extraction"] == 1
+        ):  # Failed extraction, so has no features to use
+            return
+        else:
+            feature_list = []
+            feature_list.append(features["head_tail_ratio"])
+            feature_list.append(features["length"])
+            feature_list.append(features["width"])
+            feature_list.append(features["time_gradient"])
+            feature_list.append(features["number_photons"])
+            feature_list.append(
+                features["length"] * features["width"] * np.pi
+            )
+            feature_list.append(
+                (
+                    (features["length"] * features["width"] * np.pi)
+                    / np.log(features["number_photons"]) ** 2
                 )
-                data.theta = torch.tensor(
-                    [event_data[5]],
-                    dtype=torch.long,  # Needed because most the proton events had the wrong data_format
+            )
+            feature_list.append(
+                (
+                    features["number_photons"]
+                    / (features["length"] * features["width"] * np.pi)
                 )
+            )
+        # Now make it the node features
+        data.features = torch.tensor(
+            np.asarray(feature_list),
+            dtype=torch.float,
+        )
 
-                # Now add the features from the feature extraction
-                if (
-                    features["extraction"] == 1
-                ):  # Failed extraction, so has no features to use
-                    return
-                else:
-                    feature_list = []
-                    feature_list.append(features["head_tail_ratio"])
-                    feature_list.append(features["length"])
-                    feature_list.append(features["width"])
-                    feature_list.append(features["time_gradient"])
-                    feature_list.append(features["number_photons"])
-                    feature_list.append(
-                        features["length"] * features["width"] * np.pi
-                    )
-                    feature_list.append(
-                        (
-                            (features["length"] * features["width"] * np.pi)
-                            / np.log(features["number_photons"]) ** 2
-                        )
-                    )
-                    feature_list.append(
-                        (
-                            features["number_photons"]
-                            / (features["length"] * features["width"] * np.pi)
-                        )
-                    )
-                # Now make it the node features
-                data.features = torch.tensor(
-                    np.asarray(feature_list),
-                    dtype=torch.float,
-                )
+        if self.fixed_size is not None:
+            data = self.fixed_size(data)
+        if self.pre_filter is not None and not self.pre_filter(data):
+            return
 
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    return
-
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                torch.save(
-                    data, osp.join(self.processed_dir, "{}.pt".format(raw_path)),
-                )
-                processed_list.append("{}.pt".format(raw_path))
+        if self.pre_transform is not None:
+            data = self.pre_transform(data)
+        return data
 
     def process(self):
-        used_paths = split_data(self.raw_file_names)[self.split]
-        protons = np.intersect1d(
-            used_paths, self.event_dict["proton"], assume_unique=True
-        )
-        gammas = np.intersect1d(
-            used_paths, self.event_dict["gamma"], assume_unique=True
+        if load_processed(self):
+            return
+        cache_name = f"{self.cleanliness}_raw_names"
+        if not self.include_proton:
+            cache_name += "_gamma"
+        # Events are chosen by their index in raw_file_names, the protons followed by the gammas
+        in_split = np.isin(
+            cached_split_assignment(self.raw_file_names, cache_name),
+            SPLIT_ASSIGNMENTS[self.split],
         )
+        num_protons = len(self.event_dict["proton"]) if self.include_proton else 0
+        protons = np.flatnonzero(in_split[:num_protons])
+        gammas = np.flatnonzero(in_split[num_protons:])
         if self.balanced_classes and self.task == 'separation': # Only matters for separation task, all others only need gamma
             num_events = len(protons) if len(protons) < len(gammas) else len(gammas)
             if 0.0 < self.fraction < 1.0:
@@ -323,23 +1014,70 @@ class EventDataset(Dataset):
             gammas = np.random.choice(
                 gammas, size=int(self.fraction * len(gammas)), replace=False
             )
-        manager = Manager()
-        pool = Pool()
-        threaded_filenames = manager.list()
+        protons = [self.event_dict["proton"][i] for i in protons]
+        gammas = [self.event_dict["gamma"][i] for i in gammas]
+        # Shards are collated from the Data of the events, otherwise each event is saved by the workers
+        process_event = self.build_data if self.shard_size is not None else self.process_file
+        self.existing_filenames = existing_filenames(self.processed_dir)
+        events = imap_events(
+            partial(process_event, False), gammas, self.workers, self.chunksize
+        )
         if self.task == 'separation':
-            proton_proc = partial(self.process_file, True, threaded_filenames)
-            processors = pool.map_async(proton_proc, protons)
-            processors.wait()
-        gamma_proc = partial(self.process_file, False, threaded_filenames)
-        processors = pool.map_async(gamma_proc, gammas)
-        processors.wait()
-        for element in threaded_filenames:
-            self.processed_filenames.append(element)
+            events = chain(
+                imap_events(
+                    partial(process_event, True), protons, self.workers, self.chunksize
+                ),
+                events,
+            )
+        if self.shard_size is not None:
+            self.shards = CollatedShards.write(
+                self.processed_dir, self.processed_prefix, events, self.shard_size
+            )
+            return
+        self.processed_filenames = [filename for filename in events if filename is not None]
+        write_manifest(self.manifest_path, self.processed_filenames)
 
     def len(self):
+        if self.shards is not None:
+            return len(self.shards)
         return len(self.processed_filenames)
 
+    @property
+    def event_types(self):
+        """
+        Label of each processed event for BalancedSampler, 0 for protons and 1 for gammas, the same as event_type
+        """
+        if self.shards is not None:
+            return self.shards.column("event_type")
+        protons = set(self.event_dict["proton"])
+        suffix = f"{self.processed_suffix}.pt"
+        return torch.from_numpy(
+            np.fromiter(
+                (name[: -len(suffix)] not in protons for name in self.processed_filenames),
+                dtype=np.int64,
+                count=len(self.processed_filenames),
+            )
+        )
+
     def get(self, idx):
+        if self.cache is None:
+            return self.load(idx)
+        return self.cache.get(idx, self.load)
+
+    def load(self, idx):
+        if self.shards is not None:
+            if self.task not in TASK_LABELS:
+                print("Not recognized task type")
+                return NotImplementedError
+            keys = ["pos", TASK_LABELS[self.task]]
+            if self.fixed_size is not None:
+                keys.append("mask")
+            event = self.shards.get(idx, keys)
+            event["y"] = event.pop(TASK_LABELS[self.task])
+            if self.task == "energy":
+                event["y"] = event["y"].float()
+            return Data(**event)
+        # One file per event is loaded whole, only the shards can read just the attributes of the task
         data = torch.load(osp.join(self.processed_dir, self.processed_file_names[idx]))
         if self.task == "energy":
             del data.phi
@@ -382,6 +1120,13 @@ class DiffuseDataset(Dataset):
         transform=None,
         pre_transform=None,
             fraction=1.0,
+        event_store=None,
+        shard_size=None,
+        workers=None,
+        chunksize=64,
+        num_points=None,
+        sampling="random",
+        cache_bytes=0,
     ):
         """
         EventFile Dataloader for specifically Disp calculations,
@@ -390,11 +1135,31 @@ class DiffuseDataset(Dataset):
         Use EventFileDataset for Energy and Separation tasks
 
         :param num_points: The number of points to have, either using points multiple times, or subselecting from the total points
+        :param event_store: Path(s) of a packed event store to read the events from, instead of the event files in raw_dir
+        :param shard_size: Number of events per collated shard of processed events, None to save one file per event.
+        Only the shards load the attributes of an event lazily, one file per event is always loaded whole
+        :param workers: Number of processes to process the events with, None for the number of CPUs
+        :param chunksize: Number of events sent to a process at once
+        :param num_points: Number of points to sample or pad each point cloud to when processing, with FixedSizePoints,
+        so they can be batched with DenseDataLoader, None to keep all the points
+        :param sampling: How point clouds with more than num_points points are subsampled, either 'random' or 'fps'
+        :param cache_bytes: Bytes of loaded events to keep in memory with an EventCache, per process, 0 to not cache
         """
         self.processed_filenames = []
         self.split = split.lower()
         self.cleanliness = cleanliness.strip().lower()
         self.fraction = fraction
+        self.event_store = EventStore(event_store) if event_store is not None else None
+        self.shard_size = shard_size
+        self.shards = None
+        self.workers = workers
+        self.chunksize = chunksize
+        self.fixed_size = (
+            FixedSizePoints(num_points, sampling)
+            if num_points is not None
+            else None
+        )
+        self.cache = EventCache(cache_bytes) if cache_bytes else None
         try:
             self.event_list = pickle.load(
                 open(
@@ -408,6 +1173,7 @@ class DiffuseDataset(Dataset):
             raise ValueError(
                 "cleanliness value is not one of: 'no_clean', 'clump20', 'core20'"
             )
+        self.existing_filenames = set()  # Listed by process before the events are saved
         super(DiffuseDataset, self).__init__(root, transform, pre_transform)
 
     @property
@@ -422,80 +1188,118 @@ class DiffuseDataset(Dataset):
     def raw_dir(self):
         return osp.join(self.root, 'diffuse_raw')
 
+    @property
+    def processed_prefix(self):
+        prefix = f"diffuse_{self.cleanliness}_{self.split}"
+        if 0.0 < self.fraction < 1.0:
+            prefix += f"_{self.fraction}"
+        return prefix + self.processed_suffix
+
+    @property
+    def processed_suffix(self):
+        """
+        Added to the names of the processed files, so point clouds of a fixed size are kept apart from the others
+        """
+        if self.fixed_size is None:
+            return ""
+        return f"_{self.fixed_size.num_points}{self.fixed_size.method}"
+
+    @property
+    def manifest_path(self):
+        return osp.join(self.processed_dir, f"{self.processed_prefix}_manifest.txt")
+
     def download(self):
         pass
 
-    def process_file(self, processed_list, raw_path):
+    def process_file(self, raw_path):
         """
         Processes a single file given the path
         :param raw_path:
-        :return:
+        :return: Filename of the processed event, or None if the event is skipped
         """
-        # load the pickled file from the disk
-        if osp.exists(osp.join(self.processed_dir, f"diffuse_{raw_path}.pt")):
-            processed_list.append(f"diffuse_{raw_path}.pt")
-        else:
-            # Checks that file is not 0
-            with open(osp.join(self.raw_dir, raw_path), "rb") as pickled_event:
-                event_data, data_format, features = pickle.load(
-                    pickled_event
-                )
-                # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
-                event_photons = event_data[data_format["Image"]]
-                event_photons = list_of_lists_to_raw_phs(event_photons)
-                point_cloud = np.asarray(
-                    raw_phs_to_point_cloud(
-                        event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                    )
-                )
-                # Read data from `raw_path`.
-                data = Data(
-                    pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
-                )  # Just need x,y,z ignore derived features
-                data.y = torch.tensor(
-                    [true_sign(
-                        event_data[data_format["Source_X"]],
-                        event_data[data_format["Source_Y"]],
-                        event_data[data_format["COG_X"]],
-                        event_data[data_format["COG_Y"]],
-                        event_data[data_format["Delta"]],
-                    )
-                    * euclidean_distance(
-                        event_data[data_format["Source_X"]],
-                        event_data[data_format["Source_Y"]],
-                        event_data[data_format["COG_X"]],
-                        event_data[data_format["COG_Y"]],
-                    )],
-                    dtype=torch.float,
-                )
-                if self.pre_filter is not None and not self.pre_filter(data):
-                    return
+        filename = f"diffuse_{raw_path}{self.processed_suffix}.pt"
+        if filename in self.existing_filenames:
+            return filename
+        data = self.build_data(raw_path)
+        if data is None:
+            return
+        torch.save(data, osp.join(self.processed_dir, filename))
+        return filename
+
+    def build_data(self, raw_path):
+        """
+        Builds the Data of a single event
+        :param raw_path: raw filename of the event to process
+        :return: Data of the event, or None if the event is skipped
+        """
+        event_data, data_format, features = load_event(
+            self.raw_dir, raw_path, self.event_store
+        )[:3]
+        # Convert List of List to Point Cloud, then truncation is simply cutting in the z direction
+        point_cloud = arrays_to_point_cloud(
+            *photon_arrays(event_data[data_format["Image"]]), dtype=np.float32
+        )
+        # Read data from `raw_path`.
+        data = Data(
+            pos=torch.tensor(point_cloud, dtype=torch.float).squeeze(),
+        )  # Just need x,y,z ignore derived features
+        data.y = torch.tensor(
+            [true_sign(
+                event_data[data_format["Source_X"]],
+                event_data[data_format["Source_Y"]],
+                event_data[data_format["COG_X"]],
+                event_data[data_format["COG_Y"]],
+                event_data[data_format["Delta"]],
+            )
+            * euclidean_distance(
+                event_data[data_format["Source_X"]],
+                event_data[data_format["Source_Y"]],
+                event_data[data_format["COG_X"]],
+                event_data[data_format["COG_Y"]],
+            )],
+            dtype=torch.float,
+        )
+        if self.fixed_size is not None:
+            data = self.fixed_size(data)
+        if self.pre_filter is not None and not self.pre_filter(data):
+            return
 
-                if self.pre_transform is not None:
-                    data = self.pre_transform(data)
-                torch.save(
-                    data,
-                    osp.join(self.processed_dir, "diffuse_{}.pt".format(raw_path)),
-                )
-                processed_list.append("diffuse_{}.pt".format(raw_path))
+        if self.pre_transform is not None:
+            data = self.pre_transform(data)
+        return data
 
     def process(self):
-        used_paths = split_data(self.raw_file_names)[self.split]
+        if load_processed(self):
+            return
+        used_paths = split_data(
+            self.raw_file_names, cache_name=f"{self.cleanliness}_diffuse_raw_names"
+        )[self.split]
         if 0.0 < self.fraction < 1.0:
             used_paths = np.random.choice(used_paths, size=int(self.fraction*len(used_paths)), replace=False)
-        manager = Manager()
-        threaded_filenames = manager.list()
-        pool = Pool()
-        func = partial(self.process_file, threaded_filenames)
-        processors = pool.map_async(func, used_paths)
-        processors.wait()
-        for element in threaded_filenames:
-            self.processed_filenames.append(element)
+        if self.shard_size is not None:
+            events = imap_events(self.build_data, used_paths, self.workers, self.chunksize)
+            self.shards = CollatedShards.write(
+                self.processed_dir, self.processed_prefix, events, self.shard_size
+            )
+            return
+        self.existing_filenames = existing_filenames(self.processed_dir)
+        events = imap_events(self.process_file, used_paths, self.workers, self.chunksize)
+        self.processed_filenames = [filename for filename in events if filename is not None]
+        write_manifest(self.manifest_path, self.processed_filenames)
 
     def len(self):
+        if self.shards is not None:
+            return len(self.shards)
         return len(self.processed_file_names)
 
     def get(self, idx):
+        if self.cache is None:
+            return self.load(idx)
+        return self.cache.get(idx, self.load)
+
+    def load(self, idx):
+        if self.shards is not None:
+            return Data(**self.shards.get(idx))
         data = torch.load(
             osp.join(self.processed_dir, self.processed_file_names[idx])
         )
@@ -512,6 +1316,14 @@ class ClusterDataset(Dataset):
         cleanliness="core20",
         transform=None,
         pre_transform=None,
+        event_store=None,
+        uncleaned_store=None,
+        clump_store=None,
+        shard_size=None,
+        workers=None,
+        chunksize=64,
+        num_points=None,
+        sampling="random",
     ):
         """
 
@@ -521,12 +1333,36 @@ class ClusterDataset(Dataset):
         :param root: Root directory for the dataset, holding the files with the "cleaned" files
         :param clump_root: Root for files that hold the non-core clump outputs from DBSCAN, optional
         :param cleanliness: name of DBSCAN output eventfiles for the files in root, one of 'no_clean', 'clump5','clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'
+        :param event_store: Path(s) of a packed event store with the events of root, instead of its event files
+        :param uncleaned_store: Path(s) of a packed event store with the events of uncleaned_root
+        :param clump_store: Path(s) of a packed event store with the events of clump_root
+        :param shard_size: Number of events per collated shard of processed events, None to save one file per event.
+        Only the shards load the attributes of an event lazily, one file per event is always loaded whole
+        :param workers: Number of processes to process the events with, None for the number of CPUs
+        :param chunksize: Number of events sent to a process at once
+        :param num_points: Number of points to sample or pad each point cloud to when processing, with FixedSizePoints,
+        so they can be batched with DenseDataLoader, None to keep all the points
+        :param sampling: How point clouds with more than num_points points are subsampled, either 'random' or 'fps'
         """
         self.split = split.lower()
         self.uncleaned_root = uncleaned_root
         self.clump_root = clump_root
         self.cleanliness = cleanliness
-        if self.clump_root is not None:
+        self.event_store = EventStore(event_store) if event_store is not None else None
+        self.uncleaned_store = (
+            EventStore(uncleaned_store) if uncleaned_store is not None else None
+        )
+        self.clump_store = EventStore(clump_store) if clump_store is not None else None
+        self.shard_size = shard_size
+        self.shards = None
+        self.workers = workers
+        self.chunksize = chunksize
+        self.fixed_size = (
+            FixedSizePoints(num_points, sampling, point_keys=("pos", "y"))
+            if num_points is not None
+            else None
+        )
+        if self.clump_root is not None or self.clump_store is not None:
             self.clumps = True
         else:
             self.clumps = False
@@ -543,9 +1379,8 @@ class ClusterDataset(Dataset):
             raise ValueError(
                 "cleanliness value is not one of: 'no_clean', 'clump5','clump10', 'clump15', 'clump20', 'core5', 'core10', 'core15', 'core20'"
             )
-        self.processed_filenames = [
-            f"cluster_{event}.pt" for event in self.raw_file_names
-        ]
+        self.processed_filenames = []  # Filled by process, from the workers or the manifest
+        self.existing_filenames = set()  # Listed by process before the events are saved
         super(ClusterDataset, self).__init__(root, transform, pre_transform)
 
     @property
@@ -560,6 +1395,26 @@ class ClusterDataset(Dataset):
     def processed_dir(self):
         return osp.join(self.root, "cluster")  # To not overlap with the non-clustering
 
+    @property
+    def processed_prefix(self):
+        prefix = f"cluster_{self.cleanliness}_{self.split}"
+        if self.clumps:
+            prefix += "_clumps"
+        return prefix + self.processed_suffix
+
+    @property
+    def processed_suffix(self):
+        """
+        Added to the names of the processed files, so point clouds of a fixed size are kept apart from the others
+        """
+        if self.fixed_size is None:
+            return ""
+        return f"_{self.fixed_size.num_points}{self.fixed_size.method}"
+
+    @property
+    def manifest_path(self):
+        return osp.join(self.processed_dir, f"{self.processed_prefix}_manifest.txt")
+
     def download(self):
         pass
 
@@ -567,110 +1422,95 @@ class ClusterDataset(Dataset):
         """
         Process single cluster file
         :param base_path:
-        :return:
+        :return: Filename of the processed event, or None if the event is skipped or fails
         """
-        raw_path = osp.join(self.raw_dir, base_path)
         # Assumes that the folder structure follows the default convention of 'raw'
-        uncleaned_path = osp.join(self.uncleaned_root, "raw", base_path)
-        clump_path = osp.join(self.clump_root, "raw", base_path)
-        # load the pickled file from the disk
-        if osp.exists(
-            osp.join(self.processed_dir, f"cluster_{base_path}.pt")
-        ):
-            self.processed_filenames.append(f"cluster_{base_path}.pt")
-        else:
-            try:
-                with open(raw_path, "rb") as pickled_event:
-                    with open(uncleaned_path, "rb") as pickled_original:
-                        (
-                            event_data,
-                            data_format,
-                            features,
-                            feature_cluster,
-                        ) = pickle.load(pickled_event)
-                        uncleaned_data, _, _, _ = pickle.load(pickled_original)
-                        uncleaned_photons = uncleaned_data[data_format["Image"]]
-                        uncleaned_photons = list_of_lists_to_raw_phs(uncleaned_photons)
-                        uncleaned_cloud = np.asarray(
-                            raw_phs_to_point_cloud(
-                                uncleaned_photons,
-                                cx=GEOMETRY.x_angle,
-                                cy=GEOMETRY.y_angle,
-                            )
-                        )
-                        # Convert List of List to Point Cloud
-                        event_photons = event_data[data_format["Image"]]
-                        event_photons = list_of_lists_to_raw_phs(event_photons)
-                        point_cloud = np.asarray(
-                            raw_phs_to_point_cloud(
-                                event_photons, cx=GEOMETRY.x_angle, cy=GEOMETRY.y_angle
-                            )
-                        )
-                        out = np.where(
-                            (uncleaned_cloud == point_cloud[:, None]).all(-1)
-                        )[1]
-                        point_values = np.zeros(uncleaned_cloud.shape)
-                        point_values[out] = 1
-                        if self.clumps:
-                            with open(clump_path, "rb") as pickled_clump:
-                                clump_data, _, _, _ = pickle.load(pickled_clump)
-                                clump_photons = clump_data[data_format["Image"]]
-                                clump_photons = list_of_lists_to_raw_phs(clump_photons)
-                                clump_cloud = np.asarray(
-                                    raw_phs_to_point_cloud(
-                                        clump_photons,
-                                        cx=GEOMETRY.x_angle,
-                                        cy=GEOMETRY.y_angle,
-                                    )
-                                )
-                                out = np.where(
-                                    (uncleaned_cloud == clump_cloud[:, None]).all(-1)
-                                )[1]
-                                clump_values = np.zeros(uncleaned_cloud.shape)
-                                clump_values[out] = 1
-                                # clump_values = np.isclose(clump_cloud, point_cloud)
-                                # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
-                                point_values = point_values.astype(
-                                    int
-                                ) + clump_values.astype(int)
-                                point_values = point_values[:, 0]
-                        else:
-                            point_values = point_values.astype(int)
-                            point_values = point_values[:, 0]
-                        data = Data(
-                            pos=torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze(), y=point_values
-                        )  # Just need x,y,z ignore derived features
-                        if self.pre_filter is not None and not self.pre_filter(data):
-                            return
-
-                        if self.pre_transform is not None:
-                            data = self.pre_transform(data)
-                        torch.save(
-                            data,
-                            osp.join(
-                                self.processed_dir,
-                                "cluster_{}.pt".format(base_path),
-                            ),
-                        )
-                        self.processed_filenames.append(
-                            "cluster_{}.pt".format(base_path)
-                        )
-            except Exception as e:
-                print(f"Failed: {e}")
+        filename = f"cluster_{base_path}{self.processed_suffix}.pt"
+        if filename in self.existing_filenames:
+            return filename
+        data = self.build_data(base_path)
+        if data is None:
+            return
+        torch.save(data, osp.join(self.processed_dir, filename))
+        return filename
+
+    def build_data(self, base_path):
+        """
+        Builds the Data of a single event, with the label of each photon of the uncleaned event
+        :param base_path: raw filename of the event to process
+        :return: Data of the event, or None if the event is skipped or fails
+        """
+        try:
+            (
+                event_data,
+                data_format,
+                features,
+                feature_cluster,
+            ) = load_event(self.raw_dir, base_path, self.event_store)
+            uncleaned_data, _, _, _ = load_event(
+                osp.join(self.uncleaned_root, "raw"),
+                base_path,
+                self.uncleaned_store,
+            )
+            uncleaned_photons = photon_arrays(uncleaned_data[data_format["Image"]])
+            # Convert List of List to Point Cloud
+            uncleaned_cloud = arrays_to_point_cloud(*uncleaned_photons, dtype=np.float32)
+            # Photons kept by DBSCAN are found by their (CHID, time slice), instead of comparing every pair of points
+            point_values = in_photons(
+                uncleaned_photons, event_data[data_format["Image"]]
+            ).astype(int)
+            if self.clumps:
+                clump_data, _, _, _ = load_event(
+                    osp.join(self.clump_root, "raw"),
+                    base_path,
+                    self.clump_store,
+                )
+                # Convert to ints so that addition works, gives 0 for outside, 1 clump, 2 core
+                point_values += in_photons(
+                    uncleaned_photons, clump_data[data_format["Image"]]
+                ).astype(int)
+            data = Data(
+                pos=torch.tensor(uncleaned_cloud, dtype=torch.float).squeeze(), y=point_values
+            )  # Just need x,y,z ignore derived features
+            if self.fixed_size is not None:
+                data = self.fixed_size(data)
+            if self.pre_filter is not None and not self.pre_filter(data):
                 return
 
-    def process(self):
+            if self.pre_transform is not None:
+                data = self.pre_transform(data)
+            return data
+        except Exception as e:
+            print(f"Failed: {e}")
+            return
 
-        used_paths = split_data(self.raw_file_names)[self.split]
-        pool = Pool()
-        processors = pool.map_async(self.process_file, used_paths)
-        processors.wait()
+    def process(self):
+        if load_processed(self):
+            return
+        used_paths = split_data(
+            self.raw_file_names, cache_name=f"{self.cleanliness}_raw_names"
+        )[self.split]
+        if self.shard_size is not None:
+            events = imap_events(self.build_data, used_paths, self.workers, self.chunksize)
+            self.shards = CollatedShards.write(
+                self.processed_dir, self.processed_prefix, events, self.shard_size
+            )
+        else:
+            # Filenames come back from the workers, appending to the list in a worker would be lost
+            self.existing_filenames = existing_filenames(self.processed_dir)
+            events = imap_events(self.process_file, used_paths, self.workers, self.chunksize)
+            self.processed_filenames = [filename for filename in events if filename is not None]
+            write_manifest(self.manifest_path, self.processed_filenames)
         print("Done Processing!")
 
     def len(self):
+        if self.shards is not None:
+            return len(self.shards)
         return len(self.processed_file_names)
 
     def get(self, idx):
+        if self.shards is not None:
+            return Data(**self.shards.get(idx))
         data = torch.load(
             osp.join(self.processed_dir, self.processed_file_names[idx])
         )
@@ -690,18 +1530,73 @@ def split_train_test_by_id(data, test_ratio):
     return data[~in_test_set], data[in_test_set]
 
 
-def split_data(paths, val_split=0.2, test_split=0.2):
+def split_assignment(paths, val_split=0.2, test_split=0.2):
+    """
+    Assigns each path to a split, the same as split_train_test_by_id, with the checksum of each path computed once
+    :param paths: The paths to do the splitting on
+    :param test_split: Fraction of the data for the test set
+    :param val_split: Fraction of data in validation set
+    :return: uint8 array of the split of each path, 0 for train, 1 for val and 2 for test
+    """
+    identifier_hashes = np.fromiter(
+        (crc32(np.int64(crc32(str(x).encode()))) & 0xFFFFFFFF for x in paths),
+        dtype=np.uint64,
+        count=len(paths),
+    )
+    in_test_set = identifier_hashes < (val_split + test_split) * 2 ** 32
+    # The validation set is the part of the test set that is not in the second, val_split, test set
+    in_val_set = in_test_set & (identifier_hashes >= val_split * 2 ** 32)
+    return (2 * in_test_set - in_val_set).astype(np.uint8)
+
+
+def cached_split_assignment(paths, cache_name, val_split=0.2, test_split=0.2):
+    """
+    split_assignment, saved next to the raw names resources the first time so later datasets memory map it
+
+    The cache is named by a checksum of the paths, so a list of paths that changes, even to the same number of paths,
+    gets its split computed again instead of reusing the split of the old list
+    :param paths: The paths to do the splitting on
+    :param cache_name: Name of the list of paths, such as the name of its raw names resource
+    :param test_split: Fraction of the data for the test set
+    :param val_split: Fraction of data in validation set
+    :return: uint8 array of the split of each path, 0 for train, 1 for val and 2 for test
+    """
+    checksum = crc32("\n".join(str(path) for path in paths).encode())
+    cache_path = res.resource_filename(
+        "factnn.data.resources",
+        f"{cache_name}_split_{val_split}_{test_split}_{checksum:08x}.npy",
+    )
+    if osp.exists(cache_path):
+        assignment = np.load(cache_path, mmap_mode="r")
+        if len(assignment) == len(paths):
+            return assignment
+    assignment = split_assignment(paths, val_split, test_split)
+    try:
+        np.save(cache_path, assignment)
+    except OSError:
+        pass  # Resources are not writable, so it is computed again next time
+    return assignment
+
+
+def split_data(paths, val_split=0.2, test_split=0.2, cache_name=None):
     """
     Split up the data and return which images should go to which train, test, val directory
     :param paths: The paths to do the splitting on
     :param test_split: Fraction of the data for the test set. the validation set is rolled into the test set.
     :param val_split: Fraction of data in validation set
+    :param cache_name: Name to cache the split of the paths under with cached_split_assignment, None to not cache it
     :return: A dict containing which images go to which directory
     """
 
     print(len(paths))
-    train, test = split_train_test_by_id(np.asarray(paths), val_split + test_split)
-    val, test = split_train_test_by_id(test, val_split)
+    paths = np.asarray(paths)
+    if cache_name is None:
+        assignment = split_assignment(paths, val_split, test_split)
+    else:
+        assignment = cached_split_assignment(paths, cache_name, val_split, test_split)
+    train = paths[assignment == 0]
+    val = paths[assignment == 1]
+    test = paths[assignment == 2]
     print(train.shape)
     print(val.shape)
     print(test.shape)
@@ -2,6 +2,8 @@ import h5py
 import numpy as np
 import tensorflow.keras as keras
 
+from factnn.generator.prefetch import Prefetcher
+
 
 def print_structure(weight_file_path):
     """
@@ -140,6 +142,12 @@ class BaseModel(object):
         else:
             self.name = None
 
+        # Number of batches the generators make ahead in the background while training, 0 to not prefetch
+        if "prefetch_depth" in config:
+            self.prefetch_depth = config["prefetch_depth"]
+        else:
+            self.prefetch_depth = 0
+
         self.init()
         self.create()
 
@@ -215,15 +223,32 @@ class BaseModel(object):
             num_events = num_events
             val_num = val_num
 
-        self.model.fit_generator(
-            generator=train_generator,
-            steps_per_epoch=int(np.floor(num_events / train_generator.batch_size)),
-            epochs=self.epochs,
-            verbose=1,
-            validation_data=validate_generator,
-            callbacks=[early_stop, model_checkpoint, tensorboard],
-            validation_steps=int(np.floor(val_num / validate_generator.batch_size)),
-        )
+        steps_per_epoch = int(np.floor(num_events / train_generator.batch_size))
+        validation_steps = int(np.floor(val_num / validate_generator.batch_size))
+        if self.prefetch_depth > 0:
+            # A BaseGenerator makes one batch at a time, so one thread each is enough to keep ahead of training
+            train_prefetcher = Prefetcher(
+                train_generator, depth=self.prefetch_depth, workers=1
+            )
+            validate_prefetcher = Prefetcher(
+                validate_generator, depth=self.prefetch_depth, workers=1
+            )
+            train_generator = iter(train_prefetcher)
+            validate_generator = iter(validate_prefetcher)
+        try:
+            self.model.fit(
+                train_generator,
+                steps_per_epoch=steps_per_epoch,
+                epochs=self.epochs,
+                verbose=1,
+                validation_data=validate_generator,
+                callbacks=[early_stop, model_checkpoint, tensorboard],
+                validation_steps=validation_steps,
+            )
+        finally:
+            if self.prefetch_depth > 0:
+                train_prefetcher.close()
+                validate_prefetcher.close()
 
     def save(self):
         """
@@ -17,6 +17,24 @@ from torch_geometric.data import DataLoader
 from torch_geometric.nn import PointConv, fps, radius, global_max_pool, knn
 
 
+def dense_to_batch(pos, mask=None):
+    """
+    Converts a dense batch of point clouds to the torch_geometric batch representation
+    :param pos: (batch_size, num_points, 3) tensor of the point clouds
+    :param mask: Optional (batch_size, num_points) boolean tensor, False for padded points, which are left out
+    :return: Data with pos of (number of points, 3) and the batch vector of which point cloud each point is from
+    """
+    batch_size, num_points, _ = pos.shape
+    batch = torch.arange(batch_size, device=pos.device).repeat_interleave(num_points)
+    pos = pos.reshape(batch_size * num_points, -1)
+    if mask is not None:
+        mask = mask.reshape(-1)
+        pos, batch = pos[mask], batch[mask]
+    data = Data()
+    data.pos, data.batch = pos, batch
+    return data
+
+
 class PointNet2SAModule(torch.nn.Module):
     def __init__(self, sample_radio, radius, max_num_neighbors, mlp):
         super(PointNet2SAModule, self).__init__()
@@ -246,19 +264,18 @@ class PointNet2Segmenter(torch.nn.Module):
                     pytorch_gemometric documentation for more information
         """
         dense_input = True if isinstance(data, torch.Tensor) else False
+        mask = None
 
+        if dense_input:
+            pos = data.transpose(1, 2)  # (batch_size, num_points, 3)
+        elif data.pos.dim() == 3:
+            # Fixed size point clouds stacked by DenseDataLoader, (batch_size, num_points, 3)
+            dense_input = True
+            pos, mask = data.pos, getattr(data, "mask", None)
         if dense_input:
             # Convert to torch_geometric.data.Data type
-            data = data.transpose(1, 2).contiguous()
-            batch_size, N, _ = data.shape  # (batch_size, num_points, 3)
-            pos = data.view(batch_size * N, -1)
-            batch = torch.zeros((batch_size, N), device=pos.device, dtype=torch.long)
-            for i in range(batch_size):
-                batch[i] = i
-            batch = batch.view(-1)
-
-            data = Data()
-            data.pos, data.batch = pos, batch
+            batch_size, N, _ = pos.shape
+            data = dense_to_batch(pos, mask)
 
         if not hasattr(data, "x"):
             data.x = None
@@ -277,6 +294,11 @@ class PointNet2Segmenter(torch.nn.Module):
         x = F.log_softmax(x, dim=-1)
 
         if dense_input:
+            if mask is not None:
+                # Padded points get zero for each class
+                x = x.new_zeros((batch_size * N, self.num_classes)).masked_scatter(
+                    mask.view(-1, 1), x
+                )
             return x.view(batch_size, N, self.num_classes)
         else:
             return x, fp1_out_batch
@@ -316,19 +338,18 @@ class PointNet2(torch.nn.Module):
 
     def forward(self, data):
         dense_input = True if isinstance(data, torch.Tensor) else False
+        mask = None
 
+        if dense_input:
+            pos = data.transpose(1, 2)  # (batch_size, num_points, 3)
+        elif data.pos.dim() == 3:
+            # Fixed size point clouds stacked by DenseDataLoader, (batch_size, num_points, 3)
+            dense_input = True
+            pos, mask = data.pos, getattr(data, "mask", None)
         if dense_input:
             # Convert to torch_geometric.data.Data type
-            data = data.transpose(1, 2).contiguous()
-            batch_size, N, _ = data.shape  # (batch_size, num_points, 3)
-            pos = data.view(batch_size * N, -1)
-            batch = torch.zeros((batch_size, N), device=pos.device, dtype=torch.long)
-            for i in range(batch_size):
-                batch[i] = i
-            batch = batch.view(-1)
-
-            data = Data()
-            data.pos, data.batch = pos, batch
+            batch_size, N, _ = pos.shape
+            data = dense_to_batch(pos, mask)
 
         if not hasattr(data, "x"):
             data.x = None
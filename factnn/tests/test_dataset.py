@@ -0,0 +1,337 @@
+import os
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+import torch
+from torch_geometric.data import Data
+
+import h5py
+
+from factnn.data.dataset.event_store import EventStore, EventStoreWriter
+from factnn.data.dataset.hdf5 import create_dataset
+from factnn.data.preprocess.eventfile_preprocessor import EventFilePreprocessor
+from factnn.generator.pytorch import datasets
+from factnn.generator.pytorch.datasets import (
+    BalancedSampler,
+    CollatedShards,
+    EventCache,
+    EventDataset,
+    FixedSizePoints,
+    existing_filenames,
+    prefetch,
+    shuffle_buffer,
+    split_assignment,
+    split_train_test_by_id,
+)
+
+
+def make_event(seed):
+    rng = np.random.RandomState(seed)
+    photons = [rng.randint(0, 100, rng.poisson(2)).tolist() for _ in range(1440)]
+    data = [photons, rng.uniform(200, 5000), 20.0, 180.0, 0.1, 0.2]
+    data_format = {
+        "Image": 0,
+        "Energy": 1,
+        "Zd_Deg": 2,
+        "Az_Deg": 3,
+        "Phi": 4,
+        "Theta": 5,
+    }
+    features = {"extraction": 0, "length": rng.uniform(), "width": rng.uniform()}
+    return [data, data_format, features, None]
+
+
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.events = [make_event(seed) for seed in range(5)]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        shard = os.path.join(self.directory.name, "events")
+        with EventStoreWriter(shard) as writer:
+            for index, event in enumerate(self.events[:3]):
+                writer.append("run_" + str(index), *event)
+        # Reopening appends to the shard
+        with EventStoreWriter(shard) as writer:
+            self.assertIn("run_2", writer)
+            for index, event in enumerate(self.events[3:], start=3):
+                writer.append("run_" + str(index), *event)
+
+        store = EventStore(self.directory.name)
+        self.assertEqual(len(store), 5)
+        for index, (data, data_format, features, _) in enumerate(self.events):
+            stored_data, stored_format, stored_features, _ = store.event(
+                "run_" + str(index)
+            )
+            self.assertEqual(stored_format, data_format)
+            self.assertEqual(stored_data[0], data[0])
+            self.assertEqual(stored_data[1:], data[1:])
+            self.assertEqual(stored_features, features)
+        np.testing.assert_allclose(
+            store.column("Energy"), [event[0][1] for event in self.events]
+        )
+
+    def test_views(self):
+        shard = os.path.join(self.directory.name, "events")
+        with EventStoreWriter(shard) as writer:
+            for index, event in enumerate(self.events):
+                writer.append("run_" + str(index), *event)
+
+        store = EventStore(self.directory.name)
+        photons = self.events[2][0][0]
+        times = store.photon_times(2)
+        self.assertTrue(np.shares_memory(times, store.times(0)))
+        np.testing.assert_array_equal(times, np.concatenate(photons))
+        np.testing.assert_array_equal(
+            store.photon_chids(2),
+            np.repeat(np.arange(1440), [len(pixel) for pixel in photons]),
+        )
+        self.assertEqual(store.point_cloud(2).shape, (len(times), 3))
+
+        chids, arrays_times = store.event(2, as_arrays=True)[0][0]
+        np.testing.assert_array_equal(chids, store.photon_chids(2))
+        self.assertTrue(np.shares_memory(arrays_times, times))
+
+    def test_preprocessor_reads_store(self):
+        shard = os.path.join(self.directory.name, "events")
+        paths = []
+        with EventStoreWriter(shard) as writer:
+            for index, event in enumerate(self.events):
+                writer.append("run_" + str(index), *event)
+                paths.append(os.path.join(self.directory.name, "run_" + str(index)))
+                with open(paths[-1], "wb") as event_file:
+                    pickle.dump(event, event_file)
+
+        configuration = {"paths": [], "rebin_size": 5, "shape": [30, 70]}
+        from_files = EventFilePreprocessor(config=configuration).on_files_processor(
+            paths, collapse_time=False
+        )
+        configuration["event_store"] = self.directory.name
+        from_store = EventFilePreprocessor(config=configuration).on_files_processor(
+            ["run_" + str(index) for index in range(5)], collapse_time=False
+        )
+        self.assertEqual(len(from_store), 5)
+        for (file_data, _), (store_data, _) in zip(from_files, from_store):
+            np.testing.assert_allclose(file_data[0], store_data[0])
+            self.assertEqual(file_data[1], store_data[1])
+
+
+class TestCollatedShards(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        data_list = [
+            Data(
+                pos=torch.tensor(rng.uniform(size=(rng.randint(1, 50), 3))),
+                energy=torch.tensor([index], dtype=torch.long),
+                features=torch.tensor(rng.uniform(size=8)),
+            )
+            for index in range(5)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            CollatedShards.write(
+                directory, "events", data_list[:2] + [None] + data_list[2:], 2
+            )
+            self.assertTrue(CollatedShards.exists(directory, "events"))
+            shards = CollatedShards(directory, "events")
+            self.assertEqual(len(shards), 5)
+            self.assertEqual(len(shards.files), 3)
+            for index, data in enumerate(data_list):
+                event = shards.get(index)
+                for key in ["pos", "energy", "features"]:
+                    np.testing.assert_array_equal(event[key], data[key])
+            shards = CollatedShards(directory, "events")
+            event = shards.get(3, ["pos"])
+            self.assertEqual(list(event), ["pos"])
+            self.assertEqual(list(shards.loaded), [(1, "pos")])
+            self.assertTrue(
+                np.shares_memory(
+                    event["pos"].numpy(), shards.field(1, "pos")[0].numpy()
+                )
+            )
+
+
+class TestExistingFilenames(unittest.TestCase):
+    def test_skips_saved_events(self):
+        with tempfile.TemporaryDirectory() as directory:
+            open(os.path.join(directory, "event_1.pt"), "wb").close()
+            self.assertEqual(existing_filenames(directory), {"event_1.pt"})
+            self.assertEqual(
+                existing_filenames(os.path.join(directory, "missing")), set()
+            )
+            dataset = EventDataset.__new__(EventDataset)
+            dataset.fixed_size = None
+            dataset.existing_filenames = existing_filenames(directory)
+            with unittest.mock.patch.object(
+                EventDataset, "build_data", return_value=None
+            ):
+                self.assertEqual(dataset.process_file(False, "event_1"), "event_1.pt")
+                self.assertIsNone(dataset.process_file(False, "event_2"))
+                EventDataset.build_data.assert_called_once_with(False, "event_2")
+
+
+class TestSplitAssignment(unittest.TestCase):
+    def test_matches_split_by_id(self):
+        paths = np.asarray(["event_" + str(index) for index in range(2000)])
+        train, test = split_train_test_by_id(paths, 0.4)
+        val, test = split_train_test_by_id(test, 0.2)
+        assignment = split_assignment(paths, 0.2, 0.2)
+        np.testing.assert_array_equal(paths[assignment == 0], train)
+        np.testing.assert_array_equal(paths[assignment == 1], val)
+        np.testing.assert_array_equal(paths[assignment == 2], test)
+
+    def test_cache_follows_paths(self):
+        paths = ["event_" + str(index) for index in range(200)]
+        # The same number of names, but different ones, as from a regenerated raw names resource
+        renamed = ["run_" + str(index) for index in range(200)]
+        with tempfile.TemporaryDirectory() as directory:
+            with unittest.mock.patch.object(
+                datasets.res,
+                "resource_filename",
+                lambda package, name: os.path.join(directory, name),
+            ):
+                cached = datasets.cached_split_assignment(paths, "names")
+                np.testing.assert_array_equal(cached, split_assignment(paths))
+                self.assertIsInstance(
+                    datasets.cached_split_assignment(paths, "names"), np.memmap
+                )
+                np.testing.assert_array_equal(
+                    datasets.cached_split_assignment(renamed, "names"),
+                    split_assignment(renamed),
+                )
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+
+class TestFixedSizePoints(unittest.TestCase):
+    def test_sample_and_pad(self):
+        data = Data(pos=torch.rand(10, 3), y=torch.arange(10))
+        for method in ["random", "fps"]:
+            sampled = FixedSizePoints(4, method, point_keys=("pos", "y"))(data.clone())
+            self.assertEqual(sampled.pos.shape, (4, 3))
+            self.assertTrue(sampled.mask.all())
+            np.testing.assert_array_equal(sampled.pos, data.pos[sampled.y])
+        padded = FixedSizePoints(16)(data.clone())
+        self.assertEqual(padded.pos.shape, (16, 3))
+        np.testing.assert_array_equal(padded.mask, np.arange(16) < 10)
+        np.testing.assert_array_equal(padded.pos[:10], data.pos)
+        self.assertEqual(float(padded.pos[10:].abs().sum()), 0.0)
+
+
+class TestStreaming(unittest.TestCase):
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(iter(range(100)), 4)), list(range(100)))
+
+        def failing():
+            yield 1
+            raise IOError("Broken file")
+
+        with self.assertRaises(IOError):
+            list(prefetch(failing(), 4))
+
+        closed = []
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.append(True)
+
+        # Stopping early stops the thread, which closes the source instead of blocking on the full queue
+        events = prefetch(endless(), 2)
+        self.assertEqual(next(events), 1)
+        events.close()
+        self.assertEqual(closed, [True])
+
+    def test_shuffle_buffer(self):
+        shuffled = list(shuffle_buffer(range(100), 10, np.random.RandomState(0)))
+        self.assertEqual(sorted(shuffled), list(range(100)))
+        self.assertNotEqual(shuffled, list(range(100)))
+        # An item can only be moved forward by the size of the buffer
+        self.assertTrue(all(item <= index + 10 for index, item in enumerate(shuffled)))
+
+
+class TestEventCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        loaded = []
+
+        def load(idx):
+            loaded.append(idx)
+            return Data(pos=torch.full((10, 3), float(idx)))
+
+        # Room for two events of 120 bytes
+        cache = EventCache(300)
+        for idx in [0, 1, 0, 2, 0, 1]:
+            data = cache.get(idx, load)
+            self.assertEqual(float(data.pos[0, 0]), idx)
+        # 1 is evicted by 2, as 0 was used more recently
+        self.assertEqual(loaded, [0, 1, 2, 1])
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 240)
+
+    def test_copies(self):
+        cache = EventCache(1000)
+        data = cache.get(0, lambda idx: Data(pos=torch.zeros(2, 3)))
+        data.pos = torch.ones(2, 3)
+        self.assertEqual(float(cache.get(0, None).pos.sum()), 0.0)
+
+
+class TestBalancedSampler(unittest.TestCase):
+    def test_balanced(self):
+        labels = torch.tensor([1, 0, 1, 1, 1, 0, 1, 1, 0, 1])
+        sampler = BalancedSampler(labels, generator=torch.Generator().manual_seed(0))
+        epochs = [list(sampler) for _ in range(10)]
+        for indices in epochs:
+            self.assertEqual(len(indices), len(sampler))
+            self.assertEqual(len(set(indices)), 6)
+            self.assertEqual(int(labels[indices].sum()), 3)
+        # Every epoch draws the gammas again
+        self.assertEqual(len(set(sum(epochs, []))), 10)
+
+    def test_fraction(self):
+        labels = torch.cat([torch.zeros(100), torch.ones(300)])
+        sampler = BalancedSampler(labels, balanced=False, fraction=0.1)
+        indices = list(sampler)
+        self.assertEqual(len(indices), 40)
+        self.assertEqual(int(labels[indices].sum()), 30)
+
+
+class BatchPreprocessor(object):
+    def __init__(self, batches):
+        self.batches = batches
+
+    def batch_processor(self):
+        for batch in self.batches:
+            yield batch, {"Image": 0, "Energy": 1}
+
+    def format(self, batch):
+        images, energies = zip(*batch)
+        return np.array(images), np.array(energies)
+
+
+class TestCreateDataset(unittest.TestCase):
+    def test_chunks(self):
+        rng = np.random.RandomState(0)
+        batches = [
+            [(rng.rand(10, 46, 45).astype(np.float32), rng.rand()) for _ in range(n)]
+            for n in [30, 12]
+        ]
+        output_file = os.path.join(tempfile.mkdtemp(), "output.hdf5")
+        create_dataset(BatchPreprocessor(batches), output_file, chunk_bytes=10**6)
+        with h5py.File(output_file, "r") as hdf:
+            # 12 events of 82800 bytes fit in a chunk
+            self.assertEqual(hdf["Image"].chunks, (12, 10, 46, 45))
+            self.assertEqual(hdf["Energy"].shape, (42,))
+            np.testing.assert_array_equal(
+                hdf["Image"][30:], [image for image, _ in batches[1]]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,24 @@
+import os
+import tempfile
 import unittest
+
+import h5py
+import numpy as np
+
+from factnn.generator.prefetch import Prefetcher
+from factnn.utils import augment
 from factnn.generator.generator.energy_generators import EnergyGenerator
 from factnn.generator.generator.separation_generators import SeparationGenerator
 from factnn.generator.generator.source_generators import DispGenerator, SignGenerator
 
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+if tf is not None:
+    from factnn.utils.cross_validate import fit_model, model_evaluate
+
 
 class TestEnergyGenerator(unittest.TestCase):
     def setUp(self):
@@ -190,5 +206,130 @@ class TestSignGenerator(unittest.TestCase):
         return NotImplemented
 
 
+class TestHDF5Dataset(unittest.TestCase):
+    def test_reuse_and_fork(self):
+        path = os.path.join(tempfile.mkdtemp(), "images.hdf5")
+        images = np.random.rand(20, 5, 8, 8)
+        with h5py.File(path, "w") as hdf:
+            hdf.create_dataset("Image", data=images, chunks=(4, 5, 8, 8))
+        dataset = augment.hdf5_dataset(path)
+        self.assertIs(augment.hdf5_dataset(path), dataset)
+        np.testing.assert_array_equal(dataset[[1, 5, 7]], images[[1, 5, 7]])
+        # A forked process opens the file again
+        augment._hdf5_pid = None
+        reopened = augment.hdf5_dataset(path)
+        self.assertIsNot(reopened, dataset)
+        np.testing.assert_array_equal(reopened[:], images)
+        augment.close_hdf5_files()
+        self.assertFalse(reopened.id.valid)
+
+
+class TestChunkShuffler(unittest.TestCase):
+    def test_batches(self):
+        path = os.path.join(tempfile.mkdtemp(), "chunked.hdf5")
+        images = np.arange(100 * 6).reshape(100, 6, 1)
+        with h5py.File(path, "w") as hdf:
+            hdf.create_dataset("Image", data=images, chunks=(8, 6, 1))
+        indicies = np.random.RandomState(0).choice(100, 64, replace=False)
+        shuffler = augment.ChunkShuffler(indicies, 8, buffer_size=20, seed=0)
+        dataset = augment.hdf5_dataset(path)
+        drawn = []
+        for _ in range(16):
+            positions, (batch,) = shuffler.batch(8, [dataset], 2, 3)
+            np.testing.assert_array_equal(batch, images[positions, 2:5])
+            drawn.extend(positions)
+        # Two passes over the chunks draw every event
+        self.assertEqual(set(drawn), set(indicies))
+        self.assertNotEqual(drawn[:64], sorted(drawn[:64]))
+
+
+class TestImageAugmenter(unittest.TestCase):
+    def test_same_as_per_image(self):
+        images = np.random.rand(64, 3, 6, 6, 1)
+        collapsed_images = np.random.rand(64, 6, 6, 1)
+        transforms = augment.random_dihedral_transforms(64)
+        augmented = augment.apply_dihedral_transforms(images, transforms, (2, 3))
+        augmented_collapsed = augment.apply_dihedral_transforms(
+            collapsed_images, transforms, (1, 2)
+        )
+        for index, transform in enumerate(transforms):
+            flip_x, flip_y, rotation = augment.DIHEDRAL_TRANSFORMS[transform]
+            image = images[index]
+            collapsed_image = collapsed_images[index]
+            if flip_x:
+                image = np.flip(image, 1)
+                collapsed_image = np.flip(collapsed_image, 0)
+            if flip_y:
+                image = np.flip(image, 2)
+                collapsed_image = np.flip(collapsed_image, 1)
+            image = np.rot90(image, rotation, axes=(1, 2))
+            collapsed_image = np.rot90(collapsed_image, rotation, axes=(0, 1))
+            np.testing.assert_array_equal(augmented[index], image)
+            np.testing.assert_array_equal(augmented_collapsed[index], collapsed_image)
+
+    def test_transforms(self):
+        self.assertEqual(len(augment.DIHEDRAL_TRANSFORMS), 8)
+        transforms = augment.random_dihedral_transforms(10000)
+        self.assertEqual(set(transforms), set(range(8)))
+        images = np.random.rand(50, 4, 4, 2)
+        augmented = augment.image_augmenter(images, as_channels=True)
+        self.assertEqual(augmented.shape, images.shape)
+        # Every pixel stays in its image
+        np.testing.assert_allclose(augmented.sum(axis=(1, 2)), images.sum(axis=(1, 2)))
+
+
+class BatchSequence(object):
+    def __init__(self):
+        self.order = np.arange(10)
+        self.epochs = 0
+
+    def __len__(self):
+        return 5
+
+    def __getitem__(self, index):
+        positions = self.order[2 * index : 2 * index + 2]
+        return [np.full((2, 4, 4), positions[0]), positions], positions * 2
+
+    def on_epoch_end(self):
+        self.epochs += 1
+        self.order = self.order[::-1].copy()
+
+
+class ToySequence(object):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        x = np.random.RandomState(index).rand(8, 3).astype(np.float32)
+        return x, x.sum(axis=1, keepdims=True)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_sequence(self):
+        for processes in [False, True]:
+            sequence = BatchSequence()
+            with Prefetcher(
+                sequence, depth=3, workers=2, processes=processes
+            ) as batches:
+                first = [int(next(batches)[1][0]) for _ in range(12)]
+            self.assertEqual(first, [0, 4, 8, 12, 16, 18, 14, 10, 6, 2, 0, 4])
+            self.assertEqual(sequence.epochs, 2)
+
+    def test_iterator(self):
+        batches = Prefetcher(iter(range(20)), depth=4, workers=2)
+        self.assertEqual(sorted(next(batches) for _ in range(20)), list(range(20)))
+        batches.close()
+
+    @unittest.skipUnless(tf is not None, "tensorflow is not installed")
+    def test_fit(self):
+        model = tf.keras.Sequential([tf.keras.Input((3,)), tf.keras.layers.Dense(1)])
+        # Without learning the validation loss never improves, so early stopping ends fit after a few epochs
+        model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.0), loss="mse")
+        model = fit_model(model, ToySequence(), ToySequence(), workers=2, verbose=0)
+        self.assertGreater(len(model.history.epoch), 1)
+        loss = model_evaluate(model, ToySequence(), workers=2)
+        self.assertAlmostEqual(loss, model.history.history["val_loss"][-1], places=4)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,144 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from factnn.data.dataset.event_store import EventStoreWriter
+from factnn.data.preprocess.eventfile_preprocessor import EventFilePreprocessor
+from factnn.utils.augment import DIHEDRAL_TRANSFORMS, dihedral_view, image_augmenter
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+if tf is not None:
+    from factnn.generator.keras.dataset import (
+        augment_images,
+        event_file_dataset,
+        path_dataset,
+    )
+    from factnn.generator.keras.eventfile_generator import EventFileGenerator
+
+
+def make_event(seed):
+    rng = np.random.RandomState(seed)
+    photons = [rng.randint(30, 70, rng.poisson(2)).tolist() for _ in range(1440)]
+    data = [photons, rng.uniform(200, 5000), 20.0, 180.0, 0.1, 0.2]
+    data_format = {
+        "Image": 0,
+        "Energy": 1,
+        "Zd_Deg": 2,
+        "Az_Deg": 3,
+        "Phi": 4,
+        "Theta": 5,
+    }
+    features = {"extraction": 0, "length": rng.uniform(), "width": rng.uniform()}
+    return [data, data_format, features, None]
+
+
+def transform_index(image, original, axes):
+    """
+    :return: Index into DIHEDRAL_TRANSFORMS of the transform that gives image from original, None if there is none
+    """
+    for index, transform in enumerate(DIHEDRAL_TRANSFORMS):
+        if np.array_equal(image, dihedral_view(original, *transform, axes=axes)):
+            return index
+    return None
+
+
+@unittest.skipUnless(tf is not None, "tensorflow is not installed")
+class TestEventFileDataset(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        # Two shards, so the paths are interleaved over more than one group
+        for shard in range(2):
+            with EventStoreWriter(
+                os.path.join(self.directory.name, "events_" + str(shard))
+            ) as writer:
+                for index in range(5):
+                    name = "run_{}_{}".format(shard, index)
+                    writer.append(name, *make_event(shard * 5 + index))
+                    self.paths.append(name)
+        self.preprocessor = EventFilePreprocessor(
+            config={
+                "paths": [],
+                "rebin_size": 5,
+                "shape": [30, 70],
+                "event_store": self.directory.name,
+            }
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_matches_load_batch(self):
+        generator = EventFileGenerator(
+            paths=self.paths,
+            batch_size=3,
+            preprocessor=self.preprocessor,
+            training_type="Energy",
+            final_slices=5,
+            slices=(30, 70),
+        )
+        paths = [
+            path.decode()
+            for path in path_dataset(
+                self.preprocessor, self.paths, cycle_length=2
+            ).as_numpy_iterator()
+        ]
+        self.assertEqual(sorted(paths), sorted(self.paths))
+        # Interleaving takes events from both shards within the first batch
+        self.assertEqual(len({path.split("_")[1] for path in paths[:3]}), 2)
+
+        batches = list(
+            event_file_dataset(generator, cycle_length=2).as_numpy_iterator()
+        )
+        self.assertEqual(len(batches), len(generator))
+        for batch, (images, labels) in enumerate(batches):
+            expected_images, expected_labels = generator.load_batch(
+                paths[batch * 3 : (batch + 1) * 3]
+            )
+            self.assertEqual(images.dtype, np.float32)
+            np.testing.assert_allclose(images, expected_images, rtol=1e-6)
+            np.testing.assert_allclose(labels, expected_labels, rtol=1e-6)
+
+    def test_augment_images(self):
+        tf.random.set_seed(0)
+        np.random.seed(0)
+        for as_channels in (False, True):
+            axes = (1, 2) if as_channels else (2, 3)
+            shape = (4000, 4, 4, 2) if as_channels else (4000, 2, 4, 4, 1)
+            images = np.random.uniform(size=shape).astype(np.float32)
+            labels = np.arange(len(images))
+            augmented, augmented_labels = augment_images(
+                tf.constant(images), tf.constant(labels), as_channels
+            )
+            augmented = augmented.numpy()
+            augmented_labels = augmented_labels.numpy()
+            # The batch is shuffled, with the labels following their images
+            self.assertEqual(sorted(augmented_labels), list(labels))
+            self.assertFalse(np.array_equal(augmented_labels, labels))
+            image_axes = (axes[0] - 1, axes[1] - 1)
+            transforms = [
+                transform_index(image, images[label], image_axes)
+                for image, label in zip(augmented, augmented_labels)
+            ]
+            # Each image is one of the flips and rotations image_augmenter chooses between, as often as it does
+            self.assertNotIn(None, transforms)
+            expected = [
+                transform_index(image, original, image_axes)
+                for image, original in zip(image_augmenter(images, as_channels), images)
+            ]
+            np.testing.assert_allclose(
+                np.bincount(transforms, minlength=len(DIHEDRAL_TRANSFORMS))
+                / len(images),
+                np.bincount(expected, minlength=len(DIHEDRAL_TRANSFORMS)) / len(images),
+                atol=0.03,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
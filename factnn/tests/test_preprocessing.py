@@ -1,6 +1,47 @@
+import gzip
+import os
+import tempfile
 import unittest
+from types import SimpleNamespace
+from unittest import mock
 
-from factnn.data.preprocess.simulation_preprocessors import GammaPreprocessor
+import numpy as np
+import pandas as pd
+from fact.io import to_h5py
+from photon_stream.geometry import GEOMETRY
+from photon_stream.representations import (
+    list_of_lists_to_raw_phs,
+    raw_phs_to_point_cloud,
+)
+
+from factnn.data.dataset.event_store import EventStore
+from factnn.data.preprocess.base_preprocessor import (
+    BasePreprocessor,
+    events_in_range,
+    range_file_name,
+)
+from factnn.data.preprocess import simulation_preprocessors
+from factnn.data.preprocess.clustering import GridDBSCAN, SklearnDBSCAN
+from factnn.data.preprocess.simulation_preprocessors import (
+    GammaPreprocessor,
+    GammaDiffusePreprocessor,
+)
+from factnn.data.preprocess.eventfile_preprocessor import EventFilePreprocessor
+from factnn.utils.io import (
+    convert_events,
+    count_events_in_file,
+    manifest_key,
+    read_manifest,
+    split_event_ranges,
+)
+from factnn.utils.phs import (
+    raw_to_arrays,
+    arrays_to_raw,
+    arrays_to_point_cloud,
+    list_of_lists_to_arrays,
+    photons_to_point_clouds,
+    in_photons,
+)
 
 
 class TestProtonPreprocessor(unittest.TestCase):
@@ -48,6 +89,102 @@ class TestGammaPreprocessor(unittest.TestCase):
         return NotImplemented
 
 
+def make_dl2():
+    columns = [
+        "event_num",
+        "source_position_x",
+        "source_position_y",
+        "cog_x",
+        "cog_y",
+        "delta",
+        "source_position_az",
+        "source_position_zd",
+        "aux_pointing_position_az",
+        "aux_pointing_position_zd",
+        "corsika_event_header_total_energy",
+        "corsika_event_header_az",
+        "run_id",
+    ]
+    dl2 = pd.DataFrame({column: np.zeros(5) for column in columns})
+    dl2["event_num"] = np.arange(5)
+    dl2["run_id"] = [2, 1, 2, 1, 2]
+    dl2["corsika_event_header_total_energy"] = [300.0, 300.0, 150.0, 2000.0, 300.0]
+    return dl2
+
+
+class TestGammaDiffusePreprocessor(unittest.TestCase):
+    def test_dl2_event(self):
+        with tempfile.TemporaryDirectory() as directory:
+            dl2_file = os.path.join(directory, "dl2.hdf5")
+            to_h5py(make_dl2(), dl2_file, key="events")
+            preprocessor = GammaDiffusePreprocessor(
+                config={"paths": [], "rebin_size": 5, "dl2_file": dl2_file}
+            )
+
+        def event(run, energy):
+            return SimpleNamespace(
+                simulation_truth=SimpleNamespace(
+                    run=run, air_shower=SimpleNamespace(energy=energy)
+                )
+            )
+
+        # First matching row, like the np.isclose mask over the whole file
+        self.assertEqual(
+            preprocessor.dl2_event(event(2, 300.001))["event_num"].values[0], 0
+        )
+        self.assertEqual(
+            preprocessor.dl2_event(event(1, 300.0))["event_num"].values[0], 1
+        )
+        self.assertTrue(preprocessor.dl2_event(event(1, 150.0)).empty)
+        self.assertTrue(preprocessor.dl2_event(event(3, 300.0)).empty)
+
+    def test_packed_round_trip(self):
+        dl2 = make_dl2()
+        dl2["cog_x"] = [1.5, 2.5, 3.5, 4.5, 5.5]
+        photons = [[] for _ in range(1440)]
+        photons[7] = [30, 31, 45]
+        event = SimpleNamespace(
+            photon_stream=SimpleNamespace(list_of_lists=photons),
+            simulation_truth=SimpleNamespace(
+                run=1, air_shower=SimpleNamespace(energy=300.0)
+            ),
+            zd=20.0,
+            az=180.0,
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            dl2_file = os.path.join(directory, "dl2.hdf5")
+            to_h5py(dl2, dl2_file, key="events")
+            preprocessor = GammaDiffusePreprocessor(
+                config={
+                    "paths": ["run.phs.jsonl.gz"],
+                    "rebin_size": 5,
+                    "dl2_file": dl2_file,
+                }
+            )
+            output = os.path.join(directory, "events")
+            os.makedirs(output)
+            with mock.patch.object(
+                simulation_preprocessors.ps,
+                "SimulationReader",
+                lambda photon_stream_path, mmcs_corsika_path: iter([event]),
+            ), mock.patch.object(
+                simulation_preprocessors,
+                "extract_single_simulation_features",
+                lambda event, cluster=None, min_samples=None: (
+                    {"length": 2.0, "width": 1.0},
+                    None,
+                ),
+            ):
+                preprocessor.event_processor(output, packed=True)
+            store = EventStore(output)
+            self.assertEqual(len(store), 1)
+            data, data_format, features, _ = store.event("run_1")
+        self.assertEqual(data[data_format["Image"]], photons)
+        self.assertEqual(data[data_format["COG_X"]], 2.5)
+        self.assertEqual(data[data_format["Energy"]], 300.0)
+        self.assertEqual(features, {"length": 2.0, "width": 1.0})
+
+
 class TestObservationPreprocessor(unittest.TestCase):
     def setUp(self):
         self.configuration = {
@@ -69,5 +206,411 @@ class TestObservationPreprocessor(unittest.TestCase):
         return NotImplemented
 
 
+class TestEventFilePreprocessor(unittest.TestCase):
+    def setUp(self):
+        self.configuration = {
+            "paths": [],
+            "rebin_size": 5,
+            "shape": [30, 70],
+        }
+
+    def test_rebinning(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        self.assertEqual(preprocessor.rebinning.shape, (25, 1440))
+
+        photons = [[] for _ in range(1440)]
+        photons[100] = [30, 31, 31, 69, 70, 12]
+        image = preprocessor.rebin_photons(photons)
+        self.assertEqual(image.shape, (5, 5, 40))
+
+        weights = preprocessor.rebinning[:, 100].toarray().reshape(5, 5)
+        np.testing.assert_allclose(image[:, :, 0], weights)
+        np.testing.assert_allclose(image[:, :, 1], 2 * weights)
+        np.testing.assert_allclose(image[:, :, 39], weights)
+        # Photons outside of [start, end) are dropped
+        self.assertAlmostEqual(image.sum(), 4 * weights.sum())
+
+    def test_clip_end(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        photons = [[] for _ in range(1440)]
+        photons[100] = [30, 75, 90]
+        image = preprocessor.rebin_photons(photons, end=100, clip_end=True)
+        weights = preprocessor.rebinning[:, 100].toarray().reshape(5, 5)
+        np.testing.assert_allclose(image[:, :, 39], 2 * weights)
+
+    def test_generate_rebinning(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        generated = preprocessor.generate_rebinning(5).toarray()
+        self.assertEqual(generated.shape, (25, 1440))
+        # Overlap fractions of the shapely sweep in the rebinning_5.p table that used to be shipped, by CHID and
+        # grid index, including its duplicate of the first square
+        reference = {
+            1: {7: 0.9952060126632564},
+            70: {
+                6: 0.061208652651498226,
+                7: 0.8546506952429164,
+                12: 0.08414065210558523,
+            },
+            91: {
+                0: 0.20733153832546866,
+                5: 0.20733153832546866,
+                6: 0.7085278095689461,
+                10: 0.003899062554745986,
+                11: 0.08024158955083929,
+            },
+            1000: {24: 1.0},
+        }
+        for chid, fractions in reference.items():
+            expected = np.zeros(25)
+            expected[list(fractions)] = list(fractions.values())
+            np.testing.assert_allclose(generated[:, chid], expected, atol=1e-12)
+        # The shipped float32 table is generated the same way
+        np.testing.assert_allclose(
+            generated, preprocessor.rebinning.toarray(), atol=1e-7
+        )
+        self.assertIsNone(preprocessor.shipped_rebinning(1000))
+
+    def test_cached_rebinning(self):
+        with tempfile.TemporaryDirectory() as cache:
+            configuration = dict(self.configuration, rebinning_cache=cache)
+            preprocessor = EventFilePreprocessor(config=configuration)
+            generated = preprocessor.cached_rebinning(7)
+            self.assertTrue(os.path.isfile(os.path.join(cache, "rebinning_7.npz")))
+            cached = preprocessor.cached_rebinning(7)
+            # Mapped read-only from the cache file instead of read into memory
+            self.assertFalse(cached.data.flags.writeable)
+            np.testing.assert_allclose(cached.toarray(), generated.toarray())
+            # A corrupt cache file is generated again
+            with open(os.path.join(cache, "rebinning_7.npz"), "wb") as cache_file:
+                cache_file.write(b"corrupt")
+            with self.assertWarns(UserWarning):
+                regenerated = preprocessor.cached_rebinning(7)
+            np.testing.assert_allclose(regenerated.toarray(), generated.toarray())
+
+    def test_rebin_batch(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        first = [[] for _ in range(1440)]
+        first[100] = [30, 31, 31, 69, 70, 12]
+        first[1439] = [45, 45]
+        second = [[] for _ in range(1440)]
+        second[7] = [50, 60, 95]
+        images = preprocessor.rebin_batch(
+            [first, second], starts=[30, 40], ends=[70, 80], clip_end=True
+        )
+        self.assertEqual(images.shape, (2, 5, 5, 40))
+        self.assertEqual(images.dtype, np.float32)
+        np.testing.assert_allclose(
+            images[0], preprocessor.rebin_photons(first, 30, 70, clip_end=True)
+        )
+        np.testing.assert_allclose(
+            images[1], preprocessor.rebin_photons(second, 40, 80, clip_end=True)
+        )
+        # The tables of the operator are rebuilt when it is replaced
+        preprocessor.rebinning = preprocessor.rebinning * 2
+        np.testing.assert_allclose(
+            preprocessor.rebin_batch([second], starts=40, ends=80)[0],
+            preprocessor.rebin_photons(second, 40, 80),
+        )
+
+    def test_select_clustered_photons(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        photons = [[] for _ in range(1440)]
+        photons[3] = [10, 20]
+        photons[1000] = [30, 31, 32]
+        chids, times = raw_to_arrays(list_of_lists_to_raw_phs(photons))
+        np.testing.assert_array_equal(chids, [3, 3, 1000, 1000, 1000])
+        point_cloud = arrays_to_point_cloud(chids, times)
+
+        dbscan = SimpleNamespace(
+            labels_=np.array([-1, 0, 0, 0, -1]),
+            core_sample_indices_=np.array([1, 2]),
+        )
+        clump = [[] for _ in range(1440)]
+        clump[3] = [20]
+        clump[1000] = [30, 31]
+        core = [[] for _ in range(1440)]
+        core[3] = [20]
+        core[1000] = [30]
+        for pixel_chids in (chids, None):
+            np.testing.assert_array_equal(
+                preprocessor.select_clustered_photons(
+                    dbscan, point_cloud, debug=False, only_core=False, chids=pixel_chids
+                ),
+                list_of_lists_to_raw_phs(clump),
+            )
+            np.testing.assert_array_equal(
+                preprocessor.select_clustered_photons(
+                    dbscan, point_cloud, debug=False, chids=pixel_chids
+                ),
+                list_of_lists_to_raw_phs(core),
+            )
+        dbscan.labels_[:] = -1
+        self.assertIsNone(preprocessor.select_clustered_photons(dbscan, point_cloud))
+
+    def test_dynamic_size(self):
+        preprocessor = EventFilePreprocessor(config=self.configuration)
+        photons = [[] for _ in range(1440)]
+        self.assertEqual(preprocessor.dynamic_size(photons), (-1, -1, -1, -1))
+        photons[3] = [10, 20]
+        photons[1000] = [30]
+        start, end, mean, std = preprocessor.dynamic_size(photons)
+        self.assertEqual((start, end), (10, 30))
+        self.assertAlmostEqual(mean, 20.0)
+
+
+class TestPointClouds(unittest.TestCase):
+    def test_photons_to_point_clouds(self):
+        rng = np.random.RandomState(0)
+        events = [
+            [sorted(rng.randint(0, 100, rng.poisson(2)).tolist()) for _ in range(1440)]
+            for _ in range(3)
+        ]
+        # The event store gives the photons as (chids, times) arrays
+        point_clouds = photons_to_point_clouds(
+            events[:2] + [list_of_lists_to_arrays(events[2])]
+        )
+        self.assertEqual(len(point_clouds), 3)
+        for event, point_cloud in zip(events, point_clouds):
+            self.assertEqual(point_cloud.dtype, np.float32)
+            expected = raw_phs_to_point_cloud(
+                list_of_lists_to_raw_phs(event),
+                cx=GEOMETRY.x_angle,
+                cy=GEOMETRY.y_angle,
+            )
+            np.testing.assert_allclose(point_cloud, expected, rtol=1e-6)
+
+    def test_in_photons(self):
+        photons = [[] for _ in range(1440)]
+        photons[3] = [10, 10, 20]
+        photons[1000] = [20, 31]
+        selected = [[] for _ in range(1440)]
+        selected[3] = [10]
+        selected[1000] = [31]
+        np.testing.assert_array_equal(
+            in_photons(photons, selected), [True, True, False, False, True]
+        )
+        np.testing.assert_array_equal(
+            in_photons(list_of_lists_to_arrays(photons), [[]] * 1440), [False] * 5
+        )
+
+
+class TestClustering(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Night sky background over the whole camera and two showers
+        chids = [rng.randint(0, 1440, 2000)]
+        times = [rng.randint(0, 100, 2000)]
+        for center, start in [(400, 30), (1100, 50)]:
+            chids.append(center + rng.randint(-30, 30, 300))
+            times.append(rng.randint(start, start + 8, 300))
+        chids = np.concatenate(chids)
+        times = np.concatenate(times)
+        order = np.lexsort((times, chids))
+        self.chids = chids[order]
+        self.times = times[order]
+
+    def test_grid_matches_sklearn(self):
+        min_samples_list = [5, 10, 15, 20]
+        expected = SklearnDBSCAN().fit_many(self.chids, self.times, min_samples_list)
+        clustered = GridDBSCAN().fit_many(self.chids, self.times, min_samples_list)
+        for grid, sklearn in zip(clustered, expected):
+            np.testing.assert_array_equal(grid.labels_, sklearn.labels_)
+            np.testing.assert_array_equal(
+                grid.core_sample_indices_, sklearn.core_sample_indices_
+            )
+
+    def test_clean_image_sizes(self):
+        preprocessor = EventFilePreprocessor(
+            config={"paths": [], "rebin_size": 5, "clustering": "grid"}
+        )
+        raw = arrays_to_raw(self.chids, self.times)
+        event = SimpleNamespace(photon_stream=SimpleNamespace(raw=raw))
+        cleaned = preprocessor.clean_image_sizes(event, [10, 20])
+        self.assertEqual(list(cleaned), [10, 20])
+        for min_samples, (
+            all_photons,
+            clump_photons,
+            core_photons,
+            _,
+        ) in cleaned.items():
+            np.testing.assert_array_equal(all_photons, raw)
+            np.testing.assert_array_equal(
+                core_photons,
+                preprocessor.clean_image(event, min_samples=min_samples)[2],
+            )
+            # Core photons are a subset of the clump photons
+            self.assertLessEqual(len(core_photons), len(clump_photons))
+
+
+class TestEventProcessor(unittest.TestCase):
+    def test_no_clean_once(self):
+        rng = np.random.RandomState(0)
+        chids = np.concatenate(
+            [rng.randint(0, 1440, 500), 400 + rng.randint(-5, 5, 300)]
+        )
+        times = np.concatenate([rng.randint(0, 100, 500), rng.randint(30, 34, 300)])
+        order = np.lexsort((times, chids))
+        event = SimpleNamespace(
+            photon_stream=SimpleNamespace(
+                raw=arrays_to_raw(chids[order], times[order]), list_of_lists=[]
+            ),
+            simulation_truth=SimpleNamespace(
+                air_shower=SimpleNamespace(energy=300.0, phi=0.0, theta=0.0)
+            ),
+            zd=0.0,
+            az=0.0,
+        )
+        preprocessor = GammaPreprocessor(
+            config={
+                "paths": ["run.phs.jsonl.gz"],
+                "rebin_size": 5,
+                "clustering": "grid",
+            }
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["no_clean", "clump1000", "core1000", "clump10", "core10"]:
+                os.makedirs(os.path.join(directory, name))
+            with mock.patch.object(
+                simulation_preprocessors.ps,
+                "SimulationReader",
+                lambda photon_stream_path, mmcs_corsika_path: iter([event]),
+            ), mock.patch.object(
+                simulation_preprocessors,
+                "extract_single_simulation_features",
+                lambda event, cluster=None, min_samples=None: ({}, None),
+            ):
+                # The first clump size finds no clumps, the uncleaned event is still written
+                preprocessor.event_processor(
+                    directory, clean_images=True, clump_size=[1000, 10]
+                )
+            self.assertEqual(os.listdir(os.path.join(directory, "no_clean")), ["run_1"])
+            self.assertEqual(os.listdir(os.path.join(directory, "core10")), ["run_1"])
+            self.assertEqual(os.listdir(os.path.join(directory, "core1000")), [])
+
+
+class LineCountingPreprocessor(BasePreprocessor):
+    def __init__(self, config):
+        # First counter of a range that fails, to check it is converted again
+        self.fail_first = config.get("fail_first")
+        super().__init__(config)
+
+    def event_processor(
+        self, directory, packed=False, event_range=None, check_existing=True
+    ):
+        for file in self.paths:
+            if event_range[0] == self.fail_first:
+                raise ValueError("Corrupt event")
+            file_name = os.path.basename(file).split(".phs")[0]
+            for counter, line in events_in_range(
+                open, file, event_range, self.range_directory
+            ):
+                with open(
+                    os.path.join(directory, file_name + "_" + str(counter)), "w"
+                ) as event_file:
+                    event_file.write(self.event_shard + " " + line)
+
+
+class TestConvertEvents(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source_paths = []
+            for run, num_events in enumerate([7, 3]):
+                source_paths.append(
+                    os.path.join(directory, "run" + str(run) + ".phs.jsonl.gz")
+                )
+                with gzip.open(source_paths[-1], "wt") as phs_file:
+                    phs_file.write(
+                        "\n".join(
+                            '{"event": ' + str(event) + "}"
+                            for event in range(1, num_events + 1)
+                        )
+                    )
+            self.assertEqual(count_events_in_file(source_paths[0]), 7)
+
+            output = os.path.join(directory, "output")
+            manifest_path = os.path.join(output, "conversion_manifest.jsonl")
+            # The range of events 4-6 of run0 fails, so it is not in the manifest
+            converted = convert_events(
+                LineCountingPreprocessor,
+                source_paths,
+                output,
+                config={"rebin_size": 5, "fail_first": 4},
+                events_per_task=3,
+                threads=2,
+            )
+            self.assertEqual(converted, 7)
+            completed, event_counts = read_manifest(manifest_path)
+            self.assertEqual(event_counts, {source_paths[0]: 7, source_paths[1]: 3})
+            self.assertEqual(
+                sorted(completed[(source_paths[0], manifest_key({}))]), [(1, 4), (7, 8)]
+            )
+            self.assertFalse(os.path.exists(os.path.join(output, "run0_4")))
+            with open(os.path.join(output, "run0_7")) as event_file:
+                self.assertEqual(event_file.read(), 'run0_7_8 {"event": 7}')
+
+            # Only the failed range is converted again
+            converted = convert_events(
+                LineCountingPreprocessor,
+                source_paths,
+                output,
+                config={"rebin_size": 5},
+                events_per_task=3,
+                threads=2,
+            )
+            self.assertEqual(converted, 3)
+            with open(os.path.join(output, "run0_5")) as event_file:
+                self.assertEqual(event_file.read(), 'run0_4_7 {"event": 5}\n')
+
+            # Everything is in the manifest, so nothing is converted again
+            converted = convert_events(
+                LineCountingPreprocessor,
+                source_paths,
+                output,
+                config={"rebin_size": 5},
+                events_per_task=3,
+                threads=2,
+            )
+            self.assertEqual(converted, 0)
+
+            # Other options convert everything again
+            converted = convert_events(
+                LineCountingPreprocessor,
+                source_paths,
+                output,
+                config={"rebin_size": 5},
+                processor_kwargs={"packed": True},
+                events_per_task=3,
+                threads=2,
+            )
+            self.assertEqual(converted, 10)
+            # The uncompressed ranges are removed once converted
+            self.assertFalse(
+                [name for name in os.listdir(output) if name.startswith(".ranges_")]
+            )
+
+    def test_split_event_ranges(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "run0.phs.jsonl.gz")
+            lines = ['{"event": ' + str(event) + "}" for event in range(1, 8)]
+            with gzip.open(path, "wt") as phs_file:
+                phs_file.write("\n".join(lines))
+            ranges = os.path.join(directory, "ranges")
+            os.makedirs(ranges)
+            self.assertEqual(split_event_ranges((path, ranges, 3, {4, 7})), (path, 7))
+            self.assertEqual(
+                sorted(os.listdir(ranges)),
+                sorted(range_file_name(path, first) for first in [4, 7]),
+            )
+            # The ranges are read from their own files, not from the compressed file
+            os.remove(path)
+            self.assertEqual(
+                list(events_in_range(open, path, (4, 7), ranges)),
+                [(4, lines[3] + "\n"), (5, lines[4] + "\n"), (6, lines[5] + "\n")],
+            )
+            self.assertEqual(
+                list(events_in_range(open, path, (7, 8), ranges)), [(7, lines[6])]
+            )
+
+
 if __name__ == "__main__":
     unittest.main()
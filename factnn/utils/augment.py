@@ -1,8 +1,135 @@
+import os
+
 import numpy as np
 from sklearn.utils import shuffle
 import h5py
 from scipy.spatial.transform import Rotation as R
 
+# Bytes of the HDF5 chunk cache of each opened dataset, large enough to hold the chunks of a batch
+HDF5_CHUNK_CACHE_BYTES = 256 * 1024 ** 2
+
+# HDF5 files and datasets opened by this process, by path, and the process that opened them
+_hdf5_files = {}
+_hdf5_datasets = {}
+_hdf5_pid = None
+
+
+def hdf5_dataset(path, key="Image", chunk_cache_bytes=HDF5_CHUNK_CACHE_BYTES):
+    """
+    Gets a dataset of an HDF5 file, opened once per process and then kept open, so every batch reuses the parsed
+    metadata and the chunk cache of the dataset instead of opening the file again. A process forked from the one that
+    opened the file, such as a generator worker, opens it again, as the HDF5 handles can not be shared
+    :param path: Path of the HDF5 file
+    :param key: Name of the dataset in the file
+    :param chunk_cache_bytes: Size of the chunk cache of the file, used when it is opened
+    :return: h5py Dataset
+    """
+    global _hdf5_pid
+    if _hdf5_pid != os.getpid():
+        # Handles inherited from the parent process are dropped without being used
+        _hdf5_datasets.clear()
+        _hdf5_files.clear()
+        _hdf5_pid = os.getpid()
+    if (path, key) not in _hdf5_datasets:
+        if path not in _hdf5_files:
+            _hdf5_files[path] = h5py.File(
+                path, "r", rdcc_nbytes=chunk_cache_bytes, rdcc_nslots=10007
+            )
+        _hdf5_datasets[path, key] = _hdf5_files[path][key]
+    return _hdf5_datasets[path, key]
+
+
+def close_hdf5_files():
+    """
+    Closes the HDF5 files opened by hdf5_dataset in this process, such as before the files are written again
+    """
+    _hdf5_datasets.clear()
+    if _hdf5_pid == os.getpid():
+        for hdf5_file in _hdf5_files.values():
+            hdf5_file.close()
+    _hdf5_files.clear()
+
+
+def dihedral_view(images, flip_x=False, flip_y=False, rotation=0, axes=(0, 1)):
+    """
+    Flips and then rotates images, as views without copying
+    :param images: Numpy array of images
+    :param flip_x: Whether to flip the first image axis
+    :param flip_y: Whether to flip the second image axis
+    :param rotation: Number of 90 degree rotations, as np.rot90
+    :param axes: The two image axes of the array
+    :return: View of the transformed images
+    """
+    if flip_x:
+        images = np.flip(images, axes[0])
+    if flip_y:
+        images = np.flip(images, axes[1])
+    if rotation:
+        images = np.rot90(images, rotation, axes=axes)
+    return images
+
+
+def _dihedral_transforms():
+    """
+    The flips and rotations that image_augmenter chooses between are 12 combinations of a flip of either axis and a
+    rotation by 0, 90 or 270 degrees, but only 8 different transforms of a square image. Each combination is matched to
+    its transform by where it moves the corners of a 2x2 image
+    :return: (transforms, transform_of_combination), the (flip_x, flip_y, rotation) of each of the 8 transforms and
+    the index of the transform of combination (flip_x * 2 + flip_y) * 3 + rotation index
+    """
+    corners = np.arange(4).reshape(2, 2)
+    transforms = []
+    results = []
+    transform_of_combination = []
+    for flip_x in (False, True):
+        for flip_y in (False, True):
+            for rotation in (0, 1, 3):
+                result = dihedral_view(corners, flip_x, flip_y, rotation).tobytes()
+                if result not in results:
+                    results.append(result)
+                    transforms.append((flip_x, flip_y, rotation))
+                transform_of_combination.append(results.index(result))
+    return transforms, np.array(transform_of_combination)
+
+
+DIHEDRAL_TRANSFORMS, _TRANSFORM_OF_COMBINATION = _dihedral_transforms()
+
+
+def random_dihedral_transforms(num_images):
+    """
+    Draws the random flips and rotation of each image, each flip with a chance of 0.5, and a rotation by 90 degrees
+    with a chance of 0.3, by 270 degrees with a chance of 0.3, otherwise none
+    :param num_images: Number of images
+    :return: Index into DIHEDRAL_TRANSFORMS of the transform of each image
+    """
+    flip_x = np.random.rand(num_images) < 0.5
+    flip_y = np.random.rand(num_images) < 0.5
+    rotation = np.random.rand(num_images)
+    rotation = np.where(rotation < 0.3, 1, np.where(rotation > 0.7, 2, 0))
+    return _TRANSFORM_OF_COMBINATION[(flip_x * 2 + flip_y) * 3 + rotation]
+
+
+def apply_dihedral_transforms(images, transforms, axes=(1, 2), out=None):
+    """
+    Transforms each image of a batch, grouping the images by their transform and applying each transform once to its
+    group, instead of once per image
+    :param images: Numpy array of square images, the batch along the first axis
+    :param transforms: Index into DIHEDRAL_TRANSFORMS of the transform of each image
+    :param axes: The two image axes of the batch
+    :param out: Array to write the transformed images to, a new array if None
+    :return: The transformed images, in the same order
+    """
+    images = np.asarray(images)
+    transforms = np.asarray(transforms)
+    if out is None:
+        out = np.empty_like(images)
+    for transform in np.unique(transforms):
+        group = np.flatnonzero(transforms == transform)
+        out[group] = dihedral_view(
+            images[group], *DIHEDRAL_TRANSFORMS[transform], axes=axes
+        )
+    return out
+
 
 def image_augmenter(images, as_channels=False):
     """
@@ -11,39 +138,9 @@ def image_augmenter(images, as_channels=False):
     :param images: Numpy list of images in (batch_size, timeslice, x, y, channels) format
     :return: Numpy array of randomly flipped and rotated 3D images, in same order
     """
-    new_images = []
-    for image in images:
-        vert_val = np.random.rand()
-        if vert_val < 0.5:
-            # Flip the image vertically
-            if not as_channels:
-                image = np.flip(image, 1)
-            else:
-                image = np.flip(image, 0)
-        horz_val = np.random.rand()
-        if horz_val < 0.5:
-            # Flip horizontally
-            if not as_channels:
-                image = np.flip(image, 2)
-            else:
-                image = np.flip(image, 1)
-        rot_val = np.random.rand()
-        if rot_val < 0.3:
-            # Rotate 90 degrees
-            if not as_channels:
-                image = np.rot90(image, 1, axes=(1, 2))
-            else:
-                image = np.rot90(image, 1, axes=(0, 1))
-        elif rot_val > 0.7:
-            # Rotate 270 degrees
-            if not as_channels:
-                image = np.rot90(image, 3, axes=(1, 2))
-            else:
-                image = np.rot90(image, 3, axes=(0, 1))
-
-        new_images.append(image)
-    images = np.asarray(new_images)
-    return images
+    transforms = random_dihedral_transforms(len(images))
+    axes = (1, 2) if as_channels else (2, 3)
+    return apply_dihedral_transforms(images, transforms, axes)
 
 
 def dual_image_augmenter(images, collapsed_images, as_channels=False):
@@ -53,45 +150,11 @@ def dual_image_augmenter(images, collapsed_images, as_channels=False):
     :param images: Numpy list of images in (batch_size, timeslice, x, y, channels) format
     :return: Numpy array of randomly flipped and rotated 3D images, in same order
     """
-    new_images = []
-    new_collapsed_images = []
-    for index, image in enumerate(images):
-        collapsed_image = collapsed_images[index]
-        vert_val = np.random.rand()
-        if vert_val < 0.5:
-            # Flip the image vertically
-            if not as_channels:
-                image = np.flip(image, 1)
-            else:
-                image = np.flip(image, 0)
-            collapsed_image = np.flip(collapsed_image, 0)
-        horz_val = np.random.rand()
-        if horz_val < 0.5:
-            # Flip horizontally
-            if not as_channels:
-                image = np.flip(image, 2)
-            else:
-                image = np.flip(image, 1)
-            collapsed_image = np.flip(collapsed_image, 1)
-        rot_val = np.random.rand()
-        if rot_val < 0.3:
-            # Rotate 90 degrees
-            if not as_channels:
-                image = np.rot90(image, 1, axes=(1, 2))
-            else:
-                image = np.rot90(image, 1, axes=(0, 1))
-            collapsed_image = np.rot90(collapsed_image, 1, axes=(0, 1))
-        elif rot_val > 0.7:
-            # Rotate 270 degrees
-            if not as_channels:
-                image = np.rot90(image, 3, axes=(1, 2))
-            else:
-                image = np.rot90(image, 3, axes=(0, 1))
-            collapsed_image = np.rot90(collapsed_image, 3, axes=(0, 1))
-        new_images.append(image)
-        new_collapsed_images.append(collapsed_image)
-    collapsed_images = np.asarray(new_collapsed_images)
-    images = np.asarray(new_images)
+    # Each image and its collapsed image get the same transform
+    transforms = random_dihedral_transforms(len(images))
+    axes = (1, 2) if as_channels else (2, 3)
+    images = apply_dihedral_transforms(images, transforms, axes)
+    collapsed_images = apply_dihedral_transforms(collapsed_images, transforms, (1, 2))
     return images, collapsed_images
 
 
@@ -340,45 +403,42 @@ def get_random_hdf5_chunk(
     start_pos = np.random.randint(start, last_possible_start)
     # Range for all positions, to keep with other ones
     positions = range(start_pos, int(start_pos + size))
-    with h5py.File(gamma, "r") as images_one:
-        if proton_input is not None:
-            with h5py.File(proton_input, "r") as images_two:
-                proton_data = images_two["Image"]
-                training_data = images_one["Image"]
-                batch_images = training_data[
-                    start_pos : int(start_pos + size),
-                    time_slice : time_slice + total_slices,
-                    ::,
-                ]
-                proton_images = proton_data[
-                    start_pos : int(start_pos + size),
-                    time_slice : time_slice + total_slices,
-                    ::,
-                ]
-                return common_step(
-                    batch_images,
-                    positions,
-                    labels=labels,
-                    proton_images=proton_images,
-                    augment=augment,
-                    swap=swap,
-                    shape=shape,
-                )
-        else:
-            training_data = images_one["Image"]
-            batch_images = training_data[
-                start_pos : int(start_pos + size),
-                time_slice : time_slice + total_slices,
-                ::,
-            ]
-            return common_step(
-                batch_images,
-                positions,
-                labels=labels,
-                augment=augment,
-                swap=swap,
-                shape=shape,
-            )
+    training_data = hdf5_dataset(gamma)
+    if proton_input is not None:
+        proton_data = hdf5_dataset(proton_input)
+        batch_images = training_data[
+            start_pos : int(start_pos + size),
+            time_slice : time_slice + total_slices,
+            ::,
+        ]
+        proton_images = proton_data[
+            start_pos : int(start_pos + size),
+            time_slice : time_slice + total_slices,
+            ::,
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            proton_images=proton_images,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+    else:
+        batch_images = training_data[
+            start_pos : int(start_pos + size),
+            time_slice : time_slice + total_slices,
+            ::,
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
 
 
 def get_completely_random_hdf5(
@@ -418,39 +478,36 @@ def get_completely_random_hdf5(
     # Get random positions within the start and stop sizes
     positions = np.random.randint(start, stop, size=size)
     positions = sorted(positions)
-    with h5py.File(gamma, "r") as images_one:
-        if proton_input is not None:
-            with h5py.File(proton_input, "r") as images_two:
-                proton_data = images_two["Image"]
-                training_data = images_one["Image"]
-                batch_images = training_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                proton_images = proton_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                return common_step(
-                    batch_images,
-                    positions,
-                    labels=labels,
-                    proton_images=proton_images,
-                    augment=augment,
-                    swap=swap,
-                    shape=shape,
-                )
-        else:
-            training_data = images_one["Image"]
-            batch_images = training_data[
-                positions, time_slice : time_slice + total_slices, ::
-            ]
-            return common_step(
-                batch_images,
-                positions,
-                labels=labels,
-                augment=augment,
-                swap=swap,
-                shape=shape,
-            )
+    training_data = hdf5_dataset(gamma)
+    if proton_input is not None:
+        proton_data = hdf5_dataset(proton_input)
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        proton_images = proton_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            proton_images=proton_images,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+    else:
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
 
 
 def get_random_from_list(
@@ -489,39 +546,36 @@ def get_random_from_list(
     # Get random positions within the start and stop sizes
     positions = np.random.choice(indicies, size=size, replace=False)
     positions = sorted(positions)
-    with h5py.File(gamma, "r") as images_one:
-        if proton_input is not None:
-            with h5py.File(proton_input, "r") as images_two:
-                proton_data = images_two["Image"]
-                training_data = images_one["Image"]
-                batch_images = training_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                proton_images = proton_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                return common_step(
-                    batch_images,
-                    positions,
-                    labels=labels,
-                    proton_images=proton_images,
-                    augment=augment,
-                    swap=swap,
-                    shape=shape,
-                )
-        else:
-            training_data = images_one["Image"]
-            batch_images = training_data[
-                positions, time_slice : time_slice + total_slices, ::
-            ]
-            return common_step(
-                batch_images,
-                positions,
-                labels=labels,
-                augment=augment,
-                swap=swap,
-                shape=shape,
-            )
+    training_data = hdf5_dataset(gamma)
+    if proton_input is not None:
+        proton_data = hdf5_dataset(proton_input)
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        proton_images = proton_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            proton_images=proton_images,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+    else:
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
 
 
 def get_chunk_from_list(
@@ -570,39 +624,163 @@ def get_chunk_from_list(
             # More overflow
             positions = indicies[0:size]
     positions = sorted(positions)
-    with h5py.File(gamma, "r") as images_one:
-        if proton_input is not None:
-            with h5py.File(proton_input, "r") as images_two:
-                proton_data = images_two["Image"]
-                training_data = images_one["Image"]
-                batch_images = training_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                proton_images = proton_data[
-                    positions, time_slice : time_slice + total_slices, ::
-                ]
-                return common_step(
-                    batch_images,
-                    positions,
-                    labels=labels,
-                    proton_images=proton_images,
-                    augment=augment,
-                    swap=swap,
-                    shape=shape,
-                )
-        else:
-            training_data = images_one["Image"]
-            batch_images = training_data[
-                positions, time_slice : time_slice + total_slices, ::
+    training_data = hdf5_dataset(gamma)
+    if proton_input is not None:
+        proton_data = hdf5_dataset(proton_input)
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        proton_images = proton_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            proton_images=proton_images,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+    else:
+        batch_images = training_data[
+            positions, time_slice : time_slice + total_slices, ::
+        ]
+        return common_step(
+            batch_images,
+            positions,
+            labels=labels,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+
+
+class ChunkShuffler(object):
+    """
+    Draws random batches of events from HDF5 datasets a chunk at a time, instead of reading each event of a batch on
+    its own. The chunks are read whole, in a random order, each with one contiguous read, and their events are kept
+    in a buffer that the batches are drawn from at random, so the events of a chunk are spread over many batches
+    """
+
+    def __init__(self, indicies, chunk_rows, buffer_size=None, seed=None):
+        """
+        :param indicies: Indices of the events to draw from, such as the training events
+        :param chunk_rows: Number of events in each chunk of the datasets, such as dataset.chunks[0]
+        :param buffer_size: Number of events to draw the batches from, more shuffles better, default 16 chunks
+        :param seed: Seed of the random order of the chunks and events
+        """
+        indicies = np.unique(indicies)
+        boundaries = np.flatnonzero(np.diff(indicies // chunk_rows)) + 1
+        self.chunk_indicies = np.split(indicies, boundaries)
+        self.buffer_size = buffer_size if buffer_size is not None else 16 * chunk_rows
+        self.rng = np.random.RandomState(seed)
+        self.chunk_order = []
+        self.count = 0
+        self.positions = None
+        self.images = None
+
+    def read_chunk(self, datasets, time_slice, total_slices):
+        """
+        Reads the next chunk of the random order into the end of the buffer, starting a new order after the last one
+        """
+        if not self.chunk_order:
+            self.chunk_order = list(self.rng.permutation(len(self.chunk_indicies)))
+        positions = self.chunk_indicies[self.chunk_order.pop()]
+        chunks = [
+            dataset[
+                positions[0] : positions[-1] + 1, time_slice : time_slice + total_slices
+            ][positions - positions[0]]
+            for dataset in datasets
+        ]
+        if self.images is None:
+            capacity = self.buffer_size + max(len(chunk) for chunk in self.chunk_indicies)
+            self.positions = np.empty(capacity, dtype=positions.dtype)
+            self.images = [
+                np.empty((capacity,) + chunk.shape[1:], dtype=chunk.dtype)
+                for chunk in chunks
             ]
-            return common_step(
-                batch_images,
-                positions,
-                labels=labels,
-                augment=augment,
-                swap=swap,
-                shape=shape,
-            )
+        end = self.count + len(positions)
+        self.positions[self.count : end] = positions
+        for images, chunk in zip(self.images, chunks):
+            images[self.count : end] = chunk
+        self.count = end
+
+    def batch(self, size, datasets, time_slice, total_slices):
+        """
+        Draws a batch of random events from the buffer, reading chunks until it holds buffer_size events
+        :param size: Number of events in the batch, at most buffer_size
+        :param datasets: h5py datasets to read the same events from, such as the gamma and proton images
+        :param time_slice: First time slice to read
+        :param total_slices: Number of time slices to read
+        :return: (positions, images), the index of each event of the batch and a list of its images from each dataset
+        """
+        while self.count < max(self.buffer_size, size):
+            self.read_chunk(datasets, time_slice, total_slices)
+        chosen = self.rng.choice(self.count, size=size, replace=False)
+        positions = self.positions[chosen]
+        images = [images[chosen] for images in self.images]
+        # The chosen events are replaced by the events at the end of the buffer that were not chosen
+        end = self.count - size
+        is_chosen = np.zeros(size, dtype=bool)
+        is_chosen[chosen[chosen >= end] - end] = True
+        holes = chosen[chosen < end]
+        moved = end + np.flatnonzero(~is_chosen)
+        self.positions[holes] = self.positions[moved]
+        for buffered in self.images:
+            buffered[holes] = buffered[moved]
+        self.count = end
+        return positions, images
+
+
+def get_random_from_chunks(
+    shuffler,
+    size,
+    time_slice,
+    total_slices,
+    gamma,
+    proton_input=None,
+    labels=None,
+    augment=True,
+    swap=True,
+    shape=None,
+):
+    """
+    Gets a random batch of the HDF5 database, like get_random_from_list, drawn by a ChunkShuffler that reads whole
+    chunks of the datasets
+
+    :param shuffler: ChunkShuffler of the indices to draw from
+    :param size: Number of events in the batch
+    :param time_slice: First time slice to use
+    :param total_slices: Number of time slices to use
+    :param gamma: Path of the gamma HDF5 file
+    :param proton_input: Path of the proton HDF5 file, if any
+    :param labels: Labels of the events, used if there are no proton events
+    :return:
+    """
+    datasets = [hdf5_dataset(gamma)]
+    if proton_input is not None:
+        datasets.append(hdf5_dataset(proton_input))
+    positions, images = shuffler.batch(size, datasets, time_slice, total_slices)
+    if proton_input is not None:
+        return common_step(
+            images[0],
+            positions,
+            labels=labels,
+            proton_images=images[1],
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
+    else:
+        return common_step(
+            images[0],
+            positions,
+            labels=labels,
+            augment=augment,
+            swap=swap,
+            shape=shape,
+        )
 
 
 def euclidean_distance(x1, y1, x2, y2):
@@ -1,12 +1,15 @@
 import os
 
 import numpy as np
+import tensorflow
 import tensorflow.keras
 from sklearn.model_selection import train_test_split, KFold
 from sklearn.utils import shuffle
 
 from ..data.preprocess.eventfile_preprocessor import EventFilePreprocessor
+from ..generator.keras.dataset import event_file_dataset
 from ..generator.keras.eventfile_generator import EventFileGenerator
+from ..generator.prefetch import Prefetcher
 
 
 def split_data(indicies, kfolds, seed=None):
@@ -215,7 +218,7 @@ def data(
     return train, validate, test, final_shape
 
 
-def fit_model(model, train_gen, val_gen, workers=10, verbose=1):
+def fit_model(model, train_gen, val_gen, workers=10, verbose=1, prefetch_depth=50):
     early_stop = tensorflow.keras.callbacks.EarlyStopping(
         monitor="val_loss",
         min_delta=0.0002,
@@ -226,27 +229,44 @@ def fit_model(model, train_gen, val_gen, workers=10, verbose=1):
     )
     nan_stop = tensorflow.keras.callbacks.TerminateOnNaN()
 
-    model.fit_generator(
-        generator=train_gen,
-        epochs=500,
-        verbose=verbose,
-        validation_data=val_gen,
-        callbacks=[early_stop, nan_stop],
-        use_multiprocessing=True,
-        workers=workers,
-        max_queue_size=50,
-    )
+    if isinstance(train_gen, tensorflow.data.Dataset):
+        model.fit(
+            train_gen,
+            epochs=500,
+            verbose=verbose,
+            validation_data=val_gen,
+            callbacks=[early_stop, nan_stop],
+        )
+        return model
+    # Batches are made ahead by forked workers, instead of Keras pickling the generators into its workers
+    with Prefetcher(
+        train_gen, depth=prefetch_depth, workers=workers, processes=True
+    ) as train_batches, Prefetcher(
+        val_gen, depth=prefetch_depth, workers=workers, processes=True
+    ) as val_batches:
+        model.fit(
+            iter(train_batches),
+            steps_per_epoch=len(train_gen),
+            epochs=500,
+            verbose=verbose,
+            validation_data=iter(val_batches),
+            validation_steps=len(val_gen),
+            callbacks=[early_stop, nan_stop],
+        )
     return model
 
 
-def model_evaluate(model, test_gen, workers=10, verbose=0):
-    evaluation = model.evaluate_generator(
-        generator=test_gen,
-        verbose=verbose,
-        use_multiprocessing=True,
-        workers=workers,
-        max_queue_size=50,
-    )
+def model_evaluate(model, test_gen, workers=10, verbose=0, prefetch_depth=50):
+    if isinstance(test_gen, tensorflow.data.Dataset):
+        return model.evaluate(test_gen, verbose=verbose)
+    with Prefetcher(
+        test_gen, depth=prefetch_depth, workers=workers, processes=True
+    ) as test_batches:
+        evaluation = model.evaluate(
+            iter(test_batches),
+            steps=len(test_gen),
+            verbose=verbose,
+        )
     return evaluation
 
 
@@ -473,6 +493,7 @@ def cross_validate(
     return_collapsed=False,
     return_features=False,
     plot=False,
+    tf_data=False,
 ):
     """
 
@@ -489,6 +510,8 @@ def cross_validate(
     :param workers: Number of worker threads for the fitting and evaluation
     :param verbose: How verbose the fitting and evaluation should be
     :param plot: Whether to plot the output or not
+    :param tf_data: Whether to train and evaluate on tf.data datasets built by event_file_dataset, instead of the
+    generators
     :return:
     """
 
@@ -554,6 +577,10 @@ def cross_validate(
                 return_features=return_features,
             )
 
+        if tf_data:
+            train_gen = event_file_dataset(train_gen, shuffle=True, seed=seed)
+            val_gen = event_file_dataset(val_gen)
+            test_gen = event_file_dataset(test_gen)
         model = fit_model(model, train_gen, val_gen, workers=workers, verbose=verbose)
         evaluation = model_evaluate(model, test_gen, workers=workers, verbose=verbose)
         print("Evaluation: " + str(evaluation))
@@ -1,7 +1,277 @@
-from factnn import ProtonPreprocessor, GammaPreprocessor, GammaDiffusePreprocessor
+from factnn.data.preprocess.simulation_preprocessors import (
+    ProtonPreprocessor,
+    GammaPreprocessor,
+    GammaDiffusePreprocessor,
+)
+from factnn.data.preprocess.base_preprocessor import range_file_name
+import gzip
+import json
 import os
+import shutil
+import tempfile
+import time
 from multiprocessing import Pool
-from functools import partial
+
+MANIFEST_FILE = "conversion_manifest.jsonl"
+
+# Preprocessor of each worker process, created once by _init_worker so init() and the DL2 file are not loaded per task
+_worker_preprocessor = None
+
+
+def count_events_in_file(path):
+    """
+    Counts the events in a .phs.jsonl.gz file from its lines, without parsing them
+    :param path: Path to the photon stream file
+    :return: Number of events in the file
+    """
+    count = 0
+    last_block = b"\n"
+    with gzip.open(path, "rb") as phs_file:
+        for block in iter(lambda: phs_file.read(1 << 20), b""):
+            count += block.count(b"\n")
+            last_block = block
+    if not last_block.endswith(b"\n"):
+        count += 1
+    return count
+
+
+def split_event_ranges(task):
+    """
+    Decompresses a .phs.jsonl.gz file once, counting its events and copying the lines of each range of events still to
+    convert to its own uncompressed file, which events_in_range reads instead of decompressing the file again
+    :param task: (path, range_directory, events_per_task, firsts), firsts is the set of the first counters of the
+    ranges to copy, None for all of them
+    :return: (path, number of events in the file), counted like count_events_in_file
+    """
+    path, range_directory, events_per_task, firsts = task
+    count = 0
+    range_file = None
+    try:
+        with gzip.open(path, "rb") as phs_file:
+            for line in phs_file:
+                if count == 0 or (events_per_task and count % events_per_task == 0):
+                    if range_file is not None:
+                        range_file.close()
+                        range_file = None
+                    if firsts is None or count + 1 in firsts:
+                        range_file = open(
+                            os.path.join(
+                                range_directory, range_file_name(path, count + 1)
+                            ),
+                            "wb",
+                        )
+                if range_file is not None:
+                    range_file.write(line)
+                count += 1
+    finally:
+        if range_file is not None:
+            range_file.close()
+    return path, count
+
+
+def event_ranges(num_events, events_per_task=None):
+    """
+    Splits the events of a file into the (first, stop) event_range of each conversion task
+    :param num_events: Number of events in the file
+    :param events_per_task: Number of events per task, or None for one task for the whole file
+    :return: List of (first, stop) ranges, counting from 1 like the event_processor counters
+    """
+    if events_per_task is None:
+        events_per_task = max(num_events, 1)
+    return [
+        (first, min(first + events_per_task, num_events + 1))
+        for first in range(1, num_events + 1, events_per_task)
+    ]
+
+
+def manifest_key(processor_kwargs):
+    """
+    Stable key of the event_processor options of a conversion, so a manifest entry only counts for the same options
+    :param processor_kwargs: Keyword arguments for event_processor
+    :return: JSON string of the options, with sorted keys
+    """
+    return json.dumps(processor_kwargs, sort_keys=True)
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the ranges completed by earlier runs of convert_events
+    :param manifest_path: Path to the manifest file
+    :return: (completed, event_counts), dictionary of the list of completed (first, stop) ranges for each
+    (source path, manifest_key of the options), and dictionary of the number of events of each source path
+    """
+    completed = {}
+    event_counts = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Line cut off by a crash, that range is just converted again
+                    continue
+                key = (entry["path"], manifest_key(entry["processor_kwargs"]))
+                completed.setdefault(key, []).append((entry["first"], entry["stop"]))
+                event_counts[entry["path"]] = entry["num_events"]
+    return completed, event_counts
+
+
+def is_completed(completed, path, processor_kwargs, first, stop):
+    return any(
+        done_first <= first and stop <= done_stop
+        for done_first, done_stop in completed.get(
+            (path, manifest_key(processor_kwargs)), []
+        )
+    )
+
+
+def _init_worker(preprocessor_class, config):
+    global _worker_preprocessor
+    _worker_preprocessor = preprocessor_class(config=dict(config, paths=[]))
+
+
+def _convert_range(task):
+    """
+    Converts one range of events of one file in a worker process, top level so it can be pickled by the Pool
+    :param task: (path, first, stop, directory, processor_kwargs, range_directory)
+    :return: (path, first, stop, seconds taken, error), error is None if the range was converted
+    """
+    path, first, stop, directory, processor_kwargs, range_directory = task
+    start_time = time.time()
+    file_name = os.path.basename(path).split(".phs")[0]
+    _worker_preprocessor.paths = [path]
+    _worker_preprocessor.range_directory = range_directory
+    # One shard per task, so a task that is run again after a crash appends to its own shard
+    _worker_preprocessor.event_shard = file_name + "_" + str(first) + "_" + str(stop)
+    try:
+        _worker_preprocessor.event_processor(
+            directory,
+            event_range=(first, stop),
+            check_existing=False,
+            **processor_kwargs
+        )
+    except Exception as e:
+        return path, first, stop, time.time() - start_time, repr(e)
+    return path, first, stop, time.time() - start_time, None
+
+
+def convert_events(
+    preprocessor_class,
+    source_paths,
+    directory,
+    config=None,
+    processor_kwargs=None,
+    events_per_task=None,
+    threads=4,
+):
+    """
+    Converts photon stream files to event files with event_processor in parallel, resuming where an earlier run stopped
+
+    Each file is split into tasks of events_per_task events, which are handed out to the worker processes as they
+    finish. Tasks that finish without an error are appended to a manifest in directory, with the options they were
+    converted with and the number of events of their file. It is read back to skip them when the conversion is
+    started again with the same processor_kwargs, so no event files have to be checked for. Failed tasks are reported
+    and converted again by the next run. Keep events_per_task the same when resuming
+
+    Files with tasks left are decompressed once by split_event_ranges, which counts the events of the files that are
+    not in the manifest yet and copies the lines of each task uncompressed to a temporary directory in directory, so
+    the tasks of a file do not each decompress it from its start. Each copy is removed once its task is done, but the
+    events still to convert are kept uncompressed on disk until then
+
+    :param preprocessor_class: Preprocessor with an event_processor, such as GammaPreprocessor
+    :param source_paths: Paths of the .phs.jsonl.gz files to convert
+    :param directory: Output directory passed to event_processor, the manifest is kept in it
+    :param config: Configuration for the preprocessor, paths is set per task
+    :param processor_kwargs: Keyword arguments for event_processor, such as clean_images, clump_size and packed
+    :param events_per_task: Number of events per task, None to convert each file as one task
+    :param threads: Number of worker processes
+    :return: Number of events converted
+    """
+    if config is None:
+        config = {}
+    if processor_kwargs is None:
+        processor_kwargs = {}
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    completed, event_counts = read_manifest(manifest_path)
+
+    converted = 0
+    range_directory = tempfile.mkdtemp(prefix=".ranges_", dir=directory)
+    try:
+        with Pool(
+            threads, initializer=_init_worker, initargs=(preprocessor_class, config)
+        ) as pool:
+            # Counted files only copy their ranges that are left, files that are not counted yet have none done
+            splits = []
+            for path in source_paths:
+                if path not in event_counts:
+                    splits.append((path, range_directory, events_per_task, None))
+                    continue
+                firsts = {
+                    first
+                    for first, stop in event_ranges(event_counts[path], events_per_task)
+                    if not is_completed(completed, path, processor_kwargs, first, stop)
+                }
+                if firsts:
+                    splits.append((path, range_directory, events_per_task, firsts))
+            event_counts.update(pool.map(split_event_ranges, splits))
+            tasks = [
+                (path, first, stop, directory, processor_kwargs, range_directory)
+                for path in source_paths
+                for first, stop in event_ranges(event_counts[path], events_per_task)
+                if not is_completed(completed, path, processor_kwargs, first, stop)
+            ]
+            print(
+                "Converting "
+                + str(sum(task[2] - task[1] for task in tasks))
+                + " events in "
+                + str(len(tasks))
+                + " tasks"
+            )
+            start_time = time.time()
+            with open(manifest_path, "a") as manifest_file:
+                for path, first, stop, seconds, error in pool.imap_unordered(
+                    _convert_range, tasks
+                ):
+                    range_path = os.path.join(
+                        range_directory, range_file_name(path, first)
+                    )
+                    if os.path.isfile(range_path):
+                        os.remove(range_path)
+                    if error is not None:
+                        print(
+                            "Failed {} events {}-{}, converted again next run: {}".format(
+                                os.path.basename(path), first, stop - 1, error
+                            )
+                        )
+                        continue
+                    manifest_file.write(
+                        json.dumps(
+                            {
+                                "path": path,
+                                "first": first,
+                                "stop": stop,
+                                "num_events": event_counts[path],
+                                "processor_kwargs": processor_kwargs,
+                                "seconds": seconds,
+                            }
+                        )
+                        + "\n"
+                    )
+                    manifest_file.flush()
+                    converted += stop - first
+                    print(
+                        "Converted {} events {}-{}, {:.1f} events/s".format(
+                            os.path.basename(path),
+                            first,
+                            stop - 1,
+                            converted / max(time.time() - start_time, 1e-9),
+                        )
+                    )
+    finally:
+        shutil.rmtree(range_directory, ignore_errors=True)
+    return converted
 
 
 def convert_to_eventfiles(
@@ -12,6 +282,8 @@ def convert_to_eventfiles(
     clean_images=True,
     dl2_file=None,
     threads=4,
+    events_per_task=None,
+    packed=False,
 ):
     # Get paths from the directories
     source_paths = []
@@ -21,31 +293,6 @@ def convert_to_eventfiles(
                 if file.endswith("phs.jsonl.gz"):
                     source_paths.append(os.path.join(root, file))
 
-    def f(clump_size, path):
-        print("Gamma")
-        print("Size: ", clump_size)
-        gamma_configuration = {"paths": [path], "dl2_file": dl2_file}
-
-        if file_type == "Gamma":
-            preprocessor = GammaPreprocessor(config=gamma_configuration)
-            preprocessor.event_processor(
-                os.path.join(output_path, "gamma"),
-                clean_images=clean_images,
-                clump_size=clump_size,
-            )
-        elif file_type == "Proton":
-            preprocessor = ProtonPreprocessor(config=gamma_configuration)
-            preprocessor.event_processor(
-                os.path.join(output_path, "proton"),
-                clean_images=clean_images,
-                clump_size=clump_size,
-            )
-        elif file_type == "Diffuse":
-            preprocessor = GammaDiffusePreprocessor(config=gamma_configuration)
-            preprocessor.event_processor(
-                os.path.join(output_path, "gamma_diffuse"), clean_images=clean_images
-            )
-
     output_paths = [
         os.path.join(output_path, "proton", "no_clean"),
         os.path.join(output_path, "proton", "clump" + str(clump_size)),
@@ -58,11 +305,30 @@ def convert_to_eventfiles(
         if not os.path.exists(path):
             os.makedirs(path)
 
-    pool = Pool(threads)
-    func = partial(f, clump_size)
-    p = pool.map_async(func, source_paths)
+    processor_kwargs = {"clean_images": clean_images, "packed": packed}
+    if file_type == "Gamma":
+        preprocessor_class = GammaPreprocessor
+        processor_kwargs["clump_size"] = clump_size
+        output_path = os.path.join(output_path, "gamma")
+    elif file_type == "Proton":
+        preprocessor_class = ProtonPreprocessor
+        processor_kwargs["clump_size"] = clump_size
+        output_path = os.path.join(output_path, "proton")
+    elif file_type == "Diffuse":
+        preprocessor_class = GammaDiffusePreprocessor
+        output_path = os.path.join(output_path, "gamma_diffuse")
+    else:
+        raise ValueError("Unknown file_type " + str(file_type))
 
-    return p
+    return convert_events(
+        preprocessor_class,
+        source_paths,
+        output_path,
+        config={"dl2_file": dl2_file},
+        processor_kwargs=processor_kwargs,
+        events_per_task=events_per_task,
+        threads=threads,
+    )
 
 
 def get_paths(directory):
@@ -1,4 +1,144 @@
-import photon_stream as ps
-import feature_stream as fs
+import itertools
+
 import numpy as np
-import matplotlib.pyplot as plt
+from photon_stream.geometry import GEOMETRY
+from photon_stream.io.magic_constants import NUMBER_OF_PIXELS, TIME_SLICE_DURATION_S
+from photon_stream.io.binary import LINEBREAK
+
+
+def list_of_lists_to_arrays(list_of_lists):
+    """
+    Flattens the photon stream list of lists representation into flat arrays, one entry per photon
+    :param list_of_lists: List with one list of arrival time slices per CHID, in CHID order
+    :return: (chids, times) arrays, the CHID and arrival time slice of each photon, in CHID order
+    """
+    counts = np.fromiter(
+        (len(pixel) for pixel in list_of_lists),
+        dtype=np.int64,
+        count=len(list_of_lists),
+    )
+    times = np.fromiter(
+        itertools.chain.from_iterable(list_of_lists),
+        dtype=np.int64,
+        count=int(counts.sum()),
+    )
+    chids = np.repeat(np.arange(len(list_of_lists)), counts)
+    return chids, times
+
+
+def photon_arrays(photons):
+    """
+    Gets the flat arrays of the photons of an event from either of its representations
+    :param photons: Photon stream list of lists representation, or (chids, times) arrays as read from an EventStore
+    :return: (chids, times) arrays, the CHID and arrival time slice of each photon, in CHID order
+    """
+    if isinstance(photons, tuple):
+        return photons
+    return list_of_lists_to_arrays(photons)
+
+
+def raw_to_arrays(raw):
+    """
+    Splits the raw photon stream representation into flat arrays, one entry per photon
+    :param raw: Raw photon stream, arrival time slices in CHID order with LINEBREAK after the photons of each CHID
+    :return: (chids, times) arrays, the CHID and arrival time slice of each photon, in CHID order
+    """
+    raw = np.asarray(raw)
+    is_linebreak = raw == LINEBREAK
+    # CHID of a photon is the number of LINEBREAKs before it
+    chids = np.cumsum(is_linebreak)[~is_linebreak]
+    return chids, raw[~is_linebreak]
+
+
+def arrays_to_raw(chids, times):
+    """
+    Builds the raw photon stream representation from flat arrays, the inverse of raw_to_arrays
+    :param chids: CHID of each photon
+    :param times: Arrival time slice of each photon
+    :return: uint8 raw photon stream, with the photons of each CHID in the order they are given
+    """
+    order = np.argsort(chids, kind="stable")
+    chids = np.asarray(chids)[order]
+    raw = np.full(len(chids) + NUMBER_OF_PIXELS, LINEBREAK, dtype=np.uint8)
+    # Each photon is shifted by the LINEBREAKs of the CHIDs before it
+    raw[np.arange(len(chids)) + chids] = np.asarray(times)[order]
+    return raw
+
+
+# x and y angle of each CHID for each dtype, so GEOMETRY is only converted once
+_pixel_angles = {}
+
+
+def pixel_angles(dtype=np.float64):
+    """
+    Gets the cached x and y angle of each CHID
+    :param dtype: dtype of the angles
+    :return: (x_angle, y_angle) arrays indexed by CHID
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in _pixel_angles:
+        _pixel_angles[dtype] = (
+            np.asarray(GEOMETRY.x_angle, dtype=dtype),
+            np.asarray(GEOMETRY.y_angle, dtype=dtype),
+        )
+    return _pixel_angles[dtype]
+
+
+def arrays_to_point_cloud(chids, times, dtype=np.float64):
+    """
+    Same point cloud as photon_stream's raw_phs_to_point_cloud, without looping over the photons
+    :param chids: CHID of each photon
+    :param times: Arrival time slice of each photon
+    :param dtype: dtype of the point cloud
+    :return: (number of photons, 3) array of the x and y angle of the CHID and the arrival time in seconds
+    """
+    x_angle, y_angle = pixel_angles(dtype)
+    point_cloud = np.empty((len(chids), 3), dtype=dtype)
+    point_cloud[:, 0] = x_angle[chids]
+    point_cloud[:, 1] = y_angle[chids]
+    np.multiply(times, TIME_SLICE_DURATION_S, out=point_cloud[:, 2], dtype=dtype)
+    return point_cloud
+
+
+def photons_to_point_clouds(events, dtype=np.float32):
+    """
+    Converts a batch of events to point clouds, with one gather from the pixel angles for the photons of all events
+    :param events: Photons of each event, as list of lists or (chids, times) arrays
+    :param dtype: dtype of the point clouds
+    :return: List of the point cloud of each event, views of one array with the photons of all events
+    """
+    if len(events) == 0:
+        return []
+    chids, times = zip(*[photon_arrays(photons) for photons in events])
+    point_cloud = arrays_to_point_cloud(
+        np.concatenate(chids), np.concatenate(times), dtype
+    )
+    return np.split(point_cloud, np.cumsum([len(event) for event in times])[:-1])
+
+
+def photon_keys(chids, times):
+    """
+    Combines the CHID and arrival time slice of each photon into one integer, equal for photons on the same pixel
+    and time slice, which are the same point of the point cloud
+    :param chids: CHID of each photon
+    :param times: Arrival time slice of each photon, below LINEBREAK
+    :return: int64 key of each photon
+    """
+    return np.asarray(chids, dtype=np.int64) * (LINEBREAK + 1) + times
+
+
+def in_photons(photons, selected_photons):
+    """
+    Finds which photons of an event are also in a selection of it, such as its DBSCAN cleaned version, by sorting
+    and searching the keys of the photons instead of comparing every pair of points
+    :param photons: Photons of the event, as list of lists or (chids, times) arrays
+    :param selected_photons: Photons of the selection, as list of lists or (chids, times) arrays
+    :return: Boolean array, whether each photon of the event is at a point of the selection
+    """
+    keys = photon_keys(*photon_arrays(photons))
+    selected_keys = np.sort(photon_keys(*photon_arrays(selected_photons)))
+    if len(selected_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    positions = np.searchsorted(selected_keys, keys)
+    positions[positions == len(selected_keys)] = 0
+    return selected_keys[positions] == keys
@@ -10,6 +10,7 @@ setup(
     download_url="https://github.com/jacobbieker/factnn/archive/v0.5.0.tar.gz",
     keywords=["IACT Astronomy", "FACT", "Machine Learning", "Tensorflow"],
     packages=find_packages(),
+    package_data={"factnn.data.resources": ["rebinning.npz"]},
     install_requires=["astropy", "numpy"],
     classifiers=[
         "Development Status :: 3 - Alpha",